@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Depends
+
+from shared import storage
+from shared.clients import clients
+from shared.timescale import Timescale
+
+# Dependency to get a Timescale connection of the pool, it goes back to the pool after the request
+def get_timescale():
+    ts = clients.timescale()
+    try:
+        yield ts
+    finally:
+        ts.close()
+
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+)
+
+
+# Size and compression ratio of every chunk of the sensor_data hypertable (see shared/storage.py)
+@router.get("/storage/chunks")
+def get_storage_chunks(timescale: Timescale = Depends(get_timescale)):
+    return storage.chunk_stats(timescale)
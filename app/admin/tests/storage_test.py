@@ -0,0 +1,24 @@
+from fastapi.testclient import TestClient
+from app.main import app
+
+client = TestClient(app)
+
+
+def test_create_sensor_temperatura():
+    response = client.post("/sensors", json={"name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"})
+    assert response.status_code == 200
+
+def test_post_sensor_data():
+    response = client.post("/sensors/data/batch", json=[
+        {"sensor_id": 1, "data": {"temperature": float(i), "humidity": 1.0, "battery_level": 1.0, "last_seen": f"2020-01-{i + 1:02d}T00:00:00.000Z"}} for i in range(14)
+    ])
+    assert response.status_code == 200
+    assert response.json()["accepted"] == 14
+
+def test_get_storage_chunks():
+    response = client.get("/admin/storage/chunks")
+    assert response.status_code == 200
+    json_response = response.json()
+    assert json_response["hypertable"] == "sensor_data"
+    assert len(json_response["chunks"]) > 0
+    assert all(chunk["bytes"] > 0 for chunk in json_response["chunks"])
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from shared.cassandra_client import CassandraClient
+from shared.elasticsearch_client import ElasticsearchClient
+from shared.mongodb_client import MongoDBClient
+from shared.redis_client import RedisClient
+from shared.refresher import BUCKETS, aggregate_view
+from shared.timescale import Timescale
+
+
+# The Timescale migrations and views, applied once for the whole session
+@pytest.fixture(scope="session")
+def migrations():
+    from app.main import do_migrations
+    do_migrations()
+
+
+# Every test module starts with empty databases, whatever ran before it: the modules create their
+# sensors from id 1 and post readings at the same timestamps
+@pytest.fixture(scope="module", autouse=True)
+def clear_dbs(migrations):
+    from shared.database import engine
+    from shared.sensors import models
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    # The latest readings, the temperature stats, the data cache and the dirty hours of the refresher
+    redis = RedisClient(host="redis")
+    redis.clearAll()
+    redis.close()
+    mongo = MongoDBClient(host="mongodb")
+    mongo.clearDb("sensors")
+    mongo.close()
+    es = ElasticsearchClient(host="elasticsearch")
+    es.clearIndex("sensors")
+    ts = Timescale()
+    ts.enable_autocommit()
+    try:
+        ts.execute("TRUNCATE sensor_data")
+        # The aggregates keep the buckets they materialized, refreshing them empties them
+        for bucket in BUCKETS:
+            ts.execute(f"CALL refresh_continuous_aggregate('{aggregate_view(bucket)}', NULL, NULL)")
+    finally:
+        ts.close()
+
+    while True:
+        try:
+            cassandra = CassandraClient(["cassandra"])
+            cassandra.get_session().execute("DROP KEYSPACE IF EXISTS sensor")
+            cassandra.close()
+            break
+        except Exception:
+            time.sleep(5)
+    # The requests don't create the schema any more, it is created again after clearing the databases
+    from shared import bootstrap
+    bootstrap.run(force=True)
+    # The sensors were dropped, the cached metadata and data are stale
+    from shared.clients import clients
+    clients.sensor_cache.clear()
+    if clients.data_cache is not None:
+        clients.data_cache.clear()
@@ -1,18 +1,28 @@
 import json
 
+import psycopg2
 from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
 from shared.database import SessionLocal
 from shared.publisher import Publisher
+from shared.backpressure import QueueDepthMonitor, Rejected
 from shared.redis_client import RedisClient
 from shared.mongodb_client import MongoDBClient
 from shared.elasticsearch_client import ElasticsearchClient
 from shared.sensors.repository import DataCommand
 from shared.timescale import Timescale
-from shared.sensors import repository, schemas
+from shared.sensors import repository, schemas, ingest, streaming, export, downsampling
 from datetime import datetime
 from shared.cassandra_client import CassandraClient
+from shared.settings import get_settings
+from shared.clients import clients
+from shared.sensors.cache import SensorCache
+from shared.sensors.data_cache import DataCache
+
+settings = get_settings()
 
 # Dependency to get db session
 def get_db():
@@ -22,8 +32,12 @@ def get_db():
     finally:
         db.close()
 
+# The clients are created once per worker process (see shared/clients.py),
+# the dependencies only hand them to the request
+
+# Dependency to get a Timescale connection of the pool, it goes back to the pool after the request
 def get_timescale():
-    ts = Timescale()
+    ts = clients.timescale()
     try:
         yield ts
     finally:
@@ -31,38 +45,44 @@ def get_timescale():
 
 # Dependency to get redis client
 def get_redis_client():
-    redis = RedisClient(host="redis")
-    try:
-        yield redis
-    finally:
-        redis.close()
+    return clients.redis
 
 # Dependency to get mongodb client
 def get_mongodb_client():
-    mongodb = MongoDBClient(host="mongodb")
-    try:
-        yield mongodb
-    finally:
-        mongodb.close()
+    return clients.mongodb
 
 # Dependency to get elastic_search client
 def get_elastic_search():
-    es = ElasticsearchClient(host="elasticsearch")
-    try:
-        yield es
-    finally:
-        es.close()
+    return clients.elasticsearch
 
 # Dependency to get cassandra client
 def get_cassandra_client():
-    cassandra = CassandraClient(hosts=["cassandra"])
-    cassandra.create_low_battery_sensors_table()
-    cassandra.create_quantity_by_type_table()
-    cassandra.create_temperature_values_table()
+    return clients.cassandra
+
+# Dependency to get the queue publisher
+def get_publisher():
+    return clients.publisher
+
+# Dependency to get the queue depth monitor, None when the backpressure is disabled
+def get_queue_monitor():
+    return clients.queue_monitor if settings.backpressure_enabled else None
+
+# Refuses the reading with 429/503 and Retry-After while the consumers are behind (see shared/backpressure.py)
+def admit(monitor: QueueDepthMonitor, priority: schemas.Priority, sensor_id: int = None):
+    if monitor is None:
+        return
     try:
-        yield cassandra
-    finally:
-        cassandra.close()
+        monitor.admit(priority.value, sensor_id)
+    except Rejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+# Dependency to get the sensors metadata cache
+def get_sensor_cache():
+    return clients.sensor_cache
+
+# Dependency to get the cache of the aggregated data, None when it is disabled
+def get_data_cache():
+    return clients.data_cache
 
 
 router = APIRouter(
@@ -95,16 +115,112 @@ def search_sensors(query: str, size: int = 10, search_type: str = "match", db: S
 # 🙋🏽‍♀️ Add here the route to get the temperature values of a sensor
 
 @router.get("/temperature/values")
-def get_temperature_values(db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
-    return repository.get_temperature_values(db=db, cassandra=cassandra_client)
+def get_temperature_values(db: Session = Depends(get_db), redis_client: RedisClient = Depends(get_redis_client), cache: SensorCache = Depends(get_sensor_cache)):
+    return repository.get_temperature_values(db=db, redis=redis_client, cache=cache)
 
 @router.get("/quantity_by_type")
 def get_sensors_quantity(db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
     return repository.get_sensors_quantity(db=db, cassandra=cassandra_client)
 
 @router.get("/low_battery")
-def get_low_battery_sensors(db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client)):
-    return repository.get_low_battery_sensors(db=db, cassandra=cassandra_client)
+def get_low_battery_sensors(db: Session = Depends(get_db), cassandra_client: CassandraClient = Depends(get_cassandra_client), cache: SensorCache = Depends(get_sensor_cache)):
+    return repository.get_low_battery_sensors(db=db, cassandra=cassandra_client, cache=cache)
+
+# Batch ingest for gateways: a JSON array of {"sensor_id", "data"} items or a NDJSON stream
+# (Content-Type: application/x-ndjson, optionally with Content-Encoding: gzip).
+# Invalid items are reported by index and the valid ones are written in chunks.
+async def ingest_batch(request: Request, write):
+    result = ingest.BatchResult()
+    pending = []
+
+    async def flush():
+        errors = await run_in_threadpool(write, pending)
+        for index, error in errors:
+            result.reject(index, error)
+        result.accepted += len(pending) - len(errors)
+        pending.clear()
+
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip()
+    content_encoding = request.headers.get("content-encoding")
+    items = ingest.read_batch(request.stream(), content_type, content_encoding).__aiter__()
+    while True:
+        # Only reading the body is a 400, the errors of the writes of flush() are not
+        try:
+            index, message, error = await items.__anext__()
+        except StopAsyncIteration:
+            break
+        except ingest.BodyTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except ValueError as e:
+            # Also catches the json errors of a body that could not be read as an array
+            raise HTTPException(status_code=400, detail=f"Invalid batch: {e}")
+        if error is not None:
+            result.reject(index, error)
+            continue
+        pending.append((index, message))
+        if len(pending) >= settings.ingest_chunk_size:
+            await flush()
+    if pending:
+        await flush()
+    return result.to_dict()
+
+if settings.ingest_mode == "async":
+    @router.post("/data/batch", status_code=202)
+    async def record_data_batch(request: Request, priority: schemas.Priority = schemas.Priority.normal, publisher: Publisher = Depends(get_publisher), monitor: QueueDepthMonitor = Depends(get_queue_monitor)):
+        admit(monitor, priority)
+        def write(messages):
+            publisher.publish_many(message for _, message in messages)
+            return []
+        return await ingest_batch(request, write)
+else:
+    @router.post("/data/batch")
+    async def record_data_batch(request: Request, db: Session = Depends(get_db), redis_client: RedisClient = Depends(get_redis_client), timescale: Timescale = Depends(get_timescale), cassandra: CassandraClient = Depends(get_cassandra_client), cache: SensorCache = Depends(get_sensor_cache), data_cache: DataCache = Depends(get_data_cache)):
+        def write(messages):
+            return repository.record_data_messages(db=db, redis=redis_client, messages=messages, timescale=timescale, cassandra=cassandra, cache=cache, data_cache=data_cache)
+        return await ingest_batch(request, write)
+
+@router.get("/publisher/metrics")
+def get_publisher_metrics(publisher: Publisher = Depends(get_publisher)):
+    return publisher.metrics()
+
+@router.get("/cache/stats")
+def get_cache_stats(data_cache: DataCache = Depends(get_data_cache)):
+    if data_cache is None:
+        raise HTTPException(status_code=404, detail="The data cache is disabled")
+    return data_cache.stats()
+
+@router.get("/queue/status")
+def get_queue_status(monitor: QueueDepthMonitor = Depends(get_queue_monitor)):
+    if monitor is None:
+        raise HTTPException(status_code=404, detail="Backpressure is disabled")
+    return monitor.status()
+
+# Aggregated data of many sensors in one request, by ids (comma separated) and/or by type
+@router.get("/data")
+def get_data_many(_from: str, to: str, bucket: str, ids: str = None, type: str = None, db: Session = Depends(get_db), timescale: Timescale = Depends(get_timescale), cache: SensorCache = Depends(get_sensor_cache)):
+    if not ids and not type:
+        raise HTTPException(status_code=400, detail="ids or type is required")
+    try:
+        sensor_ids = [int(sensor_id) for sensor_id in ids.split(",") if sensor_id.strip()] if ids else None
+        command = DataCommand(_from, to, bucket)
+        return repository.get_data_many(db=db, timescale=timescale, command=command, sensor_ids=sensor_ids, sensor_type=type, cache=cache)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Arrow IPC or Parquet file of the data of many sensors (see shared/sensors/export.py), streamed
+# one row group at a time. bucket is one of the aggregates or "raw" for the readings of sensor_data.
+@router.get("/export")
+def export_data(ids: str, _from: str, to: str, bucket: str = "raw", format: str = "parquet", db: Session = Depends(get_db), timescale: Timescale = Depends(get_timescale), cache: SensorCache = Depends(get_sensor_cache)):
+    try:
+        sensor_ids = sorted(repository.get_sensors_metadata(db, [int(sensor_id) for sensor_id in ids.split(",") if sensor_id.strip()], cache))
+        chunks = export.export(timescale, sensor_ids, DataCommand(_from, to, bucket), format=format,
+                               row_group_size=settings.export_row_group_size, itersize=settings.stream_itersize)
+    except export.ExportUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filename = f"sensor_data_{bucket}.{export.EXTENSIONS[format]}"
+    return StreamingResponse(chunks, media_type=export.FORMATS[format], headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 # 🙋🏽‍♀️ Add here the route to get all sensors
 @router.get("")
@@ -114,11 +230,11 @@ def get_sensors(db: Session = Depends(get_db)):
 
 # 🙋🏽‍♀️ Add here the route to create a sensor
 @router.post("")
-def create_sensor(sensor: schemas.SensorCreate, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), es: ElasticsearchClient = Depends(get_elastic_search)):
+def create_sensor(sensor: schemas.SensorCreate, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), es: ElasticsearchClient = Depends(get_elastic_search), cassandra: CassandraClient = Depends(get_cassandra_client), cache: SensorCache = Depends(get_sensor_cache)):
     db_sensor = repository.get_sensor_by_name(db, sensor.name)
     if db_sensor:
         raise HTTPException(status_code=400, detail="Sensor with same name already registered")
-    return repository.create_sensor(db=db, sensor=sensor, mongodb = mongodb_client, es=es)
+    return repository.create_sensor(db=db, sensor=sensor, mongodb = mongodb_client, es=es, cassandra=cassandra, cache=cache)
 
 # 🙋🏽‍♀️ Add here the route to get a sensor by id
 @router.get("/{sensor_id}")
@@ -130,27 +246,62 @@ def get_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client: Mo
 
 # 🙋🏽‍♀️ Add here the route to delete a sensor
 @router.delete("/{sensor_id}")
-def delete_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), redis_client: RedisClient = Depends(get_redis_client)):
+def delete_sensor(sensor_id: int, db: Session = Depends(get_db), mongodb_client: MongoDBClient = Depends(get_mongodb_client), redis_client: RedisClient = Depends(get_redis_client), cassandra: CassandraClient = Depends(get_cassandra_client), cache: SensorCache = Depends(get_sensor_cache), data_cache: DataCache = Depends(get_data_cache)):
     db_sensor = repository.get_sensor(db, sensor_id)
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
-    return repository.delete_sensor(db=db, sensor_id=sensor_id, mongodb = mongodb_client, redis = redis_client)
+    return repository.delete_sensor(db=db, sensor_id=sensor_id, mongodb = mongodb_client, redis = redis_client, cassandra=cassandra, cache=cache, data_cache=data_cache)
     
 # 🙋🏽‍♀️ Add here the route to update a sensor
-@router.post("/{sensor_id}/data")
-def record_data(sensor_id: int, data: schemas.SensorData,db: Session = Depends(get_db) ,redis_client: RedisClient = Depends(get_redis_client), timescale: Timescale = Depends(get_timescale), cassandra: CassandraClient = Depends(get_cassandra_client)):
-    db_sensor = repository.get_sensor(db,sensor_id)
-    if db_sensor is None:
-        raise HTTPException(status_code=404, detail="Sensor not found") 
-    return repository.record_data(redis=redis_client, db_sensor=db_sensor, data=data, timescale=timescale, cassandra=cassandra)
+# In async mode the reading is only validated and published to the queue, the consumer writes it to the databases
+if settings.ingest_mode == "async":
+    @router.post("/{sensor_id}/data", status_code=202)
+    def record_data(sensor_id: int, data: schemas.SensorData, priority: schemas.Priority = schemas.Priority.normal, publisher: Publisher = Depends(get_publisher), monitor: QueueDepthMonitor = Depends(get_queue_monitor)):
+        admit(monitor, priority, sensor_id)
+        publisher.publish(schemas.SensorDataMessage(sensor_id=sensor_id, data=data))
+        return data
+else:
+    @router.post("/{sensor_id}/data")
+    def record_data(sensor_id: int, data: schemas.SensorData,db: Session = Depends(get_db) ,redis_client: RedisClient = Depends(get_redis_client), timescale: Timescale = Depends(get_timescale), cassandra: CassandraClient = Depends(get_cassandra_client), cache: SensorCache = Depends(get_sensor_cache), data_cache: DataCache = Depends(get_data_cache)):
+        # The sensor metadata comes from the cache, most readings don't query Postgres
+        db_sensor = repository.get_sensor_metadata(db, sensor_id, cache)
+        if db_sensor is None:
+            raise HTTPException(status_code=404, detail="Sensor not found") 
+        try:
+            return repository.record_data(redis=redis_client, db_sensor=db_sensor, data=data, timescale=timescale, cassandra=cassandra, data_cache=data_cache)
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            raise HTTPException(status_code=400, detail=f"Not stored: {str(e).strip()}")
 
 # 🙋🏽‍♀️ Add here the route to get data from a sensor
 @router.get("/{sensor_id}/data")
-def get_data(sensor_id: int, _from: str, to: str, bucket: str, db: Session = Depends(get_db) ,redis_client: RedisClient = Depends(get_redis_client), timescale: Timescale = Depends(get_timescale)):    
+def get_data(sensor_id: int, _from: str, to: str, bucket: str = None, max_points: int = None, method: str = "lttb", metric: str = None, db: Session = Depends(get_db) ,redis_client: RedisClient = Depends(get_redis_client), timescale: Timescale = Depends(get_timescale), data_cache: DataCache = Depends(get_data_cache)):    
+    # The downsampling parameters are checked before querying the sensor and its data
+    try:
+        downsampling.validate(max_points, method, metric)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     db_sensor = repository.get_sensor(db,sensor_id)
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
-    return repository.get_data(redis=redis_client, db_sensor=db_sensor, timescale=timescale, _from=_from,to=to, bucket=bucket)
+    try:
+        return repository.get_data(redis=redis_client, db_sensor=db_sensor, timescale=timescale, _from=_from,to=to, bucket=bucket, data_cache=data_cache,
+                                   max_points=max_points, method=method, metric=metric)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Streams the data of a sensor as NDJSON or CSV with constant memory, for exports and long ranges.
+# bucket is one of the aggregates or "raw" for the readings of sensor_data.
+@router.get("/{sensor_id}/data/stream")
+def stream_data(sensor_id: int, _from: str, to: str, bucket: str, format: str = "ndjson", db: Session = Depends(get_db), timescale: Timescale = Depends(get_timescale)):
+    if format not in streaming.MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(streaming.MEDIA_TYPES)}")
+    repository.get_sensor(db, sensor_id)
+    try:
+        columns, rows = repository.stream_data(timescale=timescale, sensor_ids=[sensor_id], command=DataCommand(_from, to, bucket), itersize=settings.stream_itersize)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # The pooled connection of get_timescale goes back to the pool after the response is sent
+    return StreamingResponse(streaming.encode(rows, columns, format), media_type=streaming.MEDIA_TYPES[format])
 
 class ExamplePayload():
     def __init__(self, example):
@@ -159,7 +310,7 @@ class ExamplePayload():
     def to_json(self):
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
 @router.post("/exemple/queue")
-def exemple_queue():
+def exemple_queue(publisher: Publisher = Depends(get_publisher)):
     # Publish here the data to the queue
     publisher.publish(ExamplePayload("holaaaaa"))
     return {"message": "Data published to the queue"}
\ No newline at end of file
@@ -0,0 +1,68 @@
+from fastapi.testclient import TestClient
+import gzip
+import json
+from app.main import app
+from shared.redis_client import RedisClient
+
+client = TestClient(app)
+
+
+def test_create_sensor_temperatura():
+    response = client.post("/sensors", json={"name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"})
+    assert response.status_code == 200
+
+def test_post_batch_json():
+    response = client.post("/sensors/data/batch", json=[
+        {"sensor_id": 1, "data": {"temperature": 1.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T00:00:00.000Z"}},
+        {"sensor_id": 1, "data": {"temperature": 2.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T01:00:00.000Z"}},
+    ])
+    assert response.status_code == 200
+    assert response.json() == {"accepted": 2, "rejected": 0, "errors": []}
+    redis = RedisClient(host="redis")
+    assert json.loads(redis.get(1))["temperature"] == 2.0
+    redis.close()
+
+def test_post_batch_json_per_item_errors():
+    response = client.post("/sensors/data/batch", json=[
+        {"sensor_id": 1, "data": {"temperature": 3.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T02:00:00.000Z"}},
+        {"sensor_id": 1, "data": {"temperature": 4.0}},
+        {"sensor_id": 99, "data": {"temperature": 5.0, "humidity": 1.0, "battery_level": 1.0, "last_seen": "2020-01-01T02:00:00.000Z"}},
+    ])
+    assert response.status_code == 200
+    json_response = response.json()
+    assert json_response["accepted"] == 1
+    assert json_response["rejected"] == 2
+    assert [error["index"] for error in json_response["errors"]] == [1, 2]
+    assert json_response["errors"][1]["error"] == "Sensor not found"
+
+def test_post_batch_invalid_last_seen():
+    response = client.post("/sensors/data/batch", json=[
+        {"sensor_id": 1, "data": {"temperature": 3.5, "battery_level": 1.0, "last_seen": "yesterday"}},
+        {"sensor_id": 1, "data": {"temperature": 3.5, "battery_level": 1.0, "last_seen": "2020-01-01T03:00:00.000Z"}},
+    ])
+    assert response.status_code == 200
+    json_response = response.json()
+    assert json_response["accepted"] == 1
+    assert [error["index"] for error in json_response["errors"]] == [0]
+
+def test_post_batch_ndjson_gzip():
+    lines = [json.dumps({"sensor_id": 1, "data": {"temperature": float(i), "battery_level": 1.0, "last_seen": f"2020-01-02T{i:02d}:00:00.000Z"}}) for i in range(24)]
+    body = gzip.compress(("\n".join(lines) + "\nnot json\n").encode())
+    response = client.post("/sensors/data/batch", content=body, headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"})
+    assert response.status_code == 200
+    json_response = response.json()
+    assert json_response["accepted"] == 24
+    assert json_response["rejected"] == 1
+    assert json_response["errors"][0]["index"] == 24
+
+def test_post_batch_not_an_array():
+    response = client.post("/sensors/data/batch", json={"sensor_id": 1})
+    assert response.status_code == 400
+
+def test_post_batch_json_too_large(monkeypatch):
+    from shared.sensors import ingest
+    monkeypatch.setattr(ingest, "MAX_JSON_BODY_BYTES", 100)
+    response = client.post("/sensors/data/batch", json=[
+        {"sensor_id": 1, "data": {"temperature": 1.0, "battery_level": 1.0, "last_seen": f"2020-01-03T{i:02d}:00:00.000Z"}} for i in range(10)
+    ])
+    assert response.status_code == 413
@@ -1,42 +1,25 @@
 from fastapi.testclient import TestClient
-import pytest
 from app.main import app
-from shared.redis_client import RedisClient
-from shared.mongodb_client import MongoDBClient
-from shared.elasticsearch_client import ElasticsearchClient
-from shared.timescale import Timescale
-from shared.cassandra_client import CassandraClient
-import time
+from contextlib import contextmanager
+from sqlalchemy import event
 
 client = TestClient(app)
 
 
-@pytest.fixture(scope="session", autouse=True)
-def clear_dbs():
-    from shared.database import SessionLocal, engine
-    from shared.sensors import models
-    models.Base.metadata.drop_all(bind=engine)
-    models.Base.metadata.create_all(bind=engine)
-    redis = RedisClient(host="redis")
-    redis.clearAll()
-    redis.close()
-    mongo = MongoDBClient(host="mongodb")
-    mongo.clearDb("sensors")
-    mongo.close()
-    es = ElasticsearchClient(host="elasticsearch")
-    es.clearIndex("sensors")  
-    ts = Timescale()
-    #TODO execute TS migrations
-    ts.close()
-     
-    while True:
-        try:
-            cassandra = CassandraClient(["cassandra"])
-            cassandra.get_session().execute("DROP KEYSPACE IF EXISTS sensor")
-            cassandra.close()
-            break
-        except Exception as e:
-            time.sleep(5)
+# Collects the SQL statements sent to PostgreSQL while the block runs
+@contextmanager
+def sql_statements():
+    from shared.database import engine
+    statements = []
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", collect)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", collect)
+
+
 def test_create_sensor_temperatura_1():
     """A sensor can be properly created"""
     response = client.post("/sensors", json={"name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"})
@@ -97,3 +80,32 @@ def test_get_sensors_low_battery():
     assert response.status_code == 200
     assert response.json() == {"sensors": [{"id": 2, "name": "Velocitat 1", "latitude": 1.0, "longitude": 1.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:01", "manufacturer": "Dummy", "model":"Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 1", "battery_level": 0.1}, {"id": 3, "name": "Velocitat 2", "latitude": 2.0, "longitude": 2.0, "type": "Velocitat", "mac_address": "00:00:00:00:00:02", "manufacturer": "Dummy", "model":"Dummy Vel", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de velocitat model Dummy Vel del fabricant Dummy cruïlla 2", "battery_level": 0.15}]}
 
+def test_sensor_details_loaded_with_one_query():
+    from shared.clients import clients
+    clients.sensor_cache.clear()
+    with sql_statements() as statements:
+        response = client.get("/sensors/temperature/values")
+    assert response.status_code == 200
+    assert len(response.json()["sensors"]) == 2
+    assert len(statements) == 1
+    # The details of the same sensors come from the metadata cache
+    with sql_statements() as statements:
+        response = client.get("/sensors/temperature/values")
+    assert response.status_code == 200
+    assert len(statements) == 0
+    clients.sensor_cache.clear()
+    with sql_statements() as statements:
+        response = client.get("/sensors/low_battery")
+    assert response.status_code == 200
+    assert len(response.json()["sensors"]) == 2
+    assert len(statements) == 1
+
+def test_sensor_counts_match_the_sensors():
+    from shared.clients import clients
+    from shared.database import SessionLocal
+    from shared.sensors import type_counts
+    db = SessionLocal()
+    try:
+        assert type_counts.reconcile(db, clients.cassandra, dry_run=True) == {}
+    finally:
+        db.close()
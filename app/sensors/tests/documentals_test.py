@@ -1,43 +1,11 @@
-import time
 from fastapi.testclient import TestClient
-import pytest
 from app.main import app
-from shared.cassandra_client import CassandraClient
-from shared.elasticsearch_client import ElasticsearchClient
 from shared.redis_client import RedisClient
 from shared.mongodb_client import MongoDBClient
-from shared.timescale import Timescale
 
 client = TestClient(app)
 
 
-
-@pytest.fixture(scope="session", autouse=True)
-def clear_dbs():
-    from shared.database import SessionLocal, engine
-    from shared.sensors import models
-    models.Base.metadata.drop_all(bind=engine)
-    models.Base.metadata.create_all(bind=engine)
-    redis = RedisClient(host="redis")
-    redis.clearAll()
-    redis.close()
-    mongo = MongoDBClient(host="mongodb")
-    mongo.clearDb("sensors")
-    mongo.close()
-    es = ElasticsearchClient(host="elasticsearch")
-    es.clearIndex("sensors")
-    ts = Timescale()
-    ts.close()
-
-    while True:
-        try:
-            cassandra = CassandraClient(["cassandra"])
-            cassandra.get_session().execute("DROP KEYSPACE IF EXISTS sensor")
-            cassandra.close()
-            break
-        except Exception as e:
-            time.sleep(5)
-
 def test_documentals_create_sensor_temperatura():
      """A sensor can be properly created"""
      response = client.post("/sensors", json={"name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0,
@@ -1,48 +1,12 @@
 from fastapi.testclient import TestClient
 import pytest
-import time
 from app.main import app
-from shared.redis_client import RedisClient
-from shared.mongodb_client import MongoDBClient
-from shared.elasticsearch_client import ElasticsearchClient
-from shared.timescale import Timescale
-from shared.cassandra_client import CassandraClient
 from yoyo import read_migrations, get_backend
 import os
 
 client = TestClient(app)
 
 
-
-@pytest.fixture(scope="session", autouse=True)
-def clear_dbs():
-    from shared.database import SessionLocal, engine
-    from shared.sensors import models
-    models.Base.metadata.drop_all(bind=engine)
-    models.Base.metadata.create_all(bind=engine)
-    redis = RedisClient(host="redis")
-    redis.clearAll()
-    redis.close()
-    mongo = MongoDBClient(host="mongodb")
-    mongo.clearDb("sensors")
-    mongo.close()
-    es = ElasticsearchClient(host="elasticsearch")
-    es.clearIndex("sensors")  
-    ts = Timescale()
-    ts.close()
-    from app.main import do_migrations  
-    do_migrations()
-
-
-    while True:
-        try:
-            cassandra = CassandraClient(["cassandra"])
-            cassandra.get_session().execute("DROP KEYSPACE IF EXISTS sensor")
-            cassandra.close()
-            break
-        except Exception as e:
-            time.sleep(5)
-
 def test_create_sensor_temperatura():
     """A sensor can be properly created"""
     response = client.post("/sensors", json={"name": "Sensor Temperatura 1", "latitude": 1.0, "longitude": 1.0, "type": "Temperatura", "mac_address": "00:00:00:00:00:00", "manufacturer": "Dummy", "model":"Dummy Temp", "serie_number": "0000 0000 0000 0000", "firmware_version": "1.0", "description": "Sensor de temperatura model Dummy Temp del fabricant Dummy"})
@@ -141,4 +105,72 @@ def test_get_sensor_data_not_exists():
     response = client.get("/sensors/4/data")
     assert response.status_code == 404
     assert "Sensor not found" in response.text
-'''
\ No newline at end of file
+'''
+
+def test_get_data_many_sensors():
+    response = client.get("/sensors/data?ids=1,2,99&_from=2020-01-01T00:00:00.000Z&to=2020-01-03T00:00:00.000Z&bucket=day")
+    assert response.status_code == 200
+    json_response = response.json()
+    assert [sensor["id"] for sensor in json_response] == [1, 2]
+    assert len(json_response[0]["data"]) == 3
+    assert len(json_response[1]["data"]) == 1
+
+def test_get_data_many_sensors_by_type():
+    response = client.get("/sensors/data?type=Velocitat&_from=2020-01-01T00:00:00.000Z&to=2020-01-15T00:00:00.000Z&bucket=day")
+    assert response.status_code == 200
+    assert [sensor["id"] for sensor in response.json()] == [2, 3]
+
+def test_post_sensor_data_hores():
+    response = client.post("/sensors/data/batch", json=[
+        {"sensor_id": 1, "data": {"temperature": float(i), "humidity": 1.0, "battery_level": 1.0, "last_seen": f"2020-02-01T{i:02d}:00:00.000Z"}} for i in range(24)
+    ])
+    assert response.status_code == 200
+    assert response.json()["accepted"] == 24
+
+def test_stream_raw_data_csv():
+    response = client.get("/sensors/1/data/stream?_from=2020-02-01T00:00:00.000Z&to=2020-02-01T23:00:00.000Z&bucket=raw&format=csv")
+    assert response.status_code == 200
+    lines = response.text.strip().splitlines()
+    assert lines[0] == "id,last_seen,temperature,humidity,velocity,battery_level"
+    assert len(lines) == 25
+
+def test_stream_aggregated_data_ndjson():
+    response = client.get("/sensors/1/data/stream?_from=2020-01-01T00:00:00.000Z&to=2020-01-03T00:00:00.000Z&bucket=day")
+    assert response.status_code == 200
+    assert len(response.text.strip().splitlines()) == 3
+
+def test_export_raw_data_parquet():
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    response = client.get("/sensors/export?ids=1&_from=2020-02-01T00:00:00.000Z&to=2020-02-01T23:00:00.000Z&bucket=raw&format=parquet")
+    assert response.status_code == 200
+    table = pyarrow.parquet.read_table(pyarrow.BufferReader(response.content))
+    assert table.column_names == ["id", "last_seen", "temperature", "humidity", "velocity", "battery_level"]
+    assert table.num_rows == 24
+
+def test_get_data_downsampled():
+    response = client.get("/sensors/1/data?_from=2020-02-01T00:00:00.000Z&to=2020-02-01T23:00:00.000Z&bucket=hour&max_points=6")
+    assert response.status_code == 200
+    json_response = response.json()
+    assert len(json_response) == 6
+    assert json_response[0]["temperature"] == 0.0
+    assert json_response[-1]["temperature"] == 23.0
+
+def test_get_data_statistics():
+    response = client.get("/sensors/1/data?_from=2020-02-01T00:00:00.000Z&to=2020-02-01T01:00:00.000Z&bucket=day")
+    assert response.status_code == 200
+    json_response = response.json()
+    assert len(json_response) == 1
+    day = json_response[0]
+    assert day["temperature"] == 11.5
+    assert day["temperature_min"] == 0.0
+    assert day["temperature_max"] == 23.0
+    assert day["temperature_count"] == 24
+    assert round(day["temperature_stddev"], 4) == 7.0711
+
+def test_get_data_downsampled_invalid():
+    # The parameters are checked before looking for the sensor
+    response = client.get("/sensors/99/data?_from=2020-02-01T00:00:00.000Z&to=2020-02-01T23:00:00.000Z&bucket=hour&max_points=1")
+    assert response.status_code == 400
+    response = client.get("/sensors/99/data?_from=2020-02-01T00:00:00.000Z&to=2020-02-01T23:00:00.000Z&bucket=hour&max_points=6&method=average")
+    assert response.status_code == 400
@@ -0,0 +1,60 @@
+# Compares encode/decode throughput and message size of the queue formats: one JSON message per
+# reading, a JSON array of readings and the binary frames of shared/sensors/codec.py. No service is needed:
+#   python -m benchmarks.codec --readings 100000 --batch 500
+import argparse
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+from shared.sensors import codec, schemas
+
+
+def make_messages(count, sensors=1000):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    return [
+        schemas.SensorDataMessage(sensor_id=i % sensors, data=schemas.SensorData(
+            temperature=20.0 + i % 10, humidity=50.0, battery_level=0.9, last_seen=(start + timedelta(seconds=i)).isoformat()))
+        for i in range(count)
+    ]
+
+
+def chunks(messages, size):
+    return [messages[i:i + size] for i in range(0, len(messages), size)]
+
+
+def json_single(messages, batch):
+    bodies = [message.to_json().encode() for message in messages]
+    return bodies, lambda body: [schemas.SensorDataMessage.parse_raw(body)]
+
+
+def json_batch(messages, batch):
+    bodies = [("[" + ",".join(message.to_json() for message in chunk) + "]").encode() for chunk in chunks(messages, batch)]
+    return bodies, lambda body: [schemas.SensorDataMessage.parse_obj(item) for item in json.loads(body)]
+
+
+def binary_batch(messages, batch):
+    return [codec.encode(chunk) for chunk in chunks(messages, batch)], codec.decode
+
+
+def run(name, encoder, messages, batch):
+    started = time.perf_counter()
+    bodies, decode = encoder(messages, batch)
+    encoded = time.perf_counter() - started
+    started = time.perf_counter()
+    decoded = sum(len(decode(body)) for body in bodies)
+    elapsed = time.perf_counter() - started
+    assert decoded == len(messages)
+    size = sum(len(body) for body in bodies)
+    print(f"{name:>12} encode {len(messages) / encoded:>10.0f} msg/s  decode {len(messages) / elapsed:>10.0f} msg/s  "
+          f"{size / len(messages):>7.1f} bytes/reading  {len(bodies):>7} messages")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readings", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=500, help="readings per message of the batched formats")
+    args = parser.parse_args()
+    messages = make_messages(args.readings)
+    run("json", json_single, messages, args.batch)
+    run("json batch", json_batch, messages, args.batch)
+    run("binary", binary_batch, messages, args.batch)
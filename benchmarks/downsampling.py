@@ -0,0 +1,37 @@
+# Time of the downsampling methods of shared/sensors/downsampling.py for a range of max_points. By
+# default the series has max_points * OVERSAMPLING points, what get_data fetches without a bucket;
+# --points fixes its length instead, like a request with an explicit bucket. No service is needed:
+#   python -m benchmarks.downsampling --max-points 100 1000 10000 [--points 1000000]
+import argparse
+import time
+
+import numpy as np
+
+from shared.sensors import downsampling
+
+
+def make_series(size):
+    rng = np.random.default_rng(0)
+    x = np.arange(size, dtype=float) * 3600
+    y = np.cumsum(rng.normal(size=size))
+    return x, y
+
+
+def run(name, method, x, y, max_points, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        indexes = method(x, y, max_points)
+    elapsed = (time.perf_counter() - started) / repeat
+    print(f"{name:>7} {len(x):>9} points -> {len(indexes):>6} {elapsed * 1000:>9.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-points", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--points", type=int, help="length of the series, by default max_points * OVERSAMPLING")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for max_points in args.max_points:
+        x, y = make_series(args.points or max_points * downsampling.OVERSAMPLING)
+        run("lttb", downsampling.lttb, x, y, max_points, args.repeat)
+        run("minmax", downsampling.minmax, x, y, max_points, args.repeat)
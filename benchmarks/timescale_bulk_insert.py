@@ -0,0 +1,56 @@
+# Compares rows/sec of the per-row insert against the bulk COPY and execute_values paths.
+# Run it inside the compose network (it uses the TS_* environment like the API):
+#   python -m benchmarks.timescale_bulk_insert --sizes 1000 10000 100000
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+
+from shared.timescale import Timescale
+
+# Synthetic sensor ids, far from the real ones so the benchmark rows can be deleted safely
+BENCHMARK_SENSOR_ID = 1_000_000
+
+
+def make_rows(size, sensors=100):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    return [
+        (BENCHMARK_SENSOR_ID + i % sensors, (start + timedelta(seconds=i)).isoformat(), 20.0 + i % 10, 50.0, None, 0.9)
+        for i in range(size)
+    ]
+
+
+def clean(ts):
+    ts.execute(f"DELETE FROM sensor_data WHERE id >= {BENCHMARK_SENSOR_ID}")
+    ts.conn.commit()
+
+
+def per_row(ts, rows):
+    for row in rows:
+        ts.insert_sensor_data(row[0], dict(zip(("last_seen", "temperature", "humidity", "velocity", "battery_level"), row[1:])))
+
+
+def run(ts, name, insert, rows):
+    clean(ts)
+    started = time.perf_counter()
+    insert(ts, rows)
+    elapsed = time.perf_counter() - started
+    print(f"{name:>15} {len(rows):>8} rows {elapsed:>9.3f} s {len(rows) / elapsed:>12.0f} rows/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--skip-per-row", action="store_true", help="the per-row path takes minutes for 100k rows")
+    args = parser.parse_args()
+
+    ts = Timescale()
+    try:
+        for size in args.sizes:
+            rows = make_rows(size)
+            if not args.skip_per_row:
+                run(ts, "per_row", per_row, rows)
+            run(ts, "execute_values", lambda ts, rows: ts.insert_sensor_data_bulk(rows, method="execute_values"), rows)
+            run(ts, "copy", lambda ts, rows: ts.insert_sensor_data_bulk(rows), rows)
+        clean(ts)
+    finally:
+        ts.close()
@@ -0,0 +1,87 @@
+# Compares the on-disk size and the range-scan latency of a year of synthetic readings before and after
+# the native compression of shared/storage.py (segmented by id, ordered by last_seen). The readings go
+# to a hypertable of their own, dropped at the end. Run it inside the compose network:
+#   python -m benchmarks.timescale_compression --sensors 50 --interval-minutes 10
+import argparse
+import statistics
+import time
+
+from shared.timescale import Timescale
+
+TABLE = "sensor_data_compression_benchmark"
+START = "2021-01-01T00:00:00+00:00"
+
+# (name, query) of the range scans timed, %(sensor)s is a sensor id
+QUERIES = [
+    ("1 sensor, 1 day", f"SELECT * FROM {TABLE} WHERE id = %(sensor)s AND last_seen BETWEEN '2021-06-01' AND '2021-06-02'"),
+    ("1 sensor, 1 month", f"SELECT * FROM {TABLE} WHERE id = %(sensor)s AND last_seen BETWEEN '2021-06-01' AND '2021-07-01'"),
+    ("1 sensor, year avg", f"SELECT avg(temperature) FROM {TABLE} WHERE id = %(sensor)s"),
+    ("all sensors, 1 day", f"SELECT * FROM {TABLE} WHERE last_seen BETWEEN '2021-06-01' AND '2021-06-02'"),
+]
+
+
+def create(ts, sensors, interval_minutes, chunk_hours):
+    ts.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    ts.execute(f"""
+        CREATE TABLE {TABLE} (id INT, last_seen TIMESTAMPTZ NOT NULL, temperature float, humidity float,
+                              velocity float, battery_level float NOT NULL, PRIMARY KEY (id, last_seen))""")
+    ts.fetch_all("SELECT create_hypertable(%s, 'last_seen', chunk_time_interval => %s::interval)", (TABLE, f"{chunk_hours} hours"))
+    started = time.perf_counter()
+    ts.execute(f"""
+        INSERT INTO {TABLE}
+        SELECT sensor, t, 20 + 5 * sin(extract(epoch FROM t) / 86400 * 2 * pi()) + random(), 50 + 10 * random(),
+               NULL, 1 - extract(epoch FROM t - '{START}') / (366 * 86400)
+        FROM generate_series(1, {int(sensors)}) sensor,
+             generate_series('{START}'::timestamptz, '{START}'::timestamptz + INTERVAL '1 year' - INTERVAL '1 second',
+                             INTERVAL '{int(interval_minutes)} minutes') t""")
+    rows = ts.fetch_all(f"SELECT count(*) FROM {TABLE}")[0][0]
+    print(f"Inserted {rows} rows in {time.perf_counter() - started:.1f} s")
+
+
+def size(ts):
+    return ts.fetch_all("SELECT hypertable_size(%s)", (TABLE,))[0][0]
+
+
+def scan(ts, repeat, sensors):
+    results = {}
+    for name, query in QUERIES:
+        timings = []
+        for i in range(repeat):
+            started = time.perf_counter()
+            ts.fetch_all(query, {"sensor": 1 + i % sensors})
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = statistics.median(timings)
+    return results
+
+
+def compress(ts):
+    ts.execute(f"ALTER TABLE {TABLE} SET (timescaledb.compress, timescaledb.compress_segmentby = 'id', timescaledb.compress_orderby = 'last_seen')")
+    started = time.perf_counter()
+    chunks = ts.fetch_all(f"SELECT compress_chunk(chunk) FROM show_chunks('{TABLE}') chunk")
+    print(f"Compressed {len(chunks)} chunks in {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sensors", type=int, default=50)
+    parser.add_argument("--interval-minutes", type=int, default=10, help="minutes between the readings of a sensor")
+    parser.add_argument("--chunk-hours", type=int, default=24)
+    parser.add_argument("--repeat", type=int, default=20, help="runs of every query, the median is reported")
+    parser.add_argument("--keep", action="store_true", help="don't drop the benchmark hypertable")
+    args = parser.parse_args()
+    ts = Timescale()
+    ts.enable_autocommit()
+    try:
+        create(ts, args.sensors, args.interval_minutes, args.chunk_hours)
+        ts.execute(f"ANALYZE {TABLE}")
+        before_size, before = size(ts), scan(ts, args.repeat, args.sensors)
+        compress(ts)
+        ts.execute(f"ANALYZE {TABLE}")
+        after_size, after = size(ts), scan(ts, args.repeat, args.sensors)
+        print(f"{'size':>20} {before_size / 2**20:>10.1f} MB -> {after_size / 2**20:>10.1f} MB ({before_size / after_size:.1f}x)")
+        for name, _ in QUERIES:
+            print(f"{name:>20} {before[name]:>10.2f} ms -> {after[name]:>10.2f} ms")
+    finally:
+        if not args.keep:
+            ts.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        ts.close()
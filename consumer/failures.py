@@ -0,0 +1,24 @@
+import psycopg2
+from pydantic import ValidationError
+
+# Errors caused by the readings themselves: writing them again would fail again, so they go to the
+# dead-letter queue. The readings of unknown sensors are not exceptions, record_data_messages returns
+# them as errors and they are dead-lettered too. Any other error (a database unavailable, a timeout,
+# a bug of the write path...) is transient: the messages are retried later and only reach the
+# dead-letter queue after the last retry.
+PERMANENT_ERRORS = (
+    ValidationError,
+    psycopg2.IntegrityError,
+    psycopg2.DataError,
+)
+
+PERMANENT = "permanent"
+TRANSIENT = "transient"
+
+
+def classify(error):
+    return PERMANENT if isinstance(error, PERMANENT_ERRORS) else TRANSIENT
+
+
+def describe(error):
+    return f"{type(error).__name__}: {error}"
@@ -1,13 +1,71 @@
-import json
+import multiprocessing
+import os
+import signal
+import time
 
-from shared.subscriber import Subscriber
+from consumer.worker import run_worker
+from shared.settings import get_settings
 
-subscriber = Subscriber()
+# Seconds to wait before restarting a worker that crashed, doubled on every crash in a row
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+# A worker that ran this long is considered healthy again
+HEALTHY_AFTER = 60
 
 
-def callback(ch, method, properties, body):
-    data = json.loads(body)
-    print("Received data:", data)
+# Starts the consumer worker processes and restarts the ones that die
+class Supervisor():
+    def __init__(self, processes):
+        self.processes = processes
+        # spawn: the workers don't inherit any connection of this process
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = {}
+        self.restarts = {}
+        self.running = True
 
+    def start_worker(self, worker):
+        process = self.context.Process(target=run_worker, args=(worker, self.processes), name=f"consumer-worker-{worker}")
+        process.start()
+        self.workers[worker] = (process, time.monotonic())
 
-subscriber.subscribe(callback)
+    def run(self):
+        for worker in range(self.processes):
+            self.start_worker(worker)
+        pending = {}
+        while self.running:
+            now = time.monotonic()
+            for worker, (process, started) in list(self.workers.items()):
+                if process.is_alive() or worker in pending:
+                    continue
+                crashes = 0 if now - started > HEALTHY_AFTER else self.restarts.get(worker, 0) + 1
+                self.restarts[worker] = crashes
+                delay = min(RESTART_DELAY * 2 ** crashes, MAX_RESTART_DELAY)
+                print(f"Worker {worker} exited with code {process.exitcode}, restarting in {delay} s")
+                pending[worker] = now + delay
+            for worker, restart_at in list(pending.items()):
+                if self.running and now >= restart_at:
+                    del pending[worker]
+                    self.start_worker(worker)
+            time.sleep(0.5)
+
+    def stop(self, *args):
+        self.running = False
+        for process, _ in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process, _ in self.workers.values():
+            process.join(timeout=10)
+
+
+if __name__ == "__main__":
+    settings = get_settings()
+    processes = min(settings.consumer_processes or os.cpu_count() or 1, settings.queue_shards)
+    supervisor = Supervisor(processes)
+    signal.signal(signal.SIGTERM, lambda *args: supervisor.stop())
+    try:
+        print(f"Starting {processes} consumer workers for {settings.queue_shards} shards")
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
@@ -0,0 +1,101 @@
+import psycopg2
+import pika
+import pytest
+
+from consumer import failures, worker
+from consumer.worker import BatchConsumer
+from shared.publisher import JSON_CONTENT_TYPE
+from shared.queues import DEAD_LETTER_EXCHANGE, RETRY_COUNT_HEADER
+from shared.sensors import repository, schemas
+
+# Temperature of the reading the fake write path can't store
+BAD_TEMPERATURE = -999.0
+
+
+class FakeSubscriber():
+    def __init__(self):
+        self.published = []
+        self.acked = []
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((exchange, body, properties))
+
+    def ack(self, delivery_tag, multiple=False):
+        self.acked.append(delivery_tag)
+
+    def nack(self, delivery_tag, multiple=False, requeue=True):
+        raise AssertionError("the batch must not be nacked")
+
+    def call_later(self, delay, callback):
+        return object()
+
+    def remove_timeout(self, timer_id):
+        pass
+
+
+class FakeConnection():
+    def rollback(self):
+        pass
+
+
+class FakeTimescale():
+    conn = FakeConnection()
+
+
+def message(index, temperature):
+    return schemas.SensorDataMessage(sensor_id=1, data=schemas.SensorData(
+        temperature=temperature, battery_level=1.0, last_seen=f"2020-01-01T{index:02d}:00:00+00:00"))
+
+
+def deliver(consumer, messages):
+    for index, sensor_message in enumerate(messages):
+        method = pika.spec.Basic.Deliver(delivery_tag=index + 1, routing_key="sensor_data.0")
+        consumer.on_message(None, method, pika.BasicProperties(content_type=JSON_CONTENT_TYPE), sensor_message.to_json())
+
+
+# The fake writes don't use the session
+@pytest.fixture(autouse=True)
+def session(monkeypatch):
+    monkeypatch.setattr(worker, "SessionLocal", lambda: type("Session", (), {"close": lambda self: None})())
+
+
+@pytest.fixture
+def written(monkeypatch):
+    written = []
+
+    # The whole write raises when the batch has the bad reading, like a bulk insert that gives up
+    def record_data_messages(db, redis, messages, timescale, cassandra, cache=None, data_cache=None):
+        if any(sensor_message.data.temperature == BAD_TEMPERATURE for _, sensor_message in messages):
+            raise psycopg2.DataError("value out of range")
+        written.extend(sensor_message.data.temperature for _, sensor_message in messages)
+        return []
+
+    monkeypatch.setattr(repository, "record_data_messages", record_data_messages)
+    return written
+
+
+def test_failed_batch_dead_letters_only_the_bad_reading(written):
+    subscriber = FakeSubscriber()
+    consumer = BatchConsumer(subscriber, redis=None, timescale=FakeTimescale(), cassandra=None, batch_size=8, batch_ms=1000, retry_delays=[1000])
+    deliver(consumer, [message(index, BAD_TEMPERATURE if index == 5 else float(index)) for index in range(8)])
+    assert sorted(written) == [0.0, 1.0, 2.0, 3.0, 4.0, 6.0, 7.0]
+    assert len(subscriber.published) == 1
+    exchange, body, properties = subscriber.published[0]
+    assert exchange == DEAD_LETTER_EXCHANGE
+    assert schemas.SensorDataMessage.parse_raw(body).data.temperature == BAD_TEMPERATURE
+    assert properties.headers["x-failure"] == failures.PERMANENT
+    assert subscriber.acked == [8]
+
+
+def test_transient_error_retries_the_whole_batch(monkeypatch):
+    def record_data_messages(db, redis, messages, timescale, cassandra, cache=None, data_cache=None):
+        raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    monkeypatch.setattr(repository, "record_data_messages", record_data_messages)
+    subscriber = FakeSubscriber()
+    consumer = BatchConsumer(subscriber, redis=None, timescale=FakeTimescale(), cassandra=None, batch_size=4, batch_ms=1000, retry_delays=[1000])
+    deliver(consumer, [message(index, float(index)) for index in range(4)])
+    assert len(subscriber.published) == 4
+    assert all(exchange != DEAD_LETTER_EXCHANGE for exchange, _, _ in subscriber.published)
+    assert all(properties.headers[RETRY_COUNT_HEADER] == 1 for _, _, properties in subscriber.published)
+    assert subscriber.acked == [4]
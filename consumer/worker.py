@@ -0,0 +1,185 @@
+import json
+import time
+
+import pika
+from pydantic import ValidationError
+
+from consumer import failures
+from shared.subscriber import Subscriber
+from shared.publisher import BATCH_CONTENT_TYPE, JSON_CONTENT_TYPE
+from shared.database import SessionLocal
+from shared.clients import clients
+from shared.sensors import codec, repository, schemas
+from shared.settings import get_settings
+from shared.queues import (DEAD_LETTER_EXCHANGE, RETRY_COUNT_HEADER, declare_failure_topology, declare_topology,
+                           retry_exchange, shard_queue, worker_shards)
+
+
+class Delivery():
+    def __init__(self, method, properties, body):
+        self.delivery_tag = method.delivery_tag
+        self.routing_key = method.routing_key
+        self.properties = properties
+        self.body = body
+
+    @property
+    def retries(self):
+        return (self.properties.headers or {}).get(RETRY_COUNT_HEADER, 0)
+
+
+# Collects the messages and writes them in batches. A batch is flushed when it is full or
+# when its oldest message has waited batch_ms, and its messages are acked only once it is written.
+#
+# A failure only costs the messages that caused it: undecodable messages and readings that fail for a
+# permanent reason (see consumer/failures.py) go to the dead-letter queue, and when a batch fails for
+# a permanent reason it is split in halves until the failing readings are isolated and the others are
+# written (the bulk insert of Timescale reports its bad rows itself, the split is for the permanent
+# errors raised by the rest of the write path). On a transient failure the messages of the batch go to the retry queues with an increasing
+# delay, and to the dead-letter queue once the retry_delays are exhausted.
+class BatchConsumer:
+    def __init__(self, subscriber, redis, timescale, cassandra, batch_size, batch_ms, cache=None, retry_delays=(), data_cache=None):
+        self.subscriber = subscriber
+        self.redis = redis
+        self.timescale = timescale
+        self.cassandra = cassandra
+        self.cache = cache
+        self.data_cache = data_cache
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.retry_delays = list(retry_delays)
+        self.batch = []
+        self.timer = None
+
+    def on_message(self, ch, method, properties, body):
+        self.batch.append(Delivery(method, properties, body))
+        if len(self.batch) == 1:
+            self.timer = self.subscriber.call_later(self.batch_ms / 1000, self.on_timeout)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def on_timeout(self):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.subscriber.remove_timeout(self.timer)
+            self.timer = None
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        last_tag = batch[-1].delivery_tag
+        started = time.perf_counter()
+        try:
+            written = self.write(batch)
+        except Exception as e:
+            # Only when the failed messages could not be published to the retry or dead-letter queues:
+            # nothing is acked, RabbitMQ delivers the whole batch again
+            print(f"Error handling batch of {len(batch)} messages: {e}")
+            self.subscriber.nack(last_tag, multiple=True, requeue=True)
+            return
+        self.subscriber.ack(last_tag, multiple=True)
+        print(f"Flushed {written} readings of {len(batch)} messages in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    # A message holds one reading, a JSON array of readings when the publisher batches them,
+    # or a binary frame of readings
+    def decode(self, content_type, body):
+        if content_type in codec.CONTENT_TYPES:
+            return codec.decode(body)
+        if content_type == BATCH_CONTENT_TYPE:
+            return [schemas.SensorDataMessage.parse_obj(item) for item in json.loads(body)]
+        return [schemas.SensorDataMessage.parse_raw(body)]
+
+    def write(self, batch):
+        # (delivery, message) of every reading of the batch
+        readings = []
+        for delivery in batch:
+            try:
+                decoded = self.decode(delivery.properties.content_type, delivery.body)
+            except (ValidationError, ValueError) as e:
+                self.dead_letter(delivery, delivery.body, delivery.properties.content_type, f"Undecodable message: {failures.describe(e)}", failures.PERMANENT)
+                continue
+            readings.extend((delivery, message) for message in decoded)
+        try:
+            errors = self.write_isolating([(index, message) for index, (_, message) in enumerate(readings)])
+        except Exception as e:
+            print(f"Transient error writing {len(readings)} readings, retrying them later: {failures.describe(e)}")
+            for delivery in {id(delivery): delivery for delivery, _ in readings}.values():
+                self.retry(delivery, failures.describe(e))
+            return 0
+        for index, error in errors:
+            delivery, message = readings[index]
+            self.dead_letter(delivery, message.to_json(), JSON_CONTENT_TYPE, error, failures.PERMANENT)
+        return len(readings) - len(errors)
+
+    # Writes (index, message) readings and returns the (index, error) of the ones that failed for a
+    # permanent reason. Raises the transient errors.
+    def write_isolating(self, messages):
+        if not messages:
+            return []
+        try:
+            return self.write_messages(messages)
+        except Exception as e:
+            if failures.classify(e) == failures.TRANSIENT:
+                raise
+            if len(messages) == 1:
+                return [(messages[0][0], failures.describe(e))]
+            middle = len(messages) // 2
+            return self.write_isolating(messages[:middle]) + self.write_isolating(messages[middle:])
+
+    def write_messages(self, messages):
+        db = SessionLocal()
+        try:
+            return repository.record_data_messages(db=db, redis=self.redis, messages=messages, timescale=self.timescale, cassandra=self.cassandra, cache=self.cache, data_cache=self.data_cache)
+        except Exception:
+            # The next write must not run in the aborted transaction
+            self.timescale.conn.rollback()
+            raise
+        finally:
+            db.close()
+
+    def retry(self, delivery, error):
+        retries = delivery.retries
+        if retries >= len(self.retry_delays):
+            self.dead_letter(delivery, delivery.body, delivery.properties.content_type,
+                             f"Retries exhausted: {error}", failures.TRANSIENT)
+            return
+        headers = dict(delivery.properties.headers or {})
+        headers[RETRY_COUNT_HEADER] = retries + 1
+        headers["x-last-error"] = error
+        properties = pika.BasicProperties(content_type=delivery.properties.content_type, delivery_mode=2, headers=headers)
+        self.subscriber.publish(retry_exchange(self.retry_delays[retries]), delivery.routing_key, delivery.body, properties)
+
+    def dead_letter(self, delivery, body, content_type, error, failure):
+        print(f"Dead-lettering message from {delivery.routing_key} ({failure}): {error}")
+        headers = dict(delivery.properties.headers or {})
+        headers.update({"x-error": error, "x-failure": failure, "x-original-routing-key": delivery.routing_key})
+        properties = pika.BasicProperties(content_type=content_type, delivery_mode=2, headers=headers)
+        self.subscriber.publish(DEAD_LETTER_EXCHANGE, delivery.routing_key, body, properties)
+
+# Entry point of a worker process started by consumer/main.py. Each worker has its own
+# connection and clients, and consumes its shard queues (see shared/queues.py).
+def run_worker(worker, processes):
+    settings = get_settings()
+    shards = worker_shards(worker, processes, settings.queue_shards)
+    subscriber = Subscriber()
+    declare_topology(subscriber.channel, settings.queue_shards)
+    declare_failure_topology(subscriber.channel, settings.consumer_retry_delays)
+
+    # The clients are opened once and reused for every batch, the worker keeps one Timescale connection
+    timescale = clients.timescale()
+    consumer = BatchConsumer(subscriber, clients.redis, timescale, clients.cassandra,
+                             batch_size=settings.consumer_batch_size, batch_ms=settings.consumer_batch_ms,
+                             cache=clients.sensor_cache, retry_delays=settings.consumer_retry_delays,
+                             data_cache=clients.data_cache)
+    print(f"Worker {worker} consuming shards {shards}")
+    try:
+        # Exclusive: a shard queue has a single consumer, which keeps the order of the readings of a sensor
+        subscriber.subscribe(consumer.on_message, auto_ack=False,
+                             prefetch_count=max(settings.consumer_prefetch, settings.consumer_batch_size),
+                             queues=[shard_queue(shard) for shard in shards], exclusive=True)
+    finally:
+        # A pending batch is not acked, RabbitMQ delivers it again to the next consumer
+        subscriber.close()
+        timescale.close()
+        clients.close()
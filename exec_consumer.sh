@@ -1,4 +1,4 @@
 path= pwd
 export PYTHONPATH=$PYTHONPATH:$path
 echo $PYTHONPATH
-python ./consumer/main.py
\ No newline at end of file
+python -m consumer.main
\ No newline at end of file
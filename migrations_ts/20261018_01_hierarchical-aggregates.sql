@@ -0,0 +1,11 @@
+-- Drops the continuous aggregates with only the averages, views/views_ts.sql creates them again
+-- with the statistics of every metric, the finer aggregates feeding the coarser ones. The history
+-- of the aggregates is computed again by their refresh policies.
+-- depends: migrations_ts
+-- transactional: false
+
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_year CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_month CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_week CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_day CASCADE;
+DROP MATERIALIZED VIEW IF EXISTS sensor_data_hour CASCADE;
@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pika
+
+from shared.queues import connection_parameters, shard_for, shard_queue
+
+# Priority of a reading, sent by the client with ?priority=
+CRITICAL = "critical"
+NORMAL = "normal"
+LOW = "low"
+PRIORITIES = (CRITICAL, NORMAL, LOW)
+
+# Load levels of a shard, by the number of messages waiting in its queue
+OK = "ok"
+DEGRADED = "degraded"
+OVERLOADED = "overloaded"
+
+
+class Rejected(Exception):
+    def __init__(self, level, status_code, retry_after, detail):
+        super().__init__(detail)
+        self.level = level
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+# Polls the message count of the shard queues (passive queue_declare) from a background thread and
+# decides which readings the API accepts while the consumers are behind:
+# - degraded (a shard has soft_depth messages or more): low priority readings of the shard are refused with 429
+# - overloaded (hard_depth or more): only critical readings of the shard are accepted, the others get 503
+# Both answers carry Retry-After. When the depths are unknown or stale (RabbitMQ unreachable from the
+# monitor) every reading is accepted, the publisher backpressure still applies.
+class QueueDepthMonitor:
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.parameters = connection_parameters(settings)
+        self.shards = settings.queue_shards
+        self.interval = settings.backpressure_poll_interval
+        self.soft_depth = settings.backpressure_soft_depth
+        self.hard_depth = settings.backpressure_hard_depth
+        self.retry_after = settings.backpressure_retry_after
+
+        self._depths = {}
+        self._consumers = {}
+        self._rates = {}
+        self._polled_at = None
+        self._rejected = {LOW: 0, NORMAL: 0, CRITICAL: 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._connection = None
+        self._thread = threading.Thread(target=self._run, name="queue-depth-monitor", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Could not read the queue depths: {e}")
+                self._disconnect()
+            self._stop.wait(self.interval)
+        self._disconnect()
+
+    def poll(self):
+        if self._connection is None or not self._connection.is_open:
+            self._connection = pika.BlockingConnection(self.parameters)
+        channel = self._connection.channel()
+        depths = {}
+        consumers = {}
+        try:
+            for shard in range(self.shards):
+                method = channel.queue_declare(queue=shard_queue(shard), passive=True).method
+                depths[shard] = method.message_count
+                consumers[shard] = method.consumer_count
+        finally:
+            if channel.is_open:
+                channel.close()
+        now = time.monotonic()
+        with self._lock:
+            if self._polled_at is not None:
+                # Messages per second the queue grows (> 0) or drains (< 0)
+                elapsed = now - self._polled_at
+                self._rates = {shard: (depths[shard] - self._depths.get(shard, 0)) / elapsed for shard in depths}
+            self._depths = depths
+            self._consumers = consumers
+            self._polled_at = now
+
+    def _disconnect(self):
+        if self._connection is not None and self._connection.is_open:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+        self._connection = None
+
+    def _fresh(self):
+        return self._polled_at is not None and time.monotonic() - self._polled_at < 3 * self.interval
+
+    def level(self, shard=None):
+        with self._lock:
+            if not self._fresh():
+                return OK
+            depth = self._depths.get(shard, 0) if shard is not None else max(self._depths.values(), default=0)
+        if depth >= self.hard_depth:
+            return OVERLOADED
+        if depth >= self.soft_depth:
+            return DEGRADED
+        return OK
+
+    # Raises Rejected if a reading of `priority` must be refused. Without sensor_id the deepest shard
+    # decides (batches, whose readings go to many shards).
+    def admit(self, priority=NORMAL, sensor_id=None):
+        level = self.level(shard_for(sensor_id, self.shards) if sensor_id is not None else None)
+        if level == OK or priority == CRITICAL:
+            return
+        if level == DEGRADED and priority != LOW:
+            return
+        with self._lock:
+            self._rejected[priority] += 1
+        if level == DEGRADED:
+            raise Rejected(level, 429, self.retry_after, "Too many readings waiting, low priority readings are refused")
+        raise Rejected(level, 503, self.retry_after, "Ingest overloaded, only critical readings are accepted")
+
+    def status(self):
+        with self._lock:
+            return {
+                "fresh": self._fresh(),
+                "soft_depth": self.soft_depth,
+                "hard_depth": self.hard_depth,
+                "total_depth": sum(self._depths.values()),
+                "shards": [
+                    {"shard": shard, "depth": depth, "consumers": self._consumers.get(shard, 0),
+                     "rate": round(self._rates.get(shard, 0.0), 1)}
+                    for shard, depth in sorted(self._depths.items())
+                ],
+                "rejected": dict(self._rejected),
+            }
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=self.interval + 5)
@@ -1,33 +1,18 @@
 from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
+from cassandra.query import BatchStatement, BatchType
 
-class CassandraClient:
-    def __init__(self, hosts):
-        self.cluster = Cluster(hosts,protocol_version=4)
-        self.session = self.cluster.connect()
-        self.create_keyspace()
-
+KEYSPACE = "sensor"
 
-    def create_keyspace(self):
-        query = """
+# Schema of the keyspace, created once by shared/bootstrap.py
+CREATE_KEYSPACE = """
         CREATE KEYSPACE IF NOT EXISTS sensor WITH replication = {
             'class': 'SimpleStrategy',
             'replication_factor': '1'
         };
         """
-        self.session.execute(query)
-        self.session.set_keyspace("sensor")
-
-    def get_session(self):
-        return self.session
-
-    def close(self):
-        self.cluster.shutdown()
-
-    def execute(self, query):
-        return self.get_session().execute(query)
 
-    def create_temperature_values_table(self):
-        query = """
+CREATE_TEMPERATURE_VALUES_TABLE = """
         CREATE TABLE IF NOT EXISTS sensor.temperature_values (
            sensor_id INT,
            timestamp TIMESTAMP,
@@ -35,21 +20,17 @@ class CassandraClient:
            PRIMARY KEY (sensor_id, timestamp)
         );
         """
-        self.session.execute(query)
 
-    def create_quantity_by_type_table(self):
-        query = """
-         CREATE TABLE IF NOT EXISTS sensor.count_by_type (
-                sensor_id INT,
-                sensor_type TEXT,
-                time TIMESTAMP,
-                PRIMARY KEY (sensor_type, sensor_id)
+# Sensors of every type, incremented and decremented when a sensor is created or deleted. Counter
+# updates are not idempotent, shared/sensors/type_counts.py reconciles them with PostgreSQL.
+CREATE_SENSOR_COUNT_BY_TYPE_TABLE = """
+         CREATE TABLE IF NOT EXISTS sensor.sensor_count_by_type (
+                sensor_type TEXT PRIMARY KEY,
+                quantity COUNTER
         );
         """
-        self.session.execute(query)
 
-    def create_low_battery_sensors_table(self):
-        query = """
+CREATE_LOW_BATTERY_SENSORS_TABLE = """
        CREATE TABLE IF NOT EXISTS sensor.low_battery_sensors (
                 sensor_id INT,
                 battery_level DECIMAL,
@@ -57,31 +38,106 @@ class CassandraClient:
                 PRIMARY KEY (sensor_id, time)
         );
         """
-        self.session.execute(query)
+
+SCHEMA = [CREATE_KEYSPACE, CREATE_TEMPERATURE_VALUES_TABLE, CREATE_SENSOR_COUNT_BY_TYPE_TABLE, CREATE_LOW_BATTERY_SENSORS_TABLE]
+TABLES = ["temperature_values", "sensor_count_by_type", "low_battery_sensors"]
+# Tables of earlier versions of the schema, dropped from the keyspaces created before: count_by_type
+# got a row per reading, sensor_count_by_type replaces it
+DROPPED_TABLES = ["count_by_type"]
+
+# Prepared statements of the write path, bound with ? markers
+INSERT_TEMPERATURE_VALUES = "INSERT INTO sensor.temperature_values (sensor_id, timestamp, temperature) VALUES (?, ?, ?)"
+UPDATE_SENSOR_COUNT_BY_TYPE = "UPDATE sensor.sensor_count_by_type SET quantity = quantity + ? WHERE sensor_type = ?"
+INSERT_LOW_BATTERY_SENSOR = "INSERT INTO sensor.low_battery_sensors (sensor_id, battery_level, time) VALUES (?, ?, ?)"
+
+class CassandraClient:
+    def __init__(self, hosts, concurrency=64, connect_timeout=5):
+        self.cluster = Cluster(hosts,protocol_version=4, connect_timeout=connect_timeout)
+        self.session = self.cluster.connect()
+        self.concurrency = concurrency
+        # Statements are prepared once per session and reused, see prepare()
+        self._prepared = {}
+        # The schema is created by shared/bootstrap.py, not by every client
+        if KEYSPACE in self.cluster.metadata.keyspaces:
+            self.session.set_keyspace(KEYSPACE)
+
+    # Checks the driver's schema metadata, it does not query the cluster
+    def has_schema(self):
+        keyspace = self.cluster.metadata.keyspaces.get(KEYSPACE)
+        return keyspace is not None and all(table in keyspace.tables for table in TABLES)
+
+    def create_keyspace(self):
+        self.session.execute(CREATE_KEYSPACE)
+        self.session.set_keyspace(KEYSPACE)
+
+    def create_schema(self):
+        self.create_keyspace()
+        self.create_temperature_values_table()
+        self.create_quantity_by_type_table()
+        self.create_low_battery_sensors_table()
+        self.drop_old_tables()
+
+    def get_session(self):
+        return self.session
+
+    def close(self):
+        self.cluster.shutdown()
+
+    def execute(self, query):
+        return self.get_session().execute(query)
+
+    def prepare(self, query):
+        statement = self._prepared.get(query)
+        if statement is None:
+            statement = self.session.prepare(query)
+            self._prepared[query] = statement
+        return statement
+
+    # Writes many rows with the same statement, with at most `concurrency` requests in flight.
+    # With batch_by_partition the rows sharing the partition key (the column at partition_key_index)
+    # are sent together as unlogged batches of up to max_batch_size rows, one request per batch.
+    def execute_many(self, query, rows, batch_by_partition=False, partition_key_index=0, max_batch_size=100, concurrency=None):
+        if not rows:
+            return []
+        statement = self.prepare(query)
+        concurrency = concurrency or self.concurrency
+        if not batch_by_partition:
+            return execute_concurrent_with_args(self.session, statement, rows, concurrency=concurrency, raise_on_first_error=True)
+        partitions = {}
+        for row in rows:
+            partitions.setdefault(row[partition_key_index], []).append(row)
+        batches = []
+        for partition_rows in partitions.values():
+            for start in range(0, len(partition_rows), max_batch_size):
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for row in partition_rows[start:start + max_batch_size]:
+                    batch.add(statement, row)
+                batches.append((batch, ()))
+        return execute_concurrent(self.session, batches, concurrency=concurrency, raise_on_first_error=True)
+
+    def create_temperature_values_table(self):
+        self.session.execute(CREATE_TEMPERATURE_VALUES_TABLE)
+
+    def create_quantity_by_type_table(self):
+        self.session.execute(CREATE_SENSOR_COUNT_BY_TYPE_TABLE)
+
+    def create_low_battery_sensors_table(self):
+        self.session.execute(CREATE_LOW_BATTERY_SENSORS_TABLE)
+
+    def drop_old_tables(self):
+        for table in DROPPED_TABLES:
+            self.session.execute(f"DROP TABLE IF EXISTS {KEYSPACE}.{table}")
 
     def insert_temperature_values(self, sensor_id, timestamp, temperature):
-        query = """
-            INSERT INTO temperature_values (sensor_id, timestamp, temperature)
-            VALUES (%s, %s, %s)
-        """
-        prepared_query = self.session.prepare(query)
-        bound_query = prepared_query.bind((sensor_id, timestamp, temperature))
-        self.session.execute(bound_query)
-
-    def insert_quantity_by_type(self, sensor_type, sensor_id):
-        query = """
-            INSERT INTO quantity_by_type (sensor_type, sensor_id)
-            VALUES (%s, %s)
-        """
-        prepared_query = self.session.prepare(query)
-        bound_query = prepared_query.bind((sensor_type, sensor_id))
-        self.session.execute(bound_query)
-
-    def insert_low_battery_sensor(self, sensor_id, battery_level):
-        query = """
-            INSERT INTO low_battery_sensors (battery_level, sensor_id)
-            VALUES (%s, %s)
-        """
-        prepared_query = self.session.prepare(query)
-        bound_query = prepared_query.bind((battery_level, sensor_id))
-        self.session.execute(bound_query)
\ No newline at end of file
+        self.session.execute(self.prepare(INSERT_TEMPERATURE_VALUES), (sensor_id, timestamp, temperature))
+
+    # delta is +1 when a sensor of the type is created and -1 when one is deleted
+    def add_to_sensor_count(self, sensor_type, delta):
+        self.session.execute(self.prepare(UPDATE_SENSOR_COUNT_BY_TYPE), (delta, sensor_type))
+
+    # {sensor_type: quantity} of the counters
+    def get_sensor_counts(self):
+        return {row.sensor_type: row.quantity for row in self.session.execute("SELECT sensor_type, quantity FROM sensor.sensor_count_by_type")}
+
+    def insert_low_battery_sensor(self, sensor_id, battery_level, time):
+        self.session.execute(self.prepare(INSERT_LOW_BATTERY_SENSOR), (sensor_id, battery_level, time))
@@ -0,0 +1,126 @@
+import threading
+
+from shared.redis_client import RedisClient
+from shared.mongodb_client import MongoDBClient
+from shared.elasticsearch_client import ElasticsearchClient
+from shared.cassandra_client import CassandraClient
+from shared.timescale import Timescale, TimescalePool
+from shared.publisher import Publisher
+from shared.backpressure import QueueDepthMonitor
+from shared.sensors.cache import SensorCache
+from shared.sensors.data_cache import DataCache
+from shared.settings import get_settings
+
+
+# Database clients shared by all the requests (or messages) handled by a worker process.
+# Every client is created the first time it is used, open() creates them all up front and
+# close() shuts down the ones that were created.
+class Clients():
+    def __init__(self, settings):
+        self.settings = settings
+        # Reentrant: a client can be built from another one (the sensor cache uses Redis)
+        self._lock = threading.RLock()
+        self._redis = None
+        self._mongodb = None
+        self._elasticsearch = None
+        self._cassandra = None
+        self._timescale_pool = None
+        self._publisher = None
+        self._queue_monitor = None
+        self._sensor_cache = None
+        self._data_cache = None
+
+    def _get(self, name, factory):
+        client = getattr(self, name)
+        if client is None:
+            with self._lock:
+                client = getattr(self, name)
+                if client is None:
+                    client = factory()
+                    setattr(self, name, client)
+        return client
+
+    @property
+    def redis(self) -> RedisClient:
+        return self._get("_redis", lambda: RedisClient(host="redis", latest_ttl=self.settings.redis_latest_ttl,
+                                                       max_connections=self.settings.redis_max_connections,
+                                                       socket_timeout=self.settings.redis_socket_timeout))
+
+    @property
+    def mongodb(self) -> MongoDBClient:
+        return self._get("_mongodb", lambda: MongoDBClient(host="mongodb", max_pool_size=self.settings.mongodb_max_pool_size,
+                                                           timeout_ms=self.settings.mongodb_timeout_ms))
+
+    @property
+    def elasticsearch(self) -> ElasticsearchClient:
+        return self._get("_elasticsearch", lambda: ElasticsearchClient(host="elasticsearch", timeout=self.settings.elasticsearch_timeout))
+
+    @property
+    def cassandra(self) -> CassandraClient:
+        return self._get("_cassandra", lambda: CassandraClient(hosts=["cassandra"], concurrency=self.settings.cassandra_concurrency,
+                                                               connect_timeout=self.settings.cassandra_connect_timeout))
+
+    @property
+    def timescale_pool(self) -> TimescalePool:
+        return self._get("_timescale_pool", lambda: TimescalePool(minconn=self.settings.timescale_pool_min,
+                                                                  maxconn=self.settings.timescale_pool_max,
+                                                                  timeout=self.settings.timescale_pool_timeout,
+                                                                  connect_timeout=self.settings.timescale_connect_timeout))
+
+    @property
+    def publisher(self) -> Publisher:
+        return self._get("_publisher", Publisher)
+
+    @property
+    def queue_monitor(self) -> QueueDepthMonitor:
+        return self._get("_queue_monitor", lambda: QueueDepthMonitor(self.settings))
+
+    @property
+    def sensor_cache(self) -> SensorCache:
+        return self._get("_sensor_cache", lambda: SensorCache(max_size=self.settings.sensor_cache_size,
+                                                              ttl=self.settings.sensor_cache_ttl,
+                                                              negative_ttl=self.settings.sensor_cache_negative_ttl,
+                                                              redis=self.redis if self.settings.sensor_cache_redis else None))
+
+    # None when the cache is disabled (data_cache_backend "none")
+    @property
+    def data_cache(self) -> DataCache:
+        if self.settings.data_cache_backend == "none":
+            return None
+        return self._get("_data_cache", lambda: DataCache(backend=self.settings.data_cache_backend,
+                                                          redis=self.redis if self.settings.data_cache_backend == "redis" else None,
+                                                          max_size=self.settings.data_cache_size,
+                                                          ttl=self.settings.data_cache_ttl,
+                                                          open_ttl=self.settings.data_cache_open_ttl,
+                                                          refresh_delay=self.settings.data_cache_refresh_delay))
+
+    # Borrows a connection of the pool, it goes back to the pool with close()
+    def timescale(self) -> Timescale:
+        return Timescale(pool=self.timescale_pool)
+
+    def open(self):
+        self.redis
+        self.mongodb
+        self.elasticsearch
+        self.cassandra
+        self.timescale_pool
+        if self.settings.ingest_mode == "async":
+            self.publisher
+            if self.settings.backpressure_enabled:
+                self.queue_monitor
+
+    def close(self):
+        with self._lock:
+            for name, close in (("_queue_monitor", "close"), ("_publisher", "close"), ("_redis", "close"), ("_mongodb", "close"),
+                                ("_elasticsearch", "close"), ("_cassandra", "close"), ("_timescale_pool", "closeall")):
+                client = getattr(self, name)
+                if client is None:
+                    continue
+                try:
+                    getattr(client, close)()
+                except Exception as e:
+                    print(f"Error closing {name[1:]}: {e}")
+                setattr(self, name, None)
+
+
+clients = Clients(get_settings())
@@ -1,32 +1,38 @@
 from elasticsearch import Elasticsearch
 import time
 
+# Index of the sensors, created once by shared/bootstrap.py
+SENSORS_INDEX = 'sensors'
+SENSORS_MAPPING = {
+    'properties': {
+        'name': {'type': 'keyword'},
+        'latitude': {'type': 'float'},
+        'longitude': {'type': 'float'},
+        'type': {'type': 'text'},
+        'mac_address': {'type': 'text'},
+        'manufacturer': {'type': 'text'},
+        'model': {'type': 'text'},
+        'serie_number': {'type': 'text'},
+        'firmware_version': {'type': 'text'},
+        'description': {'type': 'text'},
+    }    
+}
+
 class ElasticsearchClient:
-    def __init__(self, host="localhost", port="9200"):
+    def __init__(self, host="localhost", port="9200", timeout=10):
         self.host = host
         self.port = port
-        self.client = Elasticsearch(["http://"+self.host+":"+self.port])
-        self.create_index('sensors')
-        mapping = {
-            'properties': {
-                'name': {'type': 'keyword'},
-                'latitude': {'type': 'float'},
-                'longitude': {'type': 'float'},
-                'type': {'type': 'text'},
-                'mac_address': {'type': 'text'},
-                'manufacturer': {'type': 'text'},
-                'model': {'type': 'text'},
-                'serie_number': {'type': 'text'},
-                'firmware_version': {'type': 'text'},
-                'description': {'type': 'text'},
-            }    
-        }
-        # Action plsssss
-        self.create_mapping('sensors',mapping=mapping)
-        # Active waiting
+        self.client = Elasticsearch(["http://"+self.host+":"+self.port], request_timeout=timeout)
+
+    # Active waiting, used by the bootstrap before creating the index
+    def wait_until_ready(self):
         while not self.ping():
             print("Waiting for Elasticsearch to start...")
-            time.sleep(1)        
+            time.sleep(1)
+
+    def create_sensors_index(self):
+        self.create_index(SENSORS_INDEX)
+        self.create_mapping(SENSORS_INDEX, mapping=SENSORS_MAPPING)
 
     def ping(self):
         return self.client.ping()
@@ -1,10 +1,11 @@
 from pymongo import MongoClient
 
 class MongoDBClient:
-    def __init__(self, host="localhost", port=27017):
+    def __init__(self, host="localhost", port=27017, max_pool_size=100, timeout_ms=30000):
         self.host = host
         self.port = port
-        self.client = MongoClient(host, port)
+        # MongoClient pools its connections and is thread safe, one per process is enough
+        self.client = MongoClient(host, port, maxPoolSize=max_pool_size, serverSelectionTimeoutMS=timeout_ms)
         self.database = self.client['SensorsDB']
         self.collection = self.database['Sensors']
 
@@ -1,33 +1,362 @@
-import pika
+import collections
+import threading
 import time
 
+import pika
+
+from shared.sensors import codec
+from shared.queues import EXCHANGE_NAME, connection_parameters, declare_topology, shard_for, shard_routing_key
+from shared.settings import get_settings
+
 QUEUE_NAME = 'test'
 
+# Content type of a message holding a JSON array of readings instead of a single one
+BATCH_CONTENT_TYPE = 'application/vnd.sensor-batch+json'
+JSON_CONTENT_TYPE = 'application/json'
+
+# Seconds between reconnection attempts, doubled on every failure
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+# Publish latencies kept for the metrics
+LATENCY_SAMPLES = 10000
+
+
+class PublishItem():
+    def __init__(self, exchange, routing_key, body, properties, count=1, slot=0):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        # Channel of the pool the message is published on, always the same one for a routing key
+        self.slot = slot
+        self.body = body
+        self.properties = properties
+        # Readings in the message, more than one when they are batched
+        self.count = count
+        self.enqueued_at = time.monotonic()
+
+
+# Thread safe publisher shared by all the requests of a process.
+#
+# publish() only puts the message in an in-memory queue; a background thread owns the RabbitMQ
+# connection, publishes on a pool of channels with publisher confirms and collects the confirms
+# asynchronously (RabbitMQ acks many messages at once). Each channel has at most confirm_window
+# unconfirmed messages; nacked messages and the unconfirmed ones of a lost connection are published
+# again.
+#
+# RabbitMQ only keeps the order of the messages published on the same channel, so every shard is
+# pinned to one channel (shard % channels) and has its own queue of outgoing messages. A nacked
+# message is published again ahead of the later messages of its routing key: the ones not sent yet
+# wait behind it, and the ones already in flight are sent again after it (the consumers ignore the
+# readings already stored).
+#
+# When batch_size > 1 the readings of the same shard are packed in one message of up to batch_size
+# readings, sent when it is full or after batch_ms. The readings are encoded in JSON or in the binary
+# frames of shared/sensors/codec.py (publisher_codec).
 class Publisher:
 
-    channel = None
-    conn = None
+    def __init__(self, settings=None):
+        self.settings = settings or get_settings()
+        self.parameters = connection_parameters(self.settings)
+        self.channels_count = self.settings.publisher_channels
+        self.confirm_window = self.settings.publisher_confirm_window
+        self.max_pending = self.settings.publisher_max_pending
+        self.publish_timeout = self.settings.publisher_publish_timeout
+        self.batch_size = self.settings.publisher_batch_size
+        self.batch_ms = self.settings.publisher_batch_ms
+        self.codec = self.settings.publisher_codec
 
-    def __init__(self):
-        credentials = pika.PlainCredentials('guest', 'guest')
-        parameters = pika.ConnectionParameters('rabbitmq',
-                                       5672,
-                                       '/',
-                                       credentials)
-        try:
-            self.conn = pika.BlockingConnection(parameters)
-        except Exception as e:
-            time.sleep(10)
-            self.conn = pika.BlockingConnection(parameters)
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+        # Outgoing messages of every channel of the pool
+        self._outgoing = [collections.deque() for _ in range(self.channels_count)]
+        # Readings waiting to be batched, by shard
+        self._batches = {}
+        self._drain_scheduled = False
+        self._closing = False
+        self._connection = None
+        # Open channel of every slot of the pool, None while it is opening
+        self._channels = [None] * self.channels_count
+        self._channels_opened = False
+        # Per channel number: {delivery_tag: PublishItem} not confirmed yet, and the last delivery tag
+        self._unconfirmed = {}
+        self._delivery_tags = {}
 
-        self.channel = self.conn.channel()
-        self.channel.queue_declare(queue=QUEUE_NAME)
+        self._published = 0
+        self._confirmed = 0
+        self._nacked = 0
+        self._republished = 0
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
 
+        self._thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+        self._thread.start()
+
+    def _declare_topology(self):
+        conn = pika.BlockingConnection(self.parameters)
+        try:
+            channel = conn.channel()
+            channel.queue_declare(queue=QUEUE_NAME)
+            declare_topology(channel, self.settings.queue_shards)
+        finally:
+            conn.close()
 
-    
+    # Messages with a sensor_id (the sensor readings) go to the shard queue of their sensor,
+    # the rest to QUEUE_NAME
     def publish(self, message):
-        self.channel.basic_publish(exchange='', routing_key=QUEUE_NAME, body=message.to_json())
-        print(" [x] Sent %r" % message)
-    
-    def close(self):
-        self.conn.close()
+        sensor_id = getattr(message, "sensor_id", None)
+        if sensor_id is None:
+            self._enqueue(PublishItem('', QUEUE_NAME, message.to_json(), pika.BasicProperties(content_type=JSON_CONTENT_TYPE)))
+            return
+        shard = shard_for(sensor_id, self.settings.queue_shards)
+        if self.batch_size <= 1:
+            self._enqueue(self._reading_item(shard, message))
+            return
+        with self._lock:
+            batch = self._batches.setdefault(shard, [])
+            batch.append(message)
+            if len(batch) < self.batch_size:
+                return
+            del self._batches[shard]
+        self._enqueue(self._batch_item(shard, batch))
+
+    def publish_many(self, messages):
+        for message in messages:
+            self.publish(message)
+
+    def _reading_item(self, shard, message):
+        if self.codec == "binary":
+            return self._batch_item(shard, [message])
+        return PublishItem(EXCHANGE_NAME, shard_routing_key(shard), message.to_json(),
+                           pika.BasicProperties(content_type=JSON_CONTENT_TYPE, delivery_mode=2),
+                           slot=shard % self.channels_count)
+
+    def _batch_item(self, shard, batch):
+        if self.codec == "binary":
+            body, content_type = codec.encode(batch), codec.CONTENT_TYPE_V1
+        else:
+            body, content_type = "[" + ",".join(message.to_json() for message in batch) + "]", BATCH_CONTENT_TYPE
+        return PublishItem(EXCHANGE_NAME, shard_routing_key(shard), body,
+                           pika.BasicProperties(content_type=content_type, delivery_mode=2), count=len(batch),
+                           slot=shard % self.channels_count)
+
+    # Called with the lock held
+    def _pending(self):
+        return sum(len(outgoing) for outgoing in self._outgoing)
+
+    def _enqueue(self, item):
+        with self._lock:
+            # Backpressure: the callers wait while too many messages are waiting to be sent
+            deadline = time.monotonic() + self.publish_timeout
+            while self._pending() >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closing:
+                    raise RuntimeError(f"Publisher queue full ({self._pending()} messages waiting)")
+                self._space.wait(remaining)
+            self._outgoing[item.slot].append(item)
+            wake = not self._drain_scheduled
+            self._drain_scheduled = True
+        if wake:
+            self._wake()
+
+    def _wake(self):
+        connection = self._connection
+        if connection is not None and connection.is_open:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._drain)
+            except Exception:
+                # The connection is closing, the messages are sent once it is open again
+                pass
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            unconfirmed = sum(len(tags) for tags in self._unconfirmed.values())
+            metrics = {
+                "connected": any(self._channels),
+                "channels": sum(1 for channel in self._channels if channel is not None),
+                "published": self._published,
+                "confirmed": self._confirmed,
+                "nacked": self._nacked,
+                "republished": self._republished,
+                "pending": self._pending() + sum(len(batch) for batch in self._batches.values()),
+                "unconfirmed": unconfirmed,
+            }
+        if latencies:
+            metrics["publish_latency_ms"] = {
+                "avg": sum(latencies) / len(latencies) * 1000,
+                "p50": latencies[len(latencies) // 2] * 1000,
+                "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+                "max": latencies[-1] * 1000,
+            }
+        return metrics
+
+    # Waits up to `timeout` seconds for the pending messages to be confirmed, then closes the connection
+    def close(self, timeout=10):
+        with self._lock:
+            batches = list(self._batches.items())
+            self._batches.clear()
+        for shard, batch in batches:
+            self._enqueue(self._batch_item(shard, batch))
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._pending() and not any(self._unconfirmed.values()):
+                    break
+            time.sleep(0.05)
+        with self._lock:
+            self._closing = True
+            self._space.notify_all()
+        connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.ioloop.add_callback_threadsafe(connection.close)
+        self._thread.join(timeout=timeout)
+
+    # Everything below runs in the publisher thread
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        while not self._closing:
+            # Declared by the publisher thread before every connection, so the API starts while RabbitMQ
+            # is still starting (the messages wait in the outgoing queues) and a restarted broker gets
+            # its queues back
+            try:
+                self._declare_topology()
+            except Exception as e:
+                print(f"Publisher could not declare the queues ({e}), retrying in {delay} s")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            self._connection = pika.SelectConnection(self.parameters,
+                                                     on_open_callback=self._on_connection_open,
+                                                     on_open_error_callback=self._on_connection_error,
+                                                     on_close_callback=self._on_connection_closed)
+            self._connection.ioloop.start()
+            if self._closing:
+                break
+            if self._channels_opened:
+                delay = RECONNECT_DELAY
+            print(f"Publisher disconnected, reconnecting in {delay} s")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _on_connection_open(self, connection):
+        self._channels_opened = False
+        for slot in range(self.channels_count):
+            self._open_channel(connection, slot)
+        if self.batch_size > 1:
+            connection.ioloop.call_later(self.batch_ms / 1000, self._flush_batches)
+
+    def _on_connection_error(self, connection, error):
+        print(f"Publisher could not connect: {error}")
+        self._channels_opened = False
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        with self._lock:
+            # The unconfirmed messages may be lost, they are published again on the next connection
+            for slot, channel in enumerate(self._channels):
+                if channel is not None:
+                    self._requeue(slot, self._unconfirmed.pop(channel.channel_number, {}))
+            self._unconfirmed.clear()
+            self._delivery_tags.clear()
+            self._channels = [None] * self.channels_count
+            self._drain_scheduled = False
+        connection.ioloop.stop()
+
+    def _open_channel(self, connection, slot):
+        connection.channel(on_open_callback=lambda channel: self._on_channel_open(slot, channel))
+
+    def _on_channel_open(self, slot, channel):
+        channel.add_on_close_callback(lambda channel, reason: self._on_channel_closed(slot, channel, reason))
+        channel.confirm_delivery(ack_nack_callback=lambda frame: self._on_confirm(channel, frame))
+        with self._lock:
+            self._unconfirmed[channel.channel_number] = {}
+            # Delivery tags of a confirm channel count the published messages from 1
+            self._delivery_tags[channel.channel_number] = 0
+            self._channels[slot] = channel
+            self._channels_opened = True
+        self._drain()
+
+    def _on_channel_closed(self, slot, channel, reason):
+        with self._lock:
+            if self._channels[slot] is not channel:
+                return
+            self._channels[slot] = None
+            self._requeue(slot, self._unconfirmed.pop(channel.channel_number, {}))
+        connection = self._connection
+        if not self._closing and connection is not None and connection.is_open:
+            # The messages of the slot wait for a new channel, so they keep their order
+            print(f"Publisher channel {slot} closed ({reason}), opening it again")
+            connection.ioloop.call_later(RECONNECT_DELAY, lambda: connection.is_open and self._open_channel(connection, slot))
+
+    # Puts unconfirmed messages ({delivery_tag: item}) back at the front of the queue of the slot,
+    # in the order they were published. Called with the lock held.
+    def _requeue(self, slot, unconfirmed):
+        items = [item for _, item in sorted(unconfirmed.items())]
+        self._outgoing[slot].extendleft(reversed(items))
+        self._republished += sum(item.count for item in items)
+
+    def _on_confirm(self, channel, frame):
+        method = frame.method
+        now = time.monotonic()
+        with self._lock:
+            unconfirmed = self._unconfirmed.get(channel.channel_number, {})
+            if method.multiple:
+                tags = [tag for tag in unconfirmed if tag <= method.delivery_tag]
+            else:
+                tags = [method.delivery_tag] if method.delivery_tag in unconfirmed else []
+            nacked = isinstance(method, pika.spec.Basic.Nack)
+            if nacked:
+                # The nacked messages and the later ones of the same routing keys already in flight are
+                # sent again in their order, the later ones not sent yet are still behind them
+                routing_keys = set()
+                for tag in tags:
+                    item = unconfirmed[tag]
+                    self._nacked += item.count
+                    routing_keys.add(item.routing_key)
+                first = min(tags, default=None)
+                resend = {tag: item for tag, item in unconfirmed.items()
+                          if first is not None and tag >= first and item.routing_key in routing_keys}
+                for tag in resend:
+                    del unconfirmed[tag]
+                if resend:
+                    self._requeue(next(iter(resend.values())).slot, resend)
+            else:
+                for tag in tags:
+                    item = unconfirmed.pop(tag)
+                    self._confirmed += item.count
+                    self._latencies.append(now - item.enqueued_at)
+        # Confirms free room in the window of the channel
+        self._drain()
+
+    def _flush_batches(self):
+        if self._closing or self._connection is None or not self._connection.is_open:
+            return
+        with self._lock:
+            batches = list(self._batches.items())
+            self._batches.clear()
+            for shard, batch in batches:
+                item = self._batch_item(shard, batch)
+                self._outgoing[item.slot].append(item)
+        self._drain()
+        self._connection.ioloop.call_later(self.batch_ms / 1000, self._flush_batches)
+
+    def _drain(self):
+        with self._lock:
+            self._drain_scheduled = False
+            sent = False
+            for slot, channel in enumerate(self._channels):
+                if channel is None:
+                    # The messages of the slot wait until its channel is open
+                    continue
+                outgoing = self._outgoing[slot]
+                unconfirmed = self._unconfirmed[channel.channel_number]
+                # A full window is resumed by the next confirm of the channel
+                while outgoing and len(unconfirmed) < self.confirm_window:
+                    item = outgoing.popleft()
+                    channel.basic_publish(exchange=item.exchange, routing_key=item.routing_key,
+                                          body=item.body, properties=item.properties)
+                    self._delivery_tags[channel.channel_number] += 1
+                    unconfirmed[self._delivery_tags[channel.channel_number]] = item
+                    self._published += item.count
+                    sent = True
+            if sent:
+                self._space.notify_all()
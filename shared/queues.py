@@ -0,0 +1,72 @@
+import pika
+
+# Sensor readings go through a direct exchange to one of `queue_shards` durable queues. The shard
+# of a reading only depends on its sensor id, and each shard queue has a single (exclusive)
+# consumer, so the readings of a sensor are written in the order they were published.
+# Changing queue_shards moves sensors to other shards: drain the queues before changing it.
+EXCHANGE_NAME = 'sensor_data'
+# Messages that can't be written (invalid readings, unknown sensors, retries exhausted) end in this
+# queue with the error in their headers, for inspection or replay
+DEAD_LETTER_EXCHANGE = f'{EXCHANGE_NAME}.dead'
+DEAD_LETTER_QUEUE = DEAD_LETTER_EXCHANGE
+# Number of times a message was sent to a retry queue
+RETRY_COUNT_HEADER = 'x-retry-count'
+
+
+def connection_parameters(settings):
+    credentials = pika.PlainCredentials(settings.rabbitmq_user, settings.rabbitmq_password)
+    return pika.ConnectionParameters(settings.rabbitmq_host,
+                                     settings.rabbitmq_port,
+                                     '/',
+                                     credentials,
+                                     heartbeat=settings.rabbitmq_heartbeat)
+
+
+def shard_for(sensor_id, shards):
+    return sensor_id % shards
+
+
+def shard_queue(shard):
+    return f"{EXCHANGE_NAME}.shard.{shard}"
+
+
+def shard_routing_key(shard):
+    return f"shard.{shard}"
+
+
+def routing_key_for(sensor_id, shards):
+    return shard_routing_key(shard_for(sensor_id, shards))
+
+
+# The shards consumed by worker `worker` of `processes`
+def worker_shards(worker, processes, shards):
+    return [shard for shard in range(shards) if shard % processes == worker]
+
+
+def declare_topology(channel, shards):
+    channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='direct', durable=True)
+    for shard in range(shards):
+        channel.queue_declare(queue=shard_queue(shard), durable=True)
+        channel.queue_bind(queue=shard_queue(shard), exchange=EXCHANGE_NAME, routing_key=shard_routing_key(shard))
+
+
+# A failed message waits in the retry queue of its delay (one per delay, the TTL of a queue can't
+# change) and then goes back to its shard: the dead-letter exchange of the retry queue is the
+# readings exchange and the message keeps its shard routing key.
+def retry_exchange(delay_ms):
+    return f"{EXCHANGE_NAME}.retry.{delay_ms}ms"
+
+
+def retry_queue(delay_ms):
+    return retry_exchange(delay_ms)
+
+
+def declare_failure_topology(channel, retry_delays):
+    for delay in retry_delays:
+        channel.exchange_declare(exchange=retry_exchange(delay), exchange_type='fanout', durable=True)
+        channel.queue_declare(queue=retry_queue(delay), durable=True,
+                              arguments={"x-message-ttl": delay, "x-dead-letter-exchange": EXCHANGE_NAME})
+        channel.queue_bind(queue=retry_queue(delay), exchange=retry_exchange(delay))
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type='fanout', durable=True)
+    channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True)
+    channel.queue_bind(queue=DEAD_LETTER_QUEUE, exchange=DEAD_LETTER_EXCHANGE)
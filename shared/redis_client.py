@@ -1,11 +1,90 @@
 import redis
 
+# Compare-and-set of the latest reading of many sensors. For every sensor KEYS has the value key
+# and the key holding its last_seen (epoch ms); ARGV[1] is the TTL in ms (0 = no TTL) followed by
+# (value, last_seen) pairs. A reading older than the stored one is not written.
+SET_LATEST_SCRIPT = """
+local ttl = tonumber(ARGV[1])
+local written = 0
+for i = 1, #KEYS, 2 do
+    local value = ARGV[i + 1]
+    local last_seen = tonumber(ARGV[i + 2])
+    local current = tonumber(redis.call('GET', KEYS[i + 1]))
+    if current == nil or current < last_seen then
+        if ttl > 0 then
+            redis.call('SET', KEYS[i], value, 'PX', ttl)
+            redis.call('SET', KEYS[i + 1], last_seen, 'PX', ttl)
+        else
+            redis.call('SET', KEYS[i], value)
+            redis.call('SET', KEYS[i + 1], last_seen)
+        end
+        written = written + 1
+    end
+end
+return written
+"""
+
+# Sensors sent per script call, the calls of a batch share one pipeline
+SET_LATEST_CHUNK = 500
+
+# Settles pending readings of the temperature stats (see shared/sensors/temperature_stats.py). KEYS[1]
+# is the hash of the pending readings, KEYS[2] the set of the sensors with stats, then the stats hash of
+# every reading; ARGV has (field, sensor_id, count) of each reading. A reading is removed from the pending
+# ones and, if count is 1, merged into the stats of its sensor, only by the first call that removes it.
+# The temperatures are kept as sent, Lua numbers would lose precision as strings.
+SETTLE_TEMPERATURE_STATS_SCRIPT = """
+local counted = 0
+for i = 3, #KEYS do
+    local base = (i - 3) * 3
+    local value = redis.call('HGET', KEYS[1], ARGV[base + 1])
+    if value and redis.call('HDEL', KEYS[1], ARGV[base + 1]) == 1 and ARGV[base + 3] == '1' then
+        local temperature = string.match(value, '^[^|]+')
+        local current_min = tonumber(redis.call('HGET', KEYS[i], 'min'))
+        if current_min == nil or tonumber(temperature) < current_min then
+            redis.call('HSET', KEYS[i], 'min', temperature)
+        end
+        local current_max = tonumber(redis.call('HGET', KEYS[i], 'max'))
+        if current_max == nil or tonumber(temperature) > current_max then
+            redis.call('HSET', KEYS[i], 'max', temperature)
+        end
+        redis.call('HINCRBYFLOAT', KEYS[i], 'sum', temperature)
+        redis.call('HINCRBY', KEYS[i], 'count', 1)
+        redis.call('SADD', KEYS[2], ARGV[base + 2])
+        counted = counted + 1
+    end
+end
+return counted
+"""
+TEMPERATURE_STATS_SENSORS_KEY = "temperature_stats:sensors"
+TEMPERATURE_STATS_PENDING_KEY = "temperature_stats:pending"
+
+# Caches a result of the data cache (shared/sensors/data_cache.py) only if the generation of its sensor
+# is still the one read before querying it. KEYS are the generation, the entry and the index of the
+# sensor; ARGV the generation, the value and its TTL, the index field and value and the index TTL.
+SET_DATA_CACHE_ENTRY_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+redis.call('HSET', KEYS[3], ARGV[4], ARGV[5])
+redis.call('EXPIRE', KEYS[3], ARGV[6])
+return 1
+"""
+
 class RedisClient:
-    def __init__(self, host='localhost', port=6379, db=0):
+    def __init__(self, host='localhost', port=6379, db=0, latest_ttl=None, max_connections=None, socket_timeout=None):
         self._host = host
         self._port = port
         self._db = db
-        self._client = redis.Redis(host=self._host, port=self._port, db=self._db)
+        # redis.Redis keeps a thread safe connection pool, so one client can be shared by the whole process
+        self._client = redis.Redis(host=self._host, port=self._port, db=self._db,
+                                   max_connections=max_connections, socket_timeout=socket_timeout)
+        # Optional TTL in seconds of the latest readings written by set_latest_many
+        self._latest_ttl = latest_ttl
+        self._set_latest = self._client.register_script(SET_LATEST_SCRIPT)
+        self._settle_temperature_stats = self._client.register_script(SETTLE_TEMPERATURE_STATS_SCRIPT)
+        self._set_data_cache_entry = self._client.register_script(SET_DATA_CACHE_ENTRY_SCRIPT)
     
     def close(self):
         self._client.close()
@@ -15,10 +94,157 @@ class RedisClient:
     
     def get(self, key):
         return self._client.get(key)
+
+    def get_many(self, keys):
+        return self._client.mget(keys)
+
+    # values is {key: (value, ttl in seconds)}, written in one round trip
+    def set_many_with_ttl(self, values):
+        pipeline = self._client.pipeline(transaction=False)
+        for key, (value, ttl) in values.items():
+            pipeline.set(key, value, ex=ttl)
+        return pipeline.execute()
     
     def set(self, key, value):
         return self._client.set(key, value)
-    
+
+    # Stores the latest reading of every sensor of a batch. readings is a list of (key, last_seen_ms, value):
+    # only the newest reading of each key is kept, and it is written only if it is newer than the stored one.
+    # Returns how many keys were written.
+    def set_latest_many(self, readings):
+        latest = {}
+        for key, last_seen, value in readings:
+            if key not in latest or latest[key][0] < last_seen:
+                latest[key] = (last_seen, value)
+        if not latest:
+            return 0
+        ttl = int(self._latest_ttl * 1000) if self._latest_ttl else 0
+        items = list(latest.items())
+        pipeline = self._client.pipeline(transaction=False)
+        for start in range(0, len(items), SET_LATEST_CHUNK):
+            keys = []
+            args = [ttl]
+            for key, (last_seen, value) in items[start:start + SET_LATEST_CHUNK]:
+                keys += [key, f"{key}:last_seen"]
+                args += [value, last_seen]
+            self._set_latest(keys=keys, args=args, client=pipeline)
+        return sum(pipeline.execute())
+
+    def add_to_set(self, key, members):
+        if not members:
+            return 0
+        return self._client.sadd(key, *members)
+
+    # Removes and returns up to count members of the set
+    def pop_from_set(self, key, count):
+        return self._client.spop(key, count) or []
+
+    # {field: value} of many hashes, in one round trip
+    def get_hashes(self, keys):
+        pipeline = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hgetall(key)
+        return dict(zip(keys, pipeline.execute()))
+
+    def set_hash_field(self, key, field, value, ttl=None):
+        pipeline = self._client.pipeline(transaction=False)
+        pipeline.hset(key, field, value)
+        if ttl:
+            pipeline.expire(key, ttl)
+        return pipeline.execute()
+
+    def increment_many(self, keys, ttl=None):
+        pipeline = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.incr(key)
+            if ttl:
+                pipeline.expire(key, ttl)
+        return pipeline.execute()
+
+    def set_data_cache_entry(self, generation_key, generation, key, value, ttl, index_key, index_value, index_ttl):
+        return bool(self._set_data_cache_entry(keys=[generation_key, key, index_key],
+                                               args=[generation, value, ttl, key, index_value, index_ttl]))
+
+    # Deletes keys and, in the same round trip, fields of hashes given as {key: [fields]}
+    def delete_keys_and_fields(self, keys, fields):
+        pipeline = self._client.pipeline(transaction=False)
+        if keys:
+            pipeline.delete(*keys)
+        for key, hash_fields in fields.items():
+            if hash_fields:
+                pipeline.hdel(key, *hash_fields)
+        return pipeline.execute()
+
+    def _temperature_stats_key(self, sensor_id):
+        return f"temperature_stats:{sensor_id}"
+
+    def _pending_field(self, sensor_id, last_seen_ms):
+        return f"{sensor_id}:{last_seen_ms}"
+
+    # Records readings, a list of (sensor_id, last_seen_ms, temperature), as pending before they are
+    # written. Returns for every reading whether it was pending already (a previous attempt didn't settle it)
+    def add_pending_temperature_stats(self, readings, now_ms):
+        if not readings:
+            return []
+        pipeline = self._client.pipeline(transaction=False)
+        for sensor_id, last_seen_ms, temperature in readings:
+            pipeline.hsetnx(TEMPERATURE_STATS_PENDING_KEY, self._pending_field(sensor_id, last_seen_ms), f"{float(temperature)!r}|{now_ms}")
+        return [not added for added in pipeline.execute()]
+
+    # Settles pending readings, a list of (sensor_id, last_seen_ms, count), returns how many were counted
+    def settle_temperature_stats(self, readings):
+        if not readings:
+            return 0
+        pipeline = self._client.pipeline(transaction=False)
+        for start in range(0, len(readings), SET_LATEST_CHUNK):
+            keys = [TEMPERATURE_STATS_PENDING_KEY, TEMPERATURE_STATS_SENSORS_KEY]
+            args = []
+            for sensor_id, last_seen_ms, count in readings[start:start + SET_LATEST_CHUNK]:
+                keys.append(self._temperature_stats_key(sensor_id))
+                args += [self._pending_field(sensor_id, last_seen_ms), sensor_id, 1 if count else 0]
+            self._settle_temperature_stats(keys=keys, args=args, client=pipeline)
+        return sum(pipeline.execute())
+
+    # [(sensor_id, last_seen_ms, added_ms)] of the pending readings
+    def get_pending_temperature_stats(self):
+        pending = []
+        for field, value in self._client.hscan_iter(TEMPERATURE_STATS_PENDING_KEY, count=1000):
+            sensor_id, last_seen_ms = field.decode().split(":")
+            pending.append((int(sensor_id), int(last_seen_ms), int(value.decode().split("|")[1])))
+        return pending
+
+    # {sensor_id: (min, max, sum, count)} of every sensor with stats, one round trip after the set
+    def get_temperature_stats(self):
+        sensor_ids = sorted(int(sensor_id) for sensor_id in self._client.smembers(TEMPERATURE_STATS_SENSORS_KEY))
+        hashes = self.get_hashes([self._temperature_stats_key(sensor_id) for sensor_id in sensor_ids])
+        stats = {}
+        for sensor_id in sensor_ids:
+            values = hashes[self._temperature_stats_key(sensor_id)]
+            if values:
+                stats[sensor_id] = (float(values[b"min"]), float(values[b"max"]), float(values[b"sum"]), int(values[b"count"]))
+        return stats
+
+    # Replaces the stats of every sensor, in one transaction. The pending readings are dropped too,
+    # the new stats already count the stored ones
+    def replace_temperature_stats(self, stats):
+        pipeline = self._client.pipeline(transaction=True)
+        for sensor_id in self._client.smembers(TEMPERATURE_STATS_SENSORS_KEY):
+            pipeline.delete(self._temperature_stats_key(int(sensor_id)))
+        pipeline.delete(TEMPERATURE_STATS_SENSORS_KEY, TEMPERATURE_STATS_PENDING_KEY)
+        for sensor_id, (low, high, total, count) in stats.items():
+            pipeline.hset(self._temperature_stats_key(sensor_id), mapping={"min": repr(float(low)), "max": repr(float(high)), "sum": repr(float(total)), "count": int(count)})
+            pipeline.sadd(TEMPERATURE_STATS_SENSORS_KEY, sensor_id)
+        return pipeline.execute()
+
+    def delete_temperature_stats(self, sensor_id):
+        pipeline = self._client.pipeline(transaction=False)
+        pipeline.delete(self._temperature_stats_key(sensor_id))
+        pipeline.srem(TEMPERATURE_STATS_SENSORS_KEY, sensor_id)
+        return pipeline.execute()
+
+    def delete_latest(self, key):
+        return self._client.delete(key, f"{key}:last_seen")
+
     def delete(self, key):
         return self._client.delete(key)
     
@@ -0,0 +1,176 @@
+# Materializes the continuous aggregates of Timescale incrementally. The ingest path records in Redis
+# the sensors and hours it wrote readings for (mark_dirty), and the refresher only refreshes the buckets
+# of every aggregate that contain those hours, instead of the whole history. Until a bucket is refreshed
+# the reads get it from the raw data (real-time aggregation, materialized_only = false in views_ts.sql).
+# Once refreshed, the cached results of those sensors with the buckets are invalidated (data_cache).
+#
+#   python -m shared.refresher [--interval 30] [--once]
+#
+# The refresh policies of views_ts.sql stay as a backstop, e.g. for hours lost if the refresher
+# crashes after popping them.
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+from shared.redis_client import RedisClient
+from shared.settings import get_settings
+from shared.timescale import connection_params
+
+DIRTY_HOURS_KEY = "sensor_data:dirty_hours"
+# Continuous aggregates from the finest bucket to the coarsest one, the order they are refreshed in
+BUCKETS = ("hour", "day", "week", "month", "year")
+# Dirty hours popped from Redis at a time
+POP_COUNT = 10000
+# time_bucket('1 week') starts the weeks on Monday, 2000-01-03 is its origin
+WEEK_ORIGIN = datetime(2000, 1, 3, tzinfo=timezone.utc)
+
+
+def aggregate_view(bucket):
+    return f"sensor_data_{bucket}"
+
+
+def hour_of(timestamp: datetime) -> int:
+    # Start of the hour of the timestamp in seconds since the epoch, naive timestamps are UTC
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp()) // 3600 * 3600
+
+
+# Called by the ingest path with the (sensor_id, timestamp) of the readings it wrote
+def mark_dirty(redis: RedisClient, readings):
+    return redis.add_to_set(DIRTY_HOURS_KEY, {f"{sensor_id}:{hour_of(timestamp)}" for sensor_id, timestamp in readings})
+
+
+# (sensor_id, hour) of a member of the dirty set, the members written before the sensors were added have no sensor
+def parse_dirty(member):
+    sensor_id, _, hour = (member.decode() if isinstance(member, bytes) else member).rpartition(":")
+    return (int(sensor_id) if sensor_id else None), int(hour)
+
+
+def bucket_start(timestamp: datetime, bucket: str) -> datetime:
+    if bucket == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == "day":
+        return day
+    if bucket == "week":
+        return day - timedelta(days=(day - WEEK_ORIGIN).days % 7)
+    if bucket == "month":
+        return day.replace(day=1)
+    return day.replace(month=1, day=1)
+
+
+def bucket_end(start: datetime, bucket: str) -> datetime:
+    if bucket == "hour":
+        return start + timedelta(hours=1)
+    if bucket == "day":
+        return start + timedelta(days=1)
+    if bucket == "week":
+        return start + timedelta(weeks=1)
+    if bucket == "month":
+        return start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start.replace(year=start.year + 1)
+
+
+# The [start, end) windows covering the buckets of the dirty hours, contiguous buckets merged together
+def refresh_windows(hours, bucket):
+    windows = []
+    starts = sorted({bucket_start(datetime.fromtimestamp(hour, tz=timezone.utc), bucket) for hour in hours})
+    for start in starts:
+        end = bucket_end(start, bucket)
+        if windows and windows[-1][1] == start:
+            windows[-1] = (windows[-1][0], end)
+        else:
+            windows.append((start, end))
+    return windows
+
+
+class AggregateRefresher():
+    # With raw_retention_days (shared/storage.py) the hourly aggregate is not refreshed for the hours
+    # older than the retention: their readings may be dropped and the refresh would erase their buckets.
+    # The coarser aggregates are computed from the hourly one and are refreshed anyway.
+    def __init__(self, redis: RedisClient, interval=30, raw_retention_days=0, data_cache=None):
+        self.redis = redis
+        self.interval = interval
+        self.raw_retention_days = raw_retention_days
+        self.data_cache = data_cache
+
+    def _raw_hours(self, hours):
+        if not self.raw_retention_days:
+            return hours
+        cutoff = hour_of(datetime.now(timezone.utc) - timedelta(days=self.raw_retention_days)) + 3600
+        return {hour for hour in hours if hour >= cutoff}
+
+    def pop_dirty_hours(self):
+        members = set()
+        while True:
+            popped = self.redis.pop_from_set(DIRTY_HOURS_KEY, POP_COUNT)
+            members.update(popped)
+            if len(popped) < POP_COUNT:
+                return members
+
+    # Refreshes the buckets of the dirty hours, returns how many hours were dirty
+    def refresh_once(self):
+        members = self.pop_dirty_hours()
+        if not members:
+            return 0
+        dirty = [parse_dirty(member) for member in members]
+        hours = {hour for _, hour in dirty}
+        try:
+            # refresh_continuous_aggregate can't run inside a transaction
+            conn = psycopg2.connect(**connection_params())
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cursor:
+                    for bucket in BUCKETS:
+                        bucket_hours = self._raw_hours(hours) if bucket == "hour" else hours
+                        for start, end in refresh_windows(bucket_hours, bucket):
+                            cursor.execute("CALL refresh_continuous_aggregate(%s, %s, %s)", (aggregate_view(bucket), start, end))
+            finally:
+                conn.close()
+        except Exception:
+            # The hours are refreshed again on the next run
+            self.redis.add_to_set(DIRTY_HOURS_KEY, members)
+            raise
+        if self.data_cache is not None:
+            readings = {}
+            for sensor_id, hour in dirty:
+                if sensor_id is not None:
+                    readings.setdefault(sensor_id, []).append(datetime.fromtimestamp(hour, tz=timezone.utc))
+            self.data_cache.invalidate(readings)
+        return len(hours)
+
+    def run_forever(self):
+        while True:
+            started = time.monotonic()
+            try:
+                refreshed = self.refresh_once()
+                if refreshed:
+                    print(f"Refreshed the aggregates of {refreshed} hours in {time.monotonic() - started:.1f} s")
+            except Exception as e:
+                print(f"Error refreshing the aggregates: {e}")
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interval", type=float, default=30, help="seconds between refreshes")
+    parser.add_argument("--once", action="store_true", help="refresh the dirty hours once and exit")
+    args = parser.parse_args()
+    # Imported here, the data cache imports the buckets of this module
+    from shared.sensors.data_cache import DataCache
+    settings = get_settings()
+    redis = RedisClient(host="redis")
+    # The memory backend is out of reach, it keeps the buckets not refreshed yet for a short time instead
+    data_cache = DataCache(backend="redis", redis=redis, ttl=settings.data_cache_ttl, open_ttl=settings.data_cache_open_ttl) \
+        if settings.data_cache_backend == "redis" else None
+    refresher = AggregateRefresher(redis, interval=args.interval, raw_retention_days=settings.timescale_raw_retention_days, data_cache=data_cache)
+    try:
+        if args.once:
+            print(f"Refreshed the aggregates of {refresher.refresh_once()} hours")
+        else:
+            refresher.run_forever()
+    finally:
+        redis.close()
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+from shared.sensors import schemas
+
+# Marks a cached "this sensor does not exist"
+MISSING = "null"
+
+
+# LRU cache of the sensors metadata (schemas.SensorMetadata by sensor id) with a TTL per entry.
+# Unknown ids are cached too (as None) with their own, shorter, TTL. With a RedisClient the entries
+# are also kept in Redis, shared by every process, as a second level behind the in-process one.
+# Other processes only see an invalidation through Redis or when their own entry expires.
+class SensorCache():
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=30, redis=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.redis = redis
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, sensor_id):
+        return f"sensor_metadata:{sensor_id}"
+
+    # Returns ({sensor_id: metadata} of the cached sensors, [ids that are not cached]).
+    # Ids cached as unknown are in neither of them.
+    def get_many(self, sensor_ids):
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for sensor_id in set(sensor_ids):
+                entry = self._entries.get(sensor_id)
+                if entry is None or entry[0] < now:
+                    missing.append(sensor_id)
+                    continue
+                self._entries.move_to_end(sensor_id)
+                if entry[1] is not None:
+                    found[sensor_id] = entry[1]
+        if missing and self.redis is not None:
+            values = self.redis.get_many([self._key(sensor_id) for sensor_id in missing])
+            still_missing = []
+            for sensor_id, value in zip(missing, values):
+                if value is None:
+                    still_missing.append(sensor_id)
+                    continue
+                metadata = None if value.decode() == MISSING else schemas.SensorMetadata.parse_raw(value)
+                self._store(sensor_id, metadata)
+                if metadata is not None:
+                    found[sensor_id] = metadata
+            missing = still_missing
+        return found, missing
+
+    # values is {sensor_id: metadata or None for the unknown ids}
+    def set_many(self, values):
+        for sensor_id, metadata in values.items():
+            self._store(sensor_id, metadata)
+        if values and self.redis is not None:
+            self.redis.set_many_with_ttl({
+                self._key(sensor_id): (MISSING if metadata is None else metadata.json(), self.negative_ttl if metadata is None else self.ttl)
+                for sensor_id, metadata in values.items()
+            })
+
+    def invalidate(self, sensor_id):
+        with self._lock:
+            self._entries.pop(sensor_id, None)
+        if self.redis is not None:
+            self.redis.delete(self._key(sensor_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, sensor_id, metadata):
+        ttl = self.negative_ttl if metadata is None else self.ttl
+        with self._lock:
+            self._entries[sensor_id] = (time.monotonic() + ttl, metadata)
+            self._entries.move_to_end(sensor_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
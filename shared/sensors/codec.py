@@ -0,0 +1,106 @@
+import struct
+from datetime import datetime, timezone
+
+from shared.sensors import schemas
+
+# Binary frame of sensor readings published to the queue. The version is both in the content type
+# (so the consumer picks the decoder) and in the frame header, a new layout gets a new version and
+# the consumer keeps decoding the old one while both are in the queues.
+#
+# Version 1 is columnar, for n readings:
+#   header    magic "SR", version (u8), flags (u8, unused), n (u32)
+#   sensor_id n x i64
+#   last_seen n x i64, microseconds since the epoch (naive timestamps are UTC)
+#   present   n x u8, bit 0 velocity, bit 1 temperature, bit 2 humidity
+#   battery   n x f64
+#   velocity, temperature, humidity  n x f64 each, 0 when not present
+# Everything is little endian.
+CONTENT_TYPE_V1 = "application/vnd.sensor-readings.v1"
+CONTENT_TYPES = (CONTENT_TYPE_V1,)
+
+MAGIC = b"SR"
+VERSION = 1
+HEADER = struct.Struct("<2sBBI")
+OPTIONAL_FIELDS = ("velocity", "temperature", "humidity")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_micros(last_seen):
+    timestamp = datetime.fromisoformat(last_seen)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def from_micros(micros):
+    seconds, micros = divmod(micros, 1_000_000)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).replace(microsecond=micros).isoformat()
+
+
+# Encodes SensorDataMessages in one frame
+def encode(messages):
+    n = len(messages)
+    ids = []
+    timestamps = []
+    present = bytearray(n)
+    battery = []
+    columns = {field: [] for field in OPTIONAL_FIELDS}
+    for i, message in enumerate(messages):
+        data = message.data
+        ids.append(message.sensor_id)
+        timestamps.append(to_micros(data.last_seen))
+        battery.append(data.battery_level)
+        for bit, field in enumerate(OPTIONAL_FIELDS):
+            value = getattr(data, field)
+            if value is None:
+                columns[field].append(0.0)
+            else:
+                present[i] |= 1 << bit
+                columns[field].append(value)
+    floats = struct.Struct(f"<{n}d")
+    return b"".join([
+        HEADER.pack(MAGIC, VERSION, 0, n),
+        struct.pack(f"<{n}q", *ids),
+        struct.pack(f"<{n}q", *timestamps),
+        bytes(present),
+        floats.pack(*battery),
+        *(floats.pack(*columns[field]) for field in OPTIONAL_FIELDS),
+    ])
+
+
+# Decodes a frame in a list of SensorDataMessages, raises ValueError if it is not a valid frame
+def decode(frame):
+    if len(frame) < HEADER.size:
+        raise ValueError("Frame too short")
+    magic, version, _, n = HEADER.unpack_from(frame)
+    if magic != MAGIC:
+        raise ValueError("Not a sensor readings frame")
+    if version != VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+    expected = HEADER.size + n * (8 + 8 + 1 + 8 * (1 + len(OPTIONAL_FIELDS)))
+    if len(frame) != expected:
+        raise ValueError(f"Frame of {len(frame)} bytes, expected {expected} for {n} readings")
+
+    offset = HEADER.size
+    ids = struct.unpack_from(f"<{n}q", frame, offset)
+    offset += 8 * n
+    timestamps = struct.unpack_from(f"<{n}q", frame, offset)
+    offset += 8 * n
+    present = frame[offset:offset + n]
+    offset += n
+    battery = struct.unpack_from(f"<{n}d", frame, offset)
+    offset += 8 * n
+    columns = []
+    for _ in OPTIONAL_FIELDS:
+        columns.append(struct.unpack_from(f"<{n}d", frame, offset))
+        offset += 8 * n
+
+    messages = []
+    for i in range(n):
+        values = {field: columns[bit][i] if present[i] & (1 << bit) else None for bit, field in enumerate(OPTIONAL_FIELDS)}
+        # The readings were validated before being encoded, construct() skips validating them again
+        data = schemas.SensorData.construct(battery_level=battery[i], last_seen=from_micros(timestamps[i]), **values)
+        messages.append(schemas.SensorDataMessage.construct(sensor_id=ids[i], data=data))
+    return messages
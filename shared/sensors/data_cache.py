@@ -0,0 +1,229 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from shared.refresher import bucket_start
+
+
+def epoch(timestamp: datetime) -> int:
+    # Naive timestamps are taken as UTC
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+def encode_rows(rows):
+    return json.dumps(rows, default=lambda value: value.isoformat())
+
+
+# Cache of the results of repository.get_data, by sensor, bucket and range. A result whose range
+# reaches the current (open) bucket is cached for open_ttl seconds, the others for ttl seconds.
+# Every entry is indexed by sensor with its bucket and range, so a new reading only invalidates
+# the cached results of its sensor whose range contains the bucket of the reading.
+#
+# A closed bucket read before the refresher materialized a late reading is stale once it is
+# materialized, so the refresher invalidates the buckets it refreshed too. Every invalidation bumps
+# the generation of the sensor, and set() doesn't cache a result read before it (generation()).
+#
+# backend "memory" keeps an LRU of max_size results in the process: it only sees the readings
+# written by the same process, use it with the sync ingest and a single API worker. The refresher
+# can't reach it, so the results with the bucket of a reading invalidated less than refresh_delay
+# seconds ago are cached for open_ttl. Backend "redis" is shared by every process (the consumer and
+# the refresher invalidate what the API cached).
+class DataCache():
+    def __init__(self, backend="redis", redis=None, max_size=10000, ttl=3600, open_ttl=10, refresh_delay=60):
+        if backend not in ("memory", "redis"):
+            raise ValueError(f"Unknown data cache backend {backend}")
+        if backend == "redis" and redis is None:
+            raise ValueError("The redis data cache backend needs a RedisClient")
+        self.backend = backend
+        self.redis = redis
+        self.max_size = max_size
+        self.ttl = ttl
+        self.open_ttl = open_ttl
+        self.refresh_delay = refresh_delay
+        self._entries = OrderedDict()
+        # {sensor_id: {key: (bucket, from, to)}} of the memory backend
+        self._index = {}
+        # {sensor_id: generation} and {sensor_id: {hour: deadline}} of the readings not refreshed yet, of the memory backend
+        self._generations = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def _key(self, sensor_id, bucket, from_epoch, to_epoch):
+        # The version changes with the columns of the rows, so the rows cached before are not read
+        return f"data_cache_v2:{sensor_id}:{bucket}:{from_epoch}:{to_epoch}"
+
+    def _index_key(self, sensor_id):
+        return f"data_cache_index:{sensor_id}"
+
+    def _generation_key(self, sensor_id):
+        return f"data_cache_generation:{sensor_id}"
+
+    # Read before querying the database, and passed to set()
+    def generation(self, sensor_id):
+        if self.backend == "redis":
+            value = self.redis.get(self._generation_key(sensor_id))
+            return int(value) if value is not None else 0
+        with self._lock:
+            return self._generations.get(sensor_id, 0)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def get(self, sensor_id, bucket, _from: datetime, to: datetime):
+        key = self._key(sensor_id, bucket, epoch(_from), epoch(to))
+        if self.backend == "redis":
+            value = self.redis.get(key)
+            rows = json.loads(value) if value is not None else None
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] < time.monotonic():
+                    self._drop(key)
+                    entry = None
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                rows = entry[1] if entry is not None else None
+        self._count(rows is not None)
+        return rows
+
+    # The rows are not cached if the sensor was invalidated after generation was read, returns if they were
+    def set(self, sensor_id, bucket, _from: datetime, to: datetime, rows, generation=0):
+        from_epoch, to_epoch = epoch(_from), epoch(to)
+        key = self._key(sensor_id, bucket, from_epoch, to_epoch)
+        now = datetime.now(timezone.utc)
+        ttl = self.open_ttl if epoch(to) >= epoch(bucket_start(now, bucket)) else self.ttl
+        value = encode_rows(rows)
+        if self.backend == "redis":
+            return self.redis.set_data_cache_entry(self._generation_key(sensor_id), generation, key, value, ttl,
+                                                   self._index_key(sensor_id), f"{bucket}:{from_epoch}:{to_epoch}", self.ttl)
+        with self._lock:
+            if self._generations.get(sensor_id, 0) != generation:
+                return False
+            if self._is_pending(sensor_id, bucket, from_epoch, to_epoch):
+                ttl = self.open_ttl
+            # The rows are stored as they come back from the cache in Redis, the datetimes as strings
+            self._entries[key] = (time.monotonic() + ttl, json.loads(value))
+            self._entries.move_to_end(key)
+            self._index.setdefault(sensor_id, {})[key] = (bucket, from_epoch, to_epoch)
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+        return True
+
+    # readings is {sensor_id: [timestamps of its new (or just refreshed) readings]}
+    def invalidate(self, readings):
+        if not readings:
+            return 0
+        # Before reading the index: a result read before is either indexed already or not cached by set()
+        self._bump(readings)
+        if self.backend == "redis":
+            indexes = self.redis.get_hashes([self._index_key(sensor_id) for sensor_id in readings])
+            entries = {
+                sensor_id: {field.decode(): self._parse_index(value.decode()) for field, value in indexes[self._index_key(sensor_id)].items()}
+                for sensor_id in readings
+            }
+        else:
+            with self._lock:
+                entries = {sensor_id: dict(self._index.get(sensor_id, {})) for sensor_id in readings}
+        stale = {}
+        for sensor_id, timestamps in readings.items():
+            for key, (bucket, from_epoch, to_epoch) in entries[sensor_id].items():
+                # get_data filters the buckets with BETWEEN from AND to
+                if any(from_epoch <= epoch(bucket_start(self._utc(timestamp), bucket)) <= to_epoch for timestamp in timestamps):
+                    stale.setdefault(sensor_id, []).append(key)
+        if not stale:
+            return 0
+        if self.backend == "redis":
+            self.redis.delete_keys_and_fields([key for keys in stale.values() for key in keys],
+                                              {self._index_key(sensor_id): keys for sensor_id, keys in stale.items()})
+        else:
+            with self._lock:
+                for keys in stale.values():
+                    for key in keys:
+                        self._drop(key)
+        invalidated = sum(len(keys) for keys in stale.values())
+        with self._lock:
+            self._invalidations += invalidated
+        return invalidated
+
+    def invalidate_sensor(self, sensor_id):
+        self._bump({sensor_id: []})
+        if self.backend == "redis":
+            index = self.redis.get_hashes([self._index_key(sensor_id)])[self._index_key(sensor_id)]
+            self.redis.delete_keys_and_fields([field.decode() for field in index] + [self._index_key(sensor_id)], {})
+            return
+        with self._lock:
+            for key in list(self._index.get(sensor_id, {})):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self._pending.clear()
+
+    def stats(self):
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                "backend": self.backend,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / requests if requests else None,
+                "invalidations": self._invalidations,
+                "entries": len(self._entries) if self.backend == "memory" else None,
+            }
+
+    def _bump(self, readings):
+        if self.backend == "redis":
+            # The generations outlive the entries read with them
+            self.redis.increment_many([self._generation_key(sensor_id) for sensor_id in readings], ttl=self.ttl)
+            return
+        deadline = time.monotonic() + self.refresh_delay
+        with self._lock:
+            for sensor_id, timestamps in readings.items():
+                self._generations[sensor_id] = self._generations.get(sensor_id, 0) + 1
+                pending = self._pending.setdefault(sensor_id, {})
+                for timestamp in timestamps:
+                    pending[epoch(bucket_start(self._utc(timestamp), "hour"))] = deadline
+
+    def _is_pending(self, sensor_id, bucket, from_epoch, to_epoch):
+        # Called with the lock held
+        pending = self._pending.get(sensor_id)
+        if not pending:
+            return False
+        now = time.monotonic()
+        for hour in [hour for hour, deadline in pending.items() if deadline < now]:
+            del pending[hour]
+        if not pending:
+            del self._pending[sensor_id]
+            return False
+        return any(from_epoch <= epoch(bucket_start(datetime.fromtimestamp(hour, tz=timezone.utc), bucket)) <= to_epoch for hour in pending)
+
+    def _drop(self, key):
+        # Called with the lock held
+        self._entries.pop(key, None)
+        sensor_id = int(key.split(":")[1])
+        index = self._index.get(sensor_id)
+        if index is not None:
+            index.pop(key, None)
+            if not index:
+                del self._index[sensor_id]
+
+    def _parse_index(self, value):
+        bucket, from_epoch, to_epoch = value.split(":")
+        return bucket, int(from_epoch), int(to_epoch)
+
+    def _utc(self, timestamp):
+        # The buckets are aligned in UTC like time_bucket does
+        return timestamp.astimezone(timezone.utc) if timestamp.tzinfo is not None else timestamp.replace(tzinfo=timezone.utc)
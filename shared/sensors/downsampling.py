@@ -0,0 +1,146 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+METHODS = ("lttb", "minmax")
+METRICS = ("temperature", "humidity", "velocity", "battery_level")
+# Approximate length of the buckets of the continuous aggregates, from the finest one
+BUCKET_SECONDS = {"hour": 3600, "day": 86400, "week": 7 * 86400, "month": 30 * 86400, "year": 365 * 86400}
+# Buckets fetched per point returned, the downsampling needs more points than it keeps to preserve the shape
+OVERSAMPLING = 4
+# Widest buckets lttb chooses with a table of areas, and areas computed at once for the table
+LTTB_TABLE_WIDTH = 16
+LTTB_TABLE_SIZE = 1 << 20
+
+
+# The finest aggregate with at most max_points * OVERSAMPLING buckets in the range
+def finest_bucket(from_datetime: datetime, to_datetime: datetime, max_points: int) -> str:
+    seconds = (to_datetime - from_datetime).total_seconds()
+    for bucket, bucket_seconds in BUCKET_SECONDS.items():
+        if seconds / bucket_seconds <= max_points * OVERSAMPLING:
+            return bucket
+    return "year"
+
+
+# Largest-Triangle-Three-Buckets: keeps the first and last points and, from each of n - 2 buckets,
+# the point forming the largest triangle with the point kept from the previous bucket and the average
+# of the next bucket. Returns the indexes of the n points kept, in order.
+#
+# The point kept from a bucket depends on the one kept from the previous bucket, so the choice is
+# sequential. With narrow buckets (get_data fetches about OVERSAMPLING points per point returned) the
+# areas are computed at once for every point of the previous bucket, and only the lookups in the
+# resulting table are sequential. Wider buckets are fewer and are chosen one at a time.
+# See benchmarks/downsampling.py.
+def lttb(x, y, n):
+    size = len(x)
+    if n >= size:
+        return np.arange(size)
+    if n < 3:
+        return np.array([0, size - 1][:max(n, 1)])
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    starts, counts = edges[:-1], np.diff(edges)
+    # Average of the bucket after each bucket, the last point for the last bucket
+    next_x = np.r_[(np.add.reduceat(x[:-1], starts) / counts)[1:], x[-1]]
+    next_y = np.r_[(np.add.reduceat(y[:-1], starts) / counts)[1:], y[-1]]
+    width = int(counts.max())
+    if width > LTTB_TABLE_WIDTH:
+        chosen = _lttb_sequential(x, y, edges, next_x, next_y)
+    else:
+        chosen = _lttb_table(x, y, starts, counts, width, next_x, next_y)
+    return np.r_[0, chosen, size - 1]
+
+
+# Areas (times two) of the triangles with vertexes a, p and c
+def _areas(ax, ay, px, py, cx, cy):
+    return np.abs((ax - cx) * (py - ay) - (ax - px) * (cy - ay))
+
+
+def _lttb_sequential(x, y, edges, next_x, next_y):
+    chosen = np.empty(len(edges) - 1, dtype=int)
+    a = 0
+    for i, (start, end) in enumerate(zip(edges[:-1].tolist(), edges[1:].tolist())):
+        a = start + int(np.argmax(_areas(x[a], y[a], x[start:end], y[start:end], next_x[i], next_y[i])))
+        chosen[i] = a
+    return chosen
+
+
+def _lttb_table(x, y, starts, counts, width, next_x, next_y):
+    # The points of every bucket in a row, padded up to width with points that are never chosen
+    columns = np.arange(width)
+    padding = columns >= counts[:, None]
+    points = np.minimum(starts[:, None] + columns, len(x) - 1)
+    bx, by = x[points], y[points]
+    first = _areas(x[0], y[0], bx[0], by[0], next_x[0], next_y[0])
+    first[padding[0]] = -1
+    # best[i, j] is the column kept from bucket i + 1 when the one kept from bucket i is j
+    best = np.empty((len(starts) - 1, width), dtype=int)
+    step = max(1, LTTB_TABLE_SIZE // (width * width))
+    for start in range(0, len(best), step):
+        stop = min(start + step, len(best))
+        previous, current = slice(start, stop), slice(start + 1, stop + 1)
+        areas = _areas(bx[previous, :, None], by[previous, :, None], bx[current, None, :], by[current, None, :],
+                       next_x[current, None, None], next_y[current, None, None])
+        areas[np.broadcast_to(padding[current, None, :], areas.shape)] = -1
+        best[previous] = np.argmax(areas, axis=2)
+    column = int(np.argmax(first))
+    chosen = [column]
+    for row in best.tolist():
+        column = row[column]
+        chosen.append(column)
+    return starts + np.array(chosen)
+
+
+# Min/max per pixel: splits the time range in (n - 2) / 2 equal intervals and keeps the lowest and
+# the highest point of each one, plus the first and last points. Returns the indexes kept, in order.
+def minmax(x, y, n):
+    size = len(x)
+    if n >= size:
+        return np.arange(size)
+    bins_count = max(1, (n - 2) // 2)
+    span = x[-1] - x[0]
+    if span <= 0:
+        bins = np.zeros(size, dtype=int)
+    else:
+        bins = np.minimum(((x - x[0]) / span * bins_count).astype(int), bins_count - 1)
+    # Sorted by bin and value: the first point of a bin is its minimum and the last one its maximum
+    order = np.lexsort((y, bins))
+    sorted_bins = bins[order]
+    starts = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    ends = np.r_[starts[1:], size]
+    return np.unique(np.concatenate([[0, size - 1], order[starts], order[ends - 1]]))
+
+
+def _epoch(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+# Raises ValueError if the parameters of downsample are not valid, checked before querying anything
+def validate(max_points, method="lttb", metric=None):
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {', '.join(METHODS)}")
+    if metric is not None and metric not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    if max_points is not None and max_points < 2:
+        raise ValueError("max_points must be at least 2")
+
+
+# Downsamples rows of get_data (dicts with time_bucket and the metrics) to about max_points rows,
+# choosing the points by the values of `metric` (by default the first metric the rows have). Rows
+# without a value of the metric are left out.
+def downsample(rows, max_points, method="lttb", metric=None):
+    validate(max_points, method, metric)
+    if max_points is None or len(rows) <= max_points:
+        return rows
+    if metric is None:
+        metric = next((name for name in METRICS if any(row[name] is not None for row in rows)), None)
+        if metric is None:
+            return rows
+    valid = [row for row in rows if row[metric] is not None]
+    x = np.fromiter((_epoch(row["time_bucket"]) for row in valid), dtype=float, count=len(valid))
+    y = np.fromiter((row[metric] for row in valid), dtype=float, count=len(valid))
+    indexes = lttb(x, y, max_points) if method == "lttb" else minmax(x, y, max_points)
+    return [valid[index] for index in indexes]
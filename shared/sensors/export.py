@@ -0,0 +1,150 @@
+# Exports sensor_data or a continuous aggregate as Apache Arrow IPC (stream format) or Parquet, for
+# analysis tools. The rows are read with a server-side cursor and written one row group (Parquet) or
+# record batch (Arrow) at a time, so neither the rows nor the file are held in memory.
+#
+#   python -m shared.sensors.export --ids 1 2 3 --from 2020-01-01T00:00:00+00:00 --to 2020-02-01T00:00:00+00:00 \
+#       --bucket raw --format parquet --output readings.parquet
+#
+# pyarrow is in the requirements of the image; without it the exports raise ExportUnavailable (the API
+# answers 501) and everything else works.
+import argparse
+
+from shared.sensors.repository import DataCommand, stream_data
+from shared.timescale import Timescale
+
+FORMATS = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXTENSIONS = {"arrow": "arrows", "parquet": "parquet"}
+
+
+class ExportUnavailable(Exception):
+    pass
+
+
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportUnavailable("Arrow/Parquet exports need pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+# Same types as the sensor_data hypertable; the aggregates have time_bucket instead of last_seen, and
+# the statistics of each metric (<metric>_min, _max, _stddev as float64, <metric>_count as int64)
+def schema(pa, columns):
+    types = {
+        "id": pa.int32(),
+        "last_seen": pa.timestamp("us", tz="UTC"),
+        "time_bucket": pa.timestamp("us", tz="UTC"),
+        "temperature": pa.float64(),
+        "humidity": pa.float64(),
+        "velocity": pa.float64(),
+        "battery_level": pa.float64(),
+    }
+    for column in columns:
+        if column not in types:
+            types[column] = pa.int64() if column.endswith("_count") else pa.float64()
+    return pa.schema([pa.field(column, types[column], nullable=column not in ("id", "last_seen", "time_bucket")) for column in columns])
+
+
+# File-like object the writers write to, the written bytes are taken out after every row group
+class ChunkSink():
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Encodes the rows (tuples in the order of columns) and yields the bytes of the file as they are written
+def export_chunks(rows, columns, format="parquet", row_group_size=100000):
+    pa = load_pyarrow()
+    arrow_schema = schema(pa, columns)
+    sink = ChunkSink()
+    output = pa.PythonFile(sink, mode="w")
+    if format == "parquet":
+        writer = pa.parquet.ParquetWriter(output, arrow_schema)
+    else:
+        writer = pa.ipc.new_stream(output, arrow_schema)
+    try:
+        for batch in _batches(rows, row_group_size):
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*batch), arrow_schema)]
+            table = pa.Table.from_arrays(arrays, schema=arrow_schema)
+            if format == "parquet":
+                writer.write_table(table, row_group_size=row_group_size)
+            else:
+                writer.write_table(table, max_chunksize=row_group_size)
+            data = sink.take()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def export(timescale, sensor_ids, command: DataCommand, format="parquet", row_group_size=100000, itersize=2000):
+    load_pyarrow()
+    if format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    columns, rows = stream_data(timescale=timescale, sensor_ids=sensor_ids, command=command, itersize=itersize)
+    return export_chunks(rows, columns, format=format, row_group_size=row_group_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ids", type=int, nargs="+", required=True)
+    parser.add_argument("--from", dest="from_time", required=True)
+    parser.add_argument("--to", dest="to_time", required=True)
+    parser.add_argument("--bucket", default="raw", help="raw (sensor_data) or hour, day, week, month, year")
+    parser.add_argument("--format", choices=list(FORMATS), default="parquet")
+    parser.add_argument("--row-group-size", type=int, default=100000)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+    timescale = Timescale()
+    try:
+        written = 0
+        with open(args.output, "wb") as file:
+            for chunk in export(timescale, args.ids, DataCommand(args.from_time, args.to_time, args.bucket),
+                                format=args.format, row_group_size=args.row_group_size):
+                file.write(chunk)
+                written += len(chunk)
+        print(f"Wrote {written} bytes to {args.output}")
+    finally:
+        timescale.close()
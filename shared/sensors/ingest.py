@@ -0,0 +1,125 @@
+import json
+import zlib
+
+from pydantic import ValidationError
+
+from shared.sensors import schemas
+
+# Bigger NDJSON lines are rejected instead of being buffered
+MAX_LINE_BYTES = 64 * 1024
+# Only the first errors are returned, the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+# Decompressed bytes produced per step, bounds the memory used by a gzip stream
+DECOMPRESS_STEP = 1024 * 1024
+# A JSON array is parsed whole, bigger bodies (after decompressing them) must be sent as NDJSON
+MAX_JSON_BODY_BYTES = 16 * 1024 * 1024
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class BatchResult():
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, index, error):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"index": index, "error": error})
+
+    def to_dict(self):
+        return {"accepted": self.accepted, "rejected": self.rejected, "errors": self.errors}
+
+
+def parse_message(item):
+    # Returns (message, None) or (None, error) for a raw JSON line or an already decoded item
+    try:
+        if isinstance(item, (bytes, str)):
+            return schemas.SensorDataMessage.parse_raw(item), None
+        return schemas.SensorDataMessage.parse_obj(item), None
+    except ValidationError as e:
+        return None, str(e)
+
+
+async def iter_ndjson(chunks, gzipped=False):
+    # Splits a (possibly gzip compressed) byte stream in lines without holding more than one line in memory
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16) if gzipped else None
+    buffer = b""
+    skipping = False
+
+    def split(data):
+        nonlocal buffer, skipping
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if skipping:
+                # End of an oversized line, it was already reported
+                skipping = False
+                continue
+            yield line
+        if len(buffer) > MAX_LINE_BYTES:
+            buffer = b""
+            if not skipping:
+                skipping = True
+                yield None
+
+    async for chunk in chunks:
+        if decompressor is None:
+            for line in split(chunk):
+                yield line
+            continue
+        data = decompressor.decompress(chunk, DECOMPRESS_STEP)
+        while True:
+            for line in split(data):
+                yield line
+            if not decompressor.unconsumed_tail:
+                break
+            data = decompressor.decompress(decompressor.unconsumed_tail, DECOMPRESS_STEP)
+    if decompressor is not None:
+        for line in split(decompressor.flush()):
+            yield line
+    if buffer and not skipping:
+        yield buffer
+
+
+async def read_batch(stream, content_type, content_encoding):
+    # Yields (index, message, error) for every item of a JSON array or NDJSON request body
+    gzipped = content_encoding == "gzip" or content_type == "application/gzip"
+    if content_type in ("application/x-ndjson", "application/ndjson", "application/gzip"):
+        index = 0
+        try:
+            async for line in iter_ndjson(stream, gzipped=gzipped):
+                if line is None:
+                    yield index, None, f"Line longer than {MAX_LINE_BYTES} bytes"
+                elif line.strip():
+                    yield (index, *parse_message(line))
+                else:
+                    continue
+                index += 1
+        except zlib.error as e:
+            yield index, None, f"Invalid gzip stream: {e}"
+        return
+
+    body = bytearray()
+    async for chunk in stream:
+        body += chunk
+        if len(body) > MAX_JSON_BODY_BYTES:
+            raise BodyTooLarge(f"A JSON array body can't be bigger than {MAX_JSON_BODY_BYTES} bytes, send NDJSON instead")
+    if gzipped:
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        try:
+            body = decompressor.decompress(body, MAX_JSON_BODY_BYTES + 1)
+        except zlib.error as e:
+            raise ValueError(f"Invalid gzip body: {e}")
+        if len(body) > MAX_JSON_BODY_BYTES:
+            raise BodyTooLarge(f"A JSON array body can't be bigger than {MAX_JSON_BODY_BYTES} bytes decompressed, send NDJSON instead")
+        if not decompressor.eof:
+            raise ValueError("Invalid gzip body: the stream is truncated")
+    items = json.loads(body)
+    if not isinstance(items, list):
+        raise ValueError("The body must be a JSON array of {sensor_id, data} items")
+    for index, item in enumerate(items):
+        yield (index, *parse_message(item))
@@ -1,16 +1,18 @@
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timezone
 import json
 from shared.mongodb_client import MongoDBClient
 from shared import redis_client
 from shared.sensors import models, schemas
 from shared import timescale
+from shared.timescale import DUPLICATE, INSERTED
+from shared.refresher import mark_dirty
+from shared.sensors import downsampling, temperature_stats
 from shared.elasticsearch_client import ElasticsearchClient
-from shared.cassandra_client import CassandraClient 
-from datetime import datetime
-from typing import List, Optional
+from shared.cassandra_client import CassandraClient, INSERT_TEMPERATURE_VALUES, INSERT_LOW_BATTERY_SENSOR
+from decimal import Decimal
 
 
 class DataCommand():
@@ -24,18 +26,78 @@ class DataCommand():
         self.bucket = bucket
 
 
+# Continuous aggregate of each bucket (views_ts.sql): (view, bucket column)
+AGGREGATE_VIEWS = {
+    "hour": ("sensor_data_hour", "hour"),
+    "day": ("sensor_data_day", "day"),
+    "week": ("sensor_data_week", "week"),
+    "month": ("sensor_data_month", "month"),
+    "year": ("sensor_data_year", "year"),
+}
+# Metrics of the aggregates, and the statistics returned for each of them besides the average
+AGGREGATE_METRICS = ("temperature", "humidity", "velocity", "battery_level")
+AGGREGATE_STATISTICS = ("min", "max", "count", "stddev")
+# Columns of the rows of the aggregates, in the order of aggregated_data_sql
+AGGREGATED_DATA_COLUMNS = ("id", "time_bucket") + AGGREGATE_METRICS + tuple(
+    f"{metric}_{statistic}" for metric in AGGREGATE_METRICS for statistic in AGGREGATE_STATISTICS)
+
+# Sensors of a GET /sensors/data query
+MAX_SENSORS_PER_QUERY = 1000
+
+
+def epoch_ms(timestamp: datetime) -> int:
+    # Naive timestamps are taken as UTC
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+
 def get_sensor(db: Session, sensor_id: int) -> Optional[models.Sensor]:
     db_sensor = db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first()
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
     return db_sensor
+def get_sensors_by_ids(db: Session, sensor_ids: List[int]) -> dict:
+    # One query for all the ids, returns {sensor_id: sensor} with the sensors that exist
+    if not sensor_ids:
+        return {}
+    db_sensors = db.query(models.Sensor).filter(models.Sensor.id.in_(set(sensor_ids))).all()
+    return {db_sensor.id: db_sensor for db_sensor in db_sensors}
+
+# Metadata of the sensors by id, from the cache when given (see shared/sensors/cache.py).
+# The ids that are not cached are loaded with one query, and the unknown ones are cached as such.
+def get_sensors_metadata(db: Session, sensor_ids: List[int], cache=None) -> dict:
+    if cache is None:
+        return {sensor_id: schemas.SensorMetadata.from_orm(db_sensor) for sensor_id, db_sensor in get_sensors_by_ids(db, sensor_ids).items()}
+    found, missing = cache.get_many(sensor_ids)
+    if missing:
+        loaded = {sensor_id: schemas.SensorMetadata.from_orm(db_sensor) for sensor_id, db_sensor in get_sensors_by_ids(db, missing).items()}
+        cache.set_many({sensor_id: loaded.get(sensor_id) for sensor_id in missing})
+        found.update(loaded)
+    return found
+
+def get_sensor_metadata(db: Session, sensor_id: int, cache=None) -> Optional[schemas.SensorMetadata]:
+    return get_sensors_metadata(db, [sensor_id], cache).get(sensor_id)
+
+# Joins the metadata of the sensors to results read from another database, loading it for all of them
+# at once (get_sensors_metadata) instead of once per result. results is a list of (sensor_id, fields):
+# returns the sensor details with the fields added, in the same order, leaving out the unknown sensors.
+def hydrate_sensors(db: Session, results: list, cache=None) -> list:
+    metadata = get_sensors_metadata(db, [sensor_id for sensor_id, _ in results], cache)
+    hydrated = []
+    for sensor_id, fields in results:
+        sensor = metadata.get(sensor_id)
+        if sensor is not None:
+            hydrated.append({**sensor.dict(), **fields})
+    return hydrated
+
 def get_sensor_by_name(db: Session, name: str) -> Optional[models.Sensor]:
     return db.query(models.Sensor).filter(models.Sensor.name == name).first()
 
 def get_sensors(db: Session, skip: int = 0, limit: int = 100) -> List[models.Sensor]:
     return db.query(models.Sensor).offset(skip).limit(limit).all()
 
-def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb: MongoDBClient, es: ElasticsearchClient) -> models.Sensor:
+def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb: MongoDBClient, es: ElasticsearchClient, cassandra: CassandraClient, cache=None) -> models.Sensor:
     db_sensor = models.Sensor(name=sensor.name, latitude=sensor.latitude, longitude=sensor.longitude, 
                               type=sensor.type, mac_address=sensor.mac_address, manufacturer=sensor.manufacturer,
                                model=sensor.model, serie_number=sensor.serie_number, firmware_version=sensor.firmware_version,
@@ -43,6 +105,10 @@ def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb: MongoDBCli
     db.add(db_sensor)
     db.commit()
     db.refresh(db_sensor)
+    if cache is not None:
+        # The id may be cached as unknown
+        cache.invalidate(db_sensor.id)
+    cassandra.add_to_sensor_count(db_sensor.type, 1)
 
     db_sensor_data = sensor.dict()
     mongodb.insert(db_sensor_data)  # Insert the sensor data in the mongodb_collection('sensors')
@@ -63,107 +129,252 @@ def create_sensor(db: Session, sensor: schemas.SensorCreate, mongodb: MongoDBCli
     es.index_document('sensors',es_doc)
     return db_sensor
 
-def record_data(redis: redis_client, db_sensor: models.Sensor, data: schemas.SensorData, timescale: timescale, cassandra: CassandraClient):
+def record_data(redis: redis_client, db_sensor: models.Sensor, data: schemas.SensorData, timescale: timescale, cassandra: CassandraClient, data_cache=None):
     # Store the sensor data in Redis
     json_data = json.dumps(dict(data))  # Serialize the dictionary to JSON (convert SensorData to JSON)
-    timescale.insert_sensor_data(db_sensor.id,json_data)
-    redis.set(db_sensor.id, json_data)
-    cassandra.execute(f"""        
-        INSERT INTO count_by_type (sensor_id, sensor_type, time)
-        VALUES ({db_sensor.id}, '{db_sensor.type}', '{data.last_seen}')
-    """)
+    timestamp = datetime.fromisoformat(data.last_seen)
+    # Pending in the temperature stats before the write (see shared/sensors/temperature_stats.py)
     if data.temperature is not None:
-        cassandra.execute(f"""
-            INSERT INTO temperature_values (sensor_id, timestamp, temperature)
-            VALUES ({db_sensor.id},'{data.last_seen}', {data.temperature})
-        """)
+        already_pending, = temperature_stats.add_pending(redis, [(db_sensor.id, epoch_ms(timestamp), data.temperature)])
+    # A reading Timescale can't store raises before any other write, a duplicate is written again like
+    # in record_data_batch (the other writes are idempotent)
+    result = timescale.insert_sensor_data(db_sensor.id,dict(data))
+    redis.set_latest_many([(db_sensor.id, epoch_ms(timestamp), json_data)])
+    # The refresher materializes the aggregates of this hour (see shared/refresher.py)
+    mark_dirty(redis, [(db_sensor.id, timestamp)])
+    if data_cache is not None:
+        data_cache.invalidate({db_sensor.id: [timestamp]})
+    if data.temperature is not None:
+        cassandra.insert_temperature_values(db_sensor.id, timestamp, data.temperature)
+        # Counted like in record_data_batch: a reading already stored (e.g. sent twice) is only counted if it
+        # was still pending, a previous attempt stored it and failed before counting it
+        counted = result == INSERTED or (result == DUPLICATE and already_pending)
+        redis.settle_temperature_stats([(db_sensor.id, epoch_ms(timestamp), counted)])
 
     if (data.battery_level < 0.2):
-        cassandra.execute(f"""        
-            INSERT INTO low_battery_sensors (sensor_id, battery_level, time)
-            VALUES ({db_sensor.id}, {data.battery_level}, '{data.last_seen}')
-        """)
+        cassandra.insert_low_battery_sensor(db_sensor.id, Decimal(str(data.battery_level)), timestamp)
     # Return the recorded data 
     return data
 
-def get_data(redis: redis_client, db_sensor: models.Sensor, timescale: timescale, _from: str, to: str, bucket: str):
+# Writes a batch of readings, a list of (db_sensor, data), doing one operation per database instead of one per reading
+# Returns the (index, reason) of the readings Timescale rejected, the duplicates of stored readings are not errors
+def record_data_batch(redis: redis_client, readings: list, timescale: timescale, cassandra: CassandraClient, data_cache=None):
+    if not readings:
+        return []
+    # Pending in the temperature stats before the write (see shared/sensors/temperature_stats.py)
+    temperatures = [(index, db_sensor.id, epoch_ms(datetime.fromisoformat(data.last_seen)), data.temperature)
+                    for index, (db_sensor, data) in enumerate(readings) if data.temperature is not None]
+    already_pending = temperature_stats.add_pending(redis, [(sensor_id, last_seen_ms, temperature) for _, sensor_id, last_seen_ms, temperature in temperatures])
+    report = timescale.insert_sensor_data_bulk([
+        (db_sensor.id, data.last_seen, data.temperature, data.humidity, data.velocity, data.battery_level)
+        for db_sensor, data in readings
+    ])
+    rejected = [(row["index"], row["reason"]) for row in report.rejected if row["reason"] != DUPLICATE]
+    # The running stats count the readings stored now, not the duplicates of a redelivery, except the ones
+    # still pending: a previous attempt stored them and failed before counting them
+    reasons = {row["index"]: row["reason"] for row in report.rejected}
+    redis.settle_temperature_stats([
+        (sensor_id, last_seen_ms, index not in reasons or (reasons[index] == DUPLICATE and pending))
+        for (index, sensor_id, last_seen_ms, _), pending in zip(temperatures, already_pending)
+    ])
+    # The readings Timescale rejected are not written anywhere else, the duplicates are written again
+    not_stored = {index for index, _ in rejected}
+    readings = [reading for index, reading in enumerate(readings) if index not in not_stored]
+    # Redeliveries or out of order readings never overwrite a newer value
+    redis.set_latest_many([
+        (db_sensor.id, epoch_ms(datetime.fromisoformat(data.last_seen)), json.dumps(dict(data)))
+        for db_sensor, data in readings
+    ])
+    mark_dirty(redis, [(db_sensor.id, datetime.fromisoformat(data.last_seen)) for db_sensor, data in readings])
+    if data_cache is not None:
+        # Only the cached results with the buckets of the new readings
+        timestamps = {}
+        for db_sensor, data in readings:
+            timestamps.setdefault(db_sensor.id, []).append(datetime.fromisoformat(data.last_seen))
+        data_cache.invalidate(timestamps)
+    temperature_values = []
+    low_battery_sensors = []
+    for db_sensor, data in readings:
+        timestamp = datetime.fromisoformat(data.last_seen)
+        if data.temperature is not None:
+            temperature_values.append((db_sensor.id, timestamp, data.temperature))
+        if (data.battery_level < 0.2):
+            low_battery_sensors.append((db_sensor.id, Decimal(str(data.battery_level)), timestamp))
+    # The rows of a sensor share the partition, so they go together in unlogged batches
+    cassandra.execute_many(INSERT_TEMPERATURE_VALUES, temperature_values, batch_by_partition=True)
+    cassandra.execute_many(INSERT_LOW_BATTERY_SENSOR, low_battery_sensors, batch_by_partition=True)
+    return rejected
+
+# Writes a list of (index, SensorDataMessage) and returns the (index, error) of the readings of unknown sensors
+# and of the ones Timescale rejected
+def record_data_messages(db: Session, redis: redis_client, messages: list, timescale: timescale, cassandra: CassandraClient, cache=None, data_cache=None):
+    db_sensors = get_sensors_metadata(db, [message.sensor_id for _, message in messages], cache)
+    readings = []
+    indexes = []
+    errors = []
+    for index, message in messages:
+        db_sensor = db_sensors.get(message.sensor_id)
+        if db_sensor is None:
+            errors.append((index, "Sensor not found"))
+            continue
+        readings.append((db_sensor, message.data))
+        indexes.append(index)
+    rejected = record_data_batch(redis=redis, readings=readings, timescale=timescale, cassandra=cassandra, data_cache=data_cache)
+    errors.extend((indexes[position], f"Not stored: {reason}") for position, reason in rejected)
+    return sorted(errors)
+
+# Range of a DataCommand as datetimes, and the continuous aggregate of its bucket
+def data_query(command: DataCommand):
    # Convertir las fechas de string a objetos datetime
-    from_datetime = datetime.fromisoformat(_from)
-    to_datetime = datetime.fromisoformat(to)
+    from_datetime = datetime.fromisoformat(command.from_time)
+    to_datetime = datetime.fromisoformat(command.to_time)
 
     # Validar que la fecha de inicio sea anterior a la fecha de fin
     if from_datetime >= to_datetime:
         raise ValueError("La fecha de inicio debe ser anterior a la fecha de fin")
 
     # Definir el nombre de la materialized view basado en el intervalo de tiempo
-    if bucket == "hour":
-        materialized_view = "sensor_data_hour"
-    elif bucket == "day":
-        materialized_view = "sensor_data_day"
-    elif bucket == "week":
-        materialized_view = "sensor_data_week"
-    elif bucket == "month":
-        materialized_view = "sensor_data_month"
-    elif bucket == "year":
-        materialized_view = "sensor_data_year"
-    else:
+    if command.bucket not in AGGREGATE_VIEWS:
         raise ValueError("Valor no válido para el parámetro 'bucket'")
-
-
-    now = datetime.now().isoformat(timespec='milliseconds')
-    timescale.enable_autocommit(True)
-    query_refresh = f"CALL refresh_continuous_aggregate('{materialized_view}', '2020-01-01T00:00:00.000Z', '{now}Z');"
-    timescale.execute(query_refresh)
-    # Consultar los datos en la materialized view en TimescaleDB
-    query = f"""
-        SELECT *
+    return from_datetime, to_datetime, AGGREGATE_VIEWS[command.bucket]
+
+# The aggregates are refreshed incrementally in the background (shared/refresher.py), the buckets
+# not materialized yet come from the finer aggregate or sensor_data (real-time aggregation). id_filter is the condition on the id.
+# The statistics of a bucket are "<metric>_<statistic>", its average is "<metric>". The standard
+# deviation (sample) comes from the sum and the sum of squares the views keep.
+def aggregated_data_sql(view, id_filter):
+    materialized_view, bucket_column = view
+    columns = [f"avg_{metric}" for metric in AGGREGATE_METRICS]
+    for metric in AGGREGATE_METRICS:
+        columns += [f"min_{metric}", f"max_{metric}", f"count_{metric}",
+                    f"CASE WHEN count_{metric} > 1 THEN sqrt(greatest((sumsq_{metric} - sum_{metric} * sum_{metric} / count_{metric}) / (count_{metric} - 1), 0)) END"]
+    return f"""
+        SELECT id, {bucket_column}, {', '.join(columns)}
         FROM {materialized_view}
-        WHERE id = %s AND {bucket} BETWEEN %s AND %s; """
+        WHERE {id_filter} AND {bucket_column} BETWEEN %s AND %s
+        ORDER BY id, {bucket_column}; """
+
+def aggregated_data_row(row):
+    return dict(zip(AGGREGATED_DATA_COLUMNS, row))
+
+# With max_points the series is downsampled to about max_points buckets (see shared/sensors/downsampling.py),
+# and without a bucket the finest aggregate that has enough points for it is used
+def get_data(redis: redis_client, db_sensor: models.Sensor, timescale: timescale, _from: str, to: str, bucket: str, data_cache=None,
+             max_points: int = None, method: str = "lttb", metric: str = None):
+    downsampling.validate(max_points, method, metric)
+    if max_points is not None and not bucket:
+        bucket = downsampling.finest_bucket(datetime.fromisoformat(_from), datetime.fromisoformat(to), max_points)
+    data = get_aggregated_data(db_sensor, timescale, DataCommand(_from, to, bucket), data_cache)
+    if max_points is not None:
+        return downsampling.downsample(data, max_points, method=method, metric=metric)
+    return data
+
+def get_aggregated_data(db_sensor: models.Sensor, timescale: timescale, command: DataCommand, data_cache=None):
+    from_datetime, to_datetime, view = data_query(command)
+    if data_cache is not None:
+        cached = data_cache.get(db_sensor.id, command.bucket, from_datetime, to_datetime)
+        if cached is not None:
+            return cached
+        generation = data_cache.generation(db_sensor.id)
     try:
         # Ejecutar la consulta en la base de datos
-        rows = timescale.fetch_all(query, (db_sensor.id,from_datetime,to_datetime))
-        timescale.enable_autocommit(False)
+        rows = timescale.fetch_all(aggregated_data_sql(view, "id = %s"), (db_sensor.id,from_datetime,to_datetime))
         # Convertir los resultados a una lista de diccionarios
-        data = []
-        for row in rows:
-            data.append({
-                "id": row[0],
-                "time_bucket": row[1],
-                "temperature": row[2],
-                "humidity": row[3],
-                "velocity": row[4],
-                "battery_level": row[5]
-            })
-        if not data:
-            return []
-        return data    
+        data = [aggregated_data_row(row) for row in rows]
+        if data_cache is not None:
+            data_cache.set(db_sensor.id, command.bucket, from_datetime, to_datetime, data, generation=generation)
+        return data
+    except Exception as e:
+        timescale.conn.rollback()
+        raise HTTPException(status_code=500, detail=f"Failed to fetch continous_aggregated data: {str(e)}")
+
+# Columns of the rows of stream_data
+RAW_DATA_COLUMNS = ("id", "last_seen", "temperature", "humidity", "velocity", "battery_level")
+
+# Data of sensors read with a server-side cursor, for ranges too long to be loaded in memory.
+# With bucket "raw" the rows come from sensor_data, not aggregated. The command is validated before
+# returning, and the rows are only read while the returned iterator is consumed.
+# Returns (columns, rows), the rows ordered by sensor and time.
+def stream_data(timescale: timescale, sensor_ids: List[int], command: DataCommand, itersize: int = 2000):
+    if command.bucket == "raw":
+        from_datetime = datetime.fromisoformat(command.from_time)
+        to_datetime = datetime.fromisoformat(command.to_time)
+        if from_datetime >= to_datetime:
+            raise ValueError("La fecha de inicio debe ser anterior a la fecha de fin")
+        query = f"""
+            SELECT {', '.join(RAW_DATA_COLUMNS)}
+            FROM sensor_data
+            WHERE id = ANY(%s) AND last_seen BETWEEN %s AND %s
+            ORDER BY id, last_seen"""
+        return RAW_DATA_COLUMNS, timescale.stream(query, (list(sensor_ids), from_datetime, to_datetime), itersize=itersize)
+    from_datetime, to_datetime, view = data_query(command)
+    return AGGREGATED_DATA_COLUMNS, timescale.stream(aggregated_data_sql(view, "id = ANY(%s)"), (list(sensor_ids), from_datetime, to_datetime), itersize=itersize)
+
+# Aggregated data of many sensors, given by ids or by type, with one query for all of them.
+# Returns [{"id", "name", "type", "data"}] in id order, the unknown ids are left out.
+def get_data_many(db: Session, timescale: timescale, command: DataCommand, sensor_ids: List[int] = None, sensor_type: str = None, cache=None):
+    from_datetime, to_datetime, view = data_query(command)
+    # Before loading anything, the sensors of a type are limited by the query
+    if sensor_ids and len(set(sensor_ids)) > MAX_SENSORS_PER_QUERY:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SENSORS_PER_QUERY} sensors per query")
+    if sensor_type is not None:
+        query = db.query(models.Sensor).filter(models.Sensor.type == sensor_type)
+        if sensor_ids:
+            query = query.filter(models.Sensor.id.in_(set(sensor_ids)))
+        db_sensors = {db_sensor.id: schemas.SensorMetadata.from_orm(db_sensor) for db_sensor in query.limit(MAX_SENSORS_PER_QUERY + 1).all()}
+    else:
+        db_sensors = get_sensors_metadata(db, sensor_ids or [], cache)
+    if len(db_sensors) > MAX_SENSORS_PER_QUERY:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SENSORS_PER_QUERY} sensors per query")
+    if not db_sensors:
+        return []
+    try:
+        rows = timescale.fetch_all(aggregated_data_sql(view, "id = ANY(%s)"), (list(db_sensors), from_datetime, to_datetime))
     except Exception as e:
-        timescale.enable_autocommit(False)
+        timescale.conn.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to fetch continous_aggregated data: {str(e)}")
+    series = {sensor_id: [] for sensor_id in db_sensors}
+    for row in rows:
+        series[row[0]].append(aggregated_data_row(row))
+    return [
+        {"id": sensor_id, "name": db_sensors[sensor_id].name, "type": db_sensors[sensor_id].type, "data": series[sensor_id]}
+        for sensor_id in sorted(series)
+    ]
 
 # We delete the sensor from PostgreSQL, Redis and MongoDB
-def delete_sensor(db: Session, sensor_id: int, mongodb: MongoDBClient, redis: redis_client):
+def delete_sensor(db: Session, sensor_id: int, mongodb: MongoDBClient, redis: redis_client, cassandra: CassandraClient, cache=None, data_cache=None):
     db_sensor = db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first()
     if db_sensor is None:
         raise HTTPException(status_code=404, detail="Sensor not found")
     db.delete(db_sensor)
     db.commit()
+    cassandra.add_to_sensor_count(db_sensor.type, -1)
+    if cache is not None:
+        cache.invalidate(sensor_id)
     mongodb.delete(db_sensor.name)
-    redis.delete(sensor_id)
+    redis.delete_latest(sensor_id)
+    redis.delete_temperature_stats(sensor_id)
+    if data_cache is not None:
+        data_cache.invalidate_sensor(sensor_id)
     return db_sensor
 
 # We use the mongdb querys to do this method
+# Returns the id, name and latest reading of the sensors in the square of the given radius around the point
 def get_sensors_near(mongodb: MongoDBClient, latitude: float, longitude: float, radius: float, redis: redis_client, db: Session):
-    near = []
     query = {"latitude": {"$gte": latitude - radius, "$lte": latitude + radius},
      "longitude": {"$gte": longitude - radius, "$lte": longitude + radius}}
 
-    sensors = mongodb.collection.find(query) # Do a query for the sensors in a given radius.
-    for sensor in sensors:  # Traverse for every sensor in the doc.
-        db_sensor = get_sensor_by_name(db,sensor['name'])
-        db_sensor_data = get_data(redis, db_sensor) 
-
-        near.append(db_sensor_data)
+    names = [sensor['name'] for sensor in mongodb.collection.find(query)] # Do a query for the sensors in a given radius.
+    if not names:
+        return []
+    # The documents of mongodb have no id, the sensors are loaded by name with one query
+    db_sensors = db.query(models.Sensor).filter(models.Sensor.name.in_(set(names))).order_by(models.Sensor.id).all()
+    # The latest readings of all of them in one round trip
+    latest = redis.get_many([db_sensor.id for db_sensor in db_sensors]) if db_sensors else []
+    near = []
+    for db_sensor, value in zip(db_sensors, latest):
+        reading = json.loads(value) if value is not None else {}
+        near.append({"id": db_sensor.id, "name": db_sensor.name, **{field: reading[field] for field in reading if reading[field] is not None}})
     return near
 
 def search_sensors(db: Session , mongodb: MongoDBClient, es: ElasticsearchClient, query: str, size: int, search_type: str):  
@@ -199,79 +410,36 @@ def search_sensors(db: Session , mongodb: MongoDBClient, es: ElasticsearchClient
 
     return sensors 
 
-def get_temperature_values(db: Session, cassandra: CassandraClient):
+# Reads the running stats kept by the ingest path (see shared/sensors/temperature_stats.py)
+def get_temperature_values(db: Session, redis: redis_client, cache=None):
     try:
-        sensors = []
-         # Define the CQL query to calculate max, min, and average temperature values
-        query = """
-        SELECT
-            sensor_id,
-            MAX(temperature) AS max_temperature,
-            MIN(temperature) AS min_temperature,
-            AVG(temperature) AS average_temperature
-        FROM
-            sensor.temperature_values
-        GROUP BY
-            sensor_id
-        """
-        # Execute the CQL query
-        result = cassandra.execute(query)
-        
-        for row in result:
-            db_sensor = get_sensor(db=db, sensor_id=row[0])
-            sensors.append({
-                "id": row[0],
-                "name": db_sensor.name,
-                "latitude": db_sensor.latitude,
-                "longitude": db_sensor.longitude,
-                "type": db_sensor.type,
-                "mac_address": db_sensor.mac_address,
-                "manufacturer": db_sensor.manufacturer,
-                "model": db_sensor.model,
-                "serie_number": db_sensor.serie_number,
-                "firmware_version": db_sensor.firmware_version,
-                "description": db_sensor.description,
-                "values": [
-                    {
-                        "max_temperature": row[1], 
-                        "min_temperature": row[2], 
-                        "average_temperature": row[3]
-                    }
-                ]
-                })
-        return {"sensors": sensors}
+        results = [
+            (sensor_id, {"values": [{
+                "max_temperature": stats[1],
+                "min_temperature": stats[0],
+                "average_temperature": temperature_stats.average(stats)
+            }]})
+            for sensor_id, stats in redis.get_temperature_stats().items()
+        ]
+        return {"sensors": hydrate_sensors(db, results, cache)}
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch temperature values: {str(e)}")
     
+# The counters are kept by create_sensor and delete_sensor, the types without sensors are left out
 def get_sensors_quantity(db=Session, cassandra=CassandraClient):
     try:
-        sensors = []
-        # Define the CQL query to get sensor quantities by type
-        query = """
-        SELECT
-            sensor_type, COUNT(sensor_type) AS quantity
-        FROM
-            sensor.count_by_type
-        GROUP BY
-            sensor_type
-        """
-
-        # Execute the CQL query
-        result = cassandra.execute(query)
-
-        for row in result:
-            sensors.append({
-                "type" : row[0],
-                "quantity" : row[1]
-            })
-
+        sensors = [
+            {"type": sensor_type, "quantity": quantity}
+            for sensor_type, quantity in sorted(cassandra.get_sensor_counts().items())
+            if quantity > 0
+        ]
         return {"sensors": sensors}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch sensor quantities: {str(e)}")
     
 
-def get_low_battery_sensors(db=Session, cassandra=CassandraClient):
+def get_low_battery_sensors(db=Session, cassandra=CassandraClient, cache=None):
     try:
         # Define the CQL query to get sensors with low battery level
         query = """
@@ -284,38 +452,11 @@ def get_low_battery_sensors(db=Session, cassandra=CassandraClient):
         # Execute the CQL query
         result = cassandra.execute(query)
 
-        # Extract low battery sensors from the result
-        low_battery_sensors = result.all()
-
-        # Initialize a list to store the response data
-        response_data = []
-
-        # Iterate over the low battery sensors and fetch sensor details from the database
-        for sensor_data in low_battery_sensors:
-            sensor_id = sensor_data.sensor_id
-            battery_level = sensor_data.battery_level
-            
-            # Fetch sensor details from the database using sensor_id
-            sensor_details = db.query(models.Sensor).filter(models.Sensor.id == sensor_id).first()
-            if sensor_details:
-                sensor_dict = {
-                    "id": sensor_details.id,
-                    "name": sensor_details.name,
-                    "latitude": sensor_details.latitude,
-                    "longitude": sensor_details.longitude,
-                    "type": sensor_details.type,
-                    "mac_address": sensor_details.mac_address,
-                    "manufacturer": sensor_details.manufacturer,
-                    "model": sensor_details.model,
-                    "serie_number": sensor_details.serie_number,
-                    "firmware_version": sensor_details.firmware_version,
-                    "description": sensor_details.description,
-                    "battery_level": battery_level
-                }
-                response_data.append(sensor_dict)
+        # The sensor details of all the rows are loaded at once
+        results = [(row.sensor_id, {"battery_level": row.battery_level}) for row in result.all()]
 
         # Construct the response JSON
-        response = {"sensors": response_data}
+        response = {"sensors": hydrate_sensors(db, results, cache)}
         return response
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch low battery sensors: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to fetch low battery sensors: {str(e)}")
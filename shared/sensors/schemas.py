@@ -1,5 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from typing import Optional
+from enum import Enum
+from datetime import datetime
 
 class Sensor(BaseModel):
     id: int
@@ -20,6 +22,23 @@ class Sensor(BaseModel):
     class Config:
         orm_mode = True
         
+# Sensor columns kept in the metadata cache, see shared/sensors/cache.py
+class SensorMetadata(BaseModel):
+    id: int
+    name: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    type: Optional[str] = None
+    mac_address: Optional[str] = None
+    manufacturer: Optional[str] = None
+    model: Optional[str] = None
+    serie_number: Optional[str] = None
+    firmware_version: Optional[str] = None
+    description: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+
 class SensorCreate(BaseModel):
     name: str
     longitude: float
@@ -37,4 +56,29 @@ class SensorData(BaseModel):
     temperature: Optional[float] = None
     humidity: Optional[float] = None
     battery_level: float
-    last_seen: str
\ No newline at end of file
+    last_seen: str
+
+    # Kept as sent, but the writes parse it with datetime.fromisoformat
+    @validator("last_seen")
+    def last_seen_is_iso(cls, value):
+        try:
+            datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError("last_seen must be an ISO 8601 timestamp")
+        return value
+
+
+# Message published to the queue for every reading in async ingest mode
+class SensorDataMessage(BaseModel):
+    sensor_id: int
+    data: SensorData
+
+    def to_json(self):
+        return self.json()
+
+
+# Priority of the readings published in async mode, see shared/backpressure.py
+class Priority(str, Enum):
+    critical = "critical"
+    normal = "normal"
+    low = "low"
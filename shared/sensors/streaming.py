@@ -0,0 +1,51 @@
+import csv
+import io
+import json
+
+# Rows joined in each chunk sent to the client
+CHUNK_ROWS = 1000
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def _value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+# Encodes the rows (tuples in the order of columns) as NDJSON, CHUNK_ROWS lines per chunk
+def ndjson_chunks(rows, columns):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps({column: _value(value) for column, value in zip(columns, row)}))
+        if len(lines) >= CHUNK_ROWS:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+# Encodes the rows as CSV with a header line, CHUNK_ROWS lines per chunk
+def csv_chunks(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(["" if value is None else _value(value) for value in row])
+        count += 1
+        if count >= CHUNK_ROWS:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def encode(rows, columns, format):
+    if format == "csv":
+        return csv_chunks(rows, columns)
+    return ndjson_chunks(rows, columns)
@@ -0,0 +1,95 @@
+# Running temperature stats of every sensor (min, max, sum and count), kept in Redis hashes and updated
+# by the ingest path with the readings Timescale stored, so GET /sensors/temperature/values reads them in
+# O(#sensors) instead of aggregating the whole temperature_values table on every request.
+#
+# The ingest records every reading as pending (add_pending) before writing it to Timescale, and settles
+# it afterwards: a pending reading is counted at most once, by whoever removes it first. A duplicate is
+# only counted if it was still pending, i.e. a previous attempt stored it and failed before settling it
+# (Redis down, the worker killed...), so the retry of a redelivered message counts what it lost. The
+# readings left pending (a write that failed and was never retried) are settled from Timescale, run it
+# periodically:
+#   python -m shared.sensors.temperature_stats --settle [--older-than 300]
+# Only the readings pending for more than --older-than seconds are settled, to leave alone the writes
+# in progress.
+#
+# The stats can also be recomputed from the temperature_values table of Cassandra, e.g. after losing Redis:
+#   python -m shared.sensors.temperature_stats --rebuild
+# It drops the pending readings. Readings written while the rebuild runs may be counted twice or missed,
+# run it with the ingest stopped and the queues drained.
+import argparse
+import time
+
+from shared.cassandra_client import CassandraClient
+from shared.redis_client import RedisClient
+from shared.timescale import Timescale
+
+# Pending readings checked in Timescale at a time
+SETTLE_CHUNK = 10000
+
+
+def average(stats):
+    low, high, total, count = stats
+    return total / count if count else None
+
+
+# readings is a list of (sensor_id, last_seen_ms, temperature), returns for each one if it was pending already
+def add_pending(redis: RedisClient, readings):
+    return redis.add_pending_temperature_stats(readings, int(time.time() * 1000))
+
+
+# Settles the readings pending for more than older_than seconds, counting the ones Timescale has.
+# Returns (settled, counted)
+def settle_pending(redis: RedisClient, timescale: Timescale, older_than=300):
+    cutoff = int((time.time() - older_than) * 1000)
+    pending = [(sensor_id, last_seen_ms) for sensor_id, last_seen_ms, added_ms in redis.get_pending_temperature_stats() if added_ms < cutoff]
+    counted = 0
+    for start in range(0, len(pending), SETTLE_CHUNK):
+        chunk = pending[start:start + SETTLE_CHUNK]
+        # The pending readings have millisecond timestamps, last_seen may have microseconds
+        rows = timescale.fetch_all("""
+            SELECT p.id, p.ms
+            FROM unnest(%s::int[], %s::bigint[]) AS p(id, ms)
+            WHERE EXISTS (
+                SELECT 1 FROM sensor_data d
+                WHERE d.id = p.id AND d.last_seen >= to_timestamp(p.ms / 1000.0) AND d.last_seen < to_timestamp((p.ms + 1) / 1000.0))""",
+            ([sensor_id for sensor_id, _ in chunk], [last_seen_ms for _, last_seen_ms in chunk]))
+        stored = set(rows)
+        counted += redis.settle_temperature_stats([(sensor_id, last_seen_ms, (sensor_id, last_seen_ms) in stored) for sensor_id, last_seen_ms in chunk])
+    return len(pending), counted
+
+
+def rebuild(redis: RedisClient, cassandra: CassandraClient):
+    rows = cassandra.execute("""
+        SELECT sensor_id, MIN(temperature), MAX(temperature), SUM(temperature), COUNT(temperature)
+        FROM sensor.temperature_values
+        GROUP BY sensor_id""")
+    stats = {row[0]: (row[1], row[2], row[3], row[4]) for row in rows if row[4]}
+    redis.replace_temperature_stats(stats)
+    return len(stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild", action="store_true", help="recompute the stats from Cassandra")
+    parser.add_argument("--settle", action="store_true", help="settle the readings left pending from Timescale")
+    parser.add_argument("--older-than", type=int, default=300, help="seconds a reading must be pending to be settled")
+    args = parser.parse_args()
+    redis = RedisClient(host="redis")
+    try:
+        if args.rebuild:
+            cassandra = CassandraClient(hosts=["cassandra"])
+            try:
+                print(f"Rebuilt the temperature stats of {rebuild(redis, cassandra)} sensors")
+            finally:
+                cassandra.close()
+        if args.settle:
+            timescale = Timescale()
+            try:
+                settled, counted = settle_pending(redis, timescale, older_than=args.older_than)
+                print(f"Settled {settled} pending readings, {counted} counted")
+            finally:
+                timescale.close()
+        for sensor_id, stats in redis.get_temperature_stats().items():
+            print(f"{sensor_id:>8} min {stats[0]:>8.2f} max {stats[1]:>8.2f} avg {average(stats):>8.2f} count {stats[3]:>10}")
+    finally:
+        redis.close()
@@ -0,0 +1,53 @@
+# Reconciles the counters of sensors by type in Cassandra (sensor.sensor_count_by_type) with the sensors
+# of PostgreSQL. create_sensor and delete_sensor keep the counters, but a counter update is not idempotent:
+# one retried after a timeout, or lost because the process died between the two databases, leaves them off.
+# Counters can't be set, so every counter is moved by its difference with the real count.
+#
+#   python -m shared.sensors.type_counts [--dry-run]
+#
+# Run it once after deploying the counters, to count the sensors created before, and then periodically.
+# A sensor created or deleted while it runs may be counted twice or missed until the next run.
+import argparse
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from shared.cassandra_client import CassandraClient
+from shared.database import SessionLocal
+from shared.sensors import models
+
+
+def expected_counts(db: Session):
+    rows = db.query(models.Sensor.type, func.count(models.Sensor.id)).group_by(models.Sensor.type).all()
+    return {sensor_type: count for sensor_type, count in rows}
+
+
+# Returns {sensor_type: delta} of the counters that were off
+def reconcile(db: Session, cassandra: CassandraClient, dry_run=False):
+    expected = expected_counts(db)
+    current = cassandra.get_sensor_counts()
+    deltas = {}
+    for sensor_type in set(expected) | set(current):
+        delta = expected.get(sensor_type, 0) - (current.get(sensor_type) or 0)
+        if delta:
+            deltas[sensor_type] = delta
+    if not dry_run:
+        for sensor_type, delta in deltas.items():
+            cassandra.add_to_sensor_count(sensor_type, delta)
+    return deltas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="only print the counters that are off")
+    args = parser.parse_args()
+    db = SessionLocal()
+    cassandra = CassandraClient(hosts=["cassandra"])
+    try:
+        deltas = reconcile(db, cassandra, dry_run=args.dry_run)
+        for sensor_type, delta in sorted(deltas.items()):
+            print(f"{sensor_type}: {delta:+d}")
+        print(f"{len(deltas)} counters {'off' if args.dry_run else 'fixed'}")
+    finally:
+        cassandra.close()
+        db.close()
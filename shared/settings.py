@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 
 from pydantic import BaseSettings
 from dotenv import load_dotenv
@@ -12,7 +13,112 @@ class Settings(BaseSettings):
     db_password: str = os.getenv("DB_PASSWORD")
     db_host: str = os.getenv("DB_HOST")
     db_port: str = os.getenv("DB_PORT")
+
+    # Ingest mode for POST /sensors/{sensor_id}/data:
+    # - "sync": the API writes to Timescale, Redis and Cassandra before answering
+    # - "async": the API only publishes the reading to RabbitMQ and answers 202,
+    #   the consumer does the writes
+    ingest_mode: str = os.getenv("INGEST_MODE", "sync")
+    # Readings of POST /sensors/data/batch written or published together
+    ingest_chunk_size: int = os.getenv("INGEST_CHUNK_SIZE", 500)
+    # TTL in seconds of the latest reading of each sensor stored in Redis, 0 keeps it forever
+    redis_latest_ttl: int = os.getenv("REDIS_LATEST_TTL", 0)
+
+    # Cache of the GET /sensors/{sensor_id}/data results (see shared/sensors/data_cache.py): backend redis,
+    # memory or none. Results with only closed buckets are kept data_cache_ttl seconds, the ones that
+    # reach the current bucket data_cache_open_ttl seconds
+    data_cache_backend: str = os.getenv("DATA_CACHE_BACKEND", "redis")
+    data_cache_size: int = os.getenv("DATA_CACHE_SIZE", 10000)
+    data_cache_ttl: int = os.getenv("DATA_CACHE_TTL", 3600)
+    data_cache_open_ttl: int = os.getenv("DATA_CACHE_OPEN_TTL", 10)
+    # Memory backend only: seconds the refresher takes to materialize a reading, its buckets are kept
+    # data_cache_open_ttl seconds meanwhile
+    data_cache_refresh_delay: int = os.getenv("DATA_CACHE_REFRESH_DELAY", 60)
+
+    # Rows fetched at a time by the server-side cursor of GET /sensors/{sensor_id}/data/stream
+    stream_itersize: int = os.getenv("STREAM_ITERSIZE", 2000)
+    # Rows per Parquet row group / Arrow record batch of GET /sensors/export
+    export_row_group_size: int = os.getenv("EXPORT_ROW_GROUP_SIZE", 100000)
+
+    # Run shared/bootstrap.py when the API starts, disable it if the bootstrap runs at deploy time
+    bootstrap_on_startup: bool = os.getenv("BOOTSTRAP_ON_STARTUP", True)
+
+    # Cache of the sensors metadata used by the ingest path (see shared/sensors/cache.py)
+    sensor_cache_size: int = os.getenv("SENSOR_CACHE_SIZE", 10000)
+    sensor_cache_ttl: int = os.getenv("SENSOR_CACHE_TTL", 300)
+    # Unknown sensor ids are cached for less time, so a new sensor is seen soon by every process
+    sensor_cache_negative_ttl: int = os.getenv("SENSOR_CACHE_NEGATIVE_TTL", 30)
+    # Share the cache between processes through Redis, as a second level
+    sensor_cache_redis: bool = os.getenv("SENSOR_CACHE_REDIS", False)
+
+    # Connection pools, shared by all the requests of a worker process (see shared/clients.py)
+    timescale_pool_min: int = os.getenv("TIMESCALE_POOL_MIN", 1)
+    timescale_pool_max: int = os.getenv("TIMESCALE_POOL_MAX", 10)
+    # Seconds a request waits for a free Timescale connection
+    timescale_pool_timeout: float = os.getenv("TIMESCALE_POOL_TIMEOUT", 5)
+    timescale_connect_timeout: int = os.getenv("TIMESCALE_CONNECT_TIMEOUT", 10)
+    redis_max_connections: int = os.getenv("REDIS_MAX_CONNECTIONS", 50)
+    redis_socket_timeout: float = os.getenv("REDIS_SOCKET_TIMEOUT", 5)
+    mongodb_max_pool_size: int = os.getenv("MONGODB_MAX_POOL_SIZE", 50)
+    mongodb_timeout_ms: int = os.getenv("MONGODB_TIMEOUT_MS", 5000)
+    elasticsearch_timeout: float = os.getenv("ELASTICSEARCH_TIMEOUT", 10)
+    cassandra_connect_timeout: float = os.getenv("CASSANDRA_CONNECT_TIMEOUT", 10)
+    # Writes in flight per Cassandra execute_many call
+    cassandra_concurrency: int = os.getenv("CASSANDRA_CONCURRENCY", 64)
+
+    # Storage tiers of the sensor_data hypertable, applied by shared/bootstrap.py (see shared/storage.py)
+    timescale_chunk_interval_hours: int = os.getenv("TIMESCALE_CHUNK_INTERVAL_HOURS", 24)
+    # Chunks whose readings are all older than this are compressed, 0 disables the compression
+    timescale_compress_after_days: int = os.getenv("TIMESCALE_COMPRESS_AFTER_DAYS", 7)
+    # Chunks of raw readings older than this are dropped, the aggregates are kept. 0 keeps them forever
+    timescale_raw_retention_days: int = os.getenv("TIMESCALE_RAW_RETENTION_DAYS", 0)
+
+    # RabbitMQ, see shared/queues.py
+    rabbitmq_host: str = os.getenv("RABBITMQ_HOST", "rabbitmq")
+    rabbitmq_port: int = os.getenv("RABBITMQ_PORT", 5672)
+    rabbitmq_user: str = os.getenv("RABBITMQ_USER", "guest")
+    rabbitmq_password: str = os.getenv("RABBITMQ_PASSWORD", "guest")
+    rabbitmq_heartbeat: int = os.getenv("RABBITMQ_HEARTBEAT", 60)
+    # Queues the readings are sharded in by sensor id, each one is consumed by a single worker
+    queue_shards: int = os.getenv("QUEUE_SHARDS", 16)
+    # Consumer worker processes started by consumer/main.py (0 = one per CPU), never more than queue_shards
+    consumer_processes: int = os.getenv("CONSUMER_PROCESSES", 0)
+
+    # Publisher of the API (see shared/publisher.py): channels of its connection, unconfirmed
+    # messages per channel, and messages waiting to be sent before publish() blocks (up to
+    # publisher_publish_timeout seconds)
+    publisher_channels: int = os.getenv("PUBLISHER_CHANNELS", 4)
+    publisher_confirm_window: int = os.getenv("PUBLISHER_CONFIRM_WINDOW", 1000)
+    publisher_max_pending: int = os.getenv("PUBLISHER_MAX_PENDING", 100000)
+    publisher_publish_timeout: float = os.getenv("PUBLISHER_PUBLISH_TIMEOUT", 5)
+    # Readings of the same shard packed in one message (1 = no batching), sent at least every publisher_batch_ms
+    publisher_batch_size: int = os.getenv("PUBLISHER_BATCH_SIZE", 1)
+    publisher_batch_ms: int = os.getenv("PUBLISHER_BATCH_MS", 50)
+    # Backpressure of the async ingest (see shared/backpressure.py): the depth of the shard queues is
+    # polled every backpressure_poll_interval seconds; from soft_depth messages in a shard its low
+    # priority readings are refused (429), from hard_depth only the critical ones are accepted (503)
+    backpressure_enabled: bool = os.getenv("BACKPRESSURE_ENABLED", True)
+    backpressure_poll_interval: float = os.getenv("BACKPRESSURE_POLL_INTERVAL", 2)
+    backpressure_soft_depth: int = os.getenv("BACKPRESSURE_SOFT_DEPTH", 50000)
+    backpressure_hard_depth: int = os.getenv("BACKPRESSURE_HARD_DEPTH", 200000)
+    backpressure_retry_after: int = os.getenv("BACKPRESSURE_RETRY_AFTER", 5)
+    # Encoding of the readings: json or binary (see shared/sensors/codec.py). The consumer decodes both
+    publisher_codec: str = os.getenv("PUBLISHER_CODEC", "json")
+
+    # The consumer writes the readings in batches: a batch is flushed when it has
+    # consumer_batch_size messages or its oldest message waited consumer_batch_ms
+    consumer_batch_size: int = os.getenv("CONSUMER_BATCH_SIZE", 500)
+    consumer_batch_ms: int = os.getenv("CONSUMER_BATCH_MS", 200)
+    # Unacked messages RabbitMQ delivers to a consumer, it must be >= consumer_batch_size
+    consumer_prefetch: int = os.getenv("CONSUMER_PREFETCH", 1000)
+    # Delays before retrying a message whose write failed for a transient reason (comma separated, in ms).
+    # After the last one the message goes to the dead-letter queue.
+    consumer_retry_delays_ms: str = os.getenv("CONSUMER_RETRY_DELAYS_MS", "1000,5000,30000,120000")
     
+    @property
+    def consumer_retry_delays(self) -> list:
+        return [int(delay) for delay in self.consumer_retry_delays_ms.split(",") if delay.strip()]
+
     @property
     def db_name(self) -> str:
         if (os.getenv("ENVIRONMENT") == "test"):
@@ -29,4 +135,9 @@ class Settings(BaseSettings):
     
     class Config:
         env_file = ".env"
-        env_file_encoding = "utf-8"
\ No newline at end of file
+        env_file_encoding = "utf-8"
+
+
+@lru_cache()
+def get_settings() -> Settings:
+    return Settings()
@@ -0,0 +1,88 @@
+# Storage tiers of the sensor_data hypertable, from the settings:
+# - chunks of timescale_chunk_interval_hours (only the chunks created afterwards get the new interval)
+# - native columnar compression of the chunks older than timescale_compress_after_days, segmented by
+#   sensor id and ordered by last_seen, so a range scan of a sensor decompresses only its segments
+# - retention: the chunks of raw readings older than timescale_raw_retention_days are dropped. The
+#   continuous aggregates keep their buckets, the hourly one is only refreshed within the retention
+#   window so a refresh never recomputes a bucket whose readings are gone.
+#
+# Applied by the "storage" backend of shared/bootstrap.py, after the Timescale schema, again whenever
+# the settings change.
+from shared.timescale import Timescale
+
+HYPERTABLE = "sensor_data"
+# The only aggregate computed from the raw readings, the others come from it (views_ts.sql)
+RAW_AGGREGATE = "sensor_data_hour"
+
+
+# Part of the fingerprint of the storage backend of the bootstrap
+def fingerprint(settings):
+    return f"chunk={settings.timescale_chunk_interval_hours}h compress={settings.timescale_compress_after_days}d retention={settings.timescale_raw_retention_days}d"
+
+
+def _days(days):
+    return f"{int(days)} days"
+
+
+# conn is in autocommit mode
+def apply(conn, settings):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT set_chunk_time_interval(%s, %s::interval)", (HYPERTABLE, f"{int(settings.timescale_chunk_interval_hours)} hours"))
+
+        cursor.execute("SELECT remove_compression_policy(%s, if_exists => true)", (HYPERTABLE,))
+        if settings.timescale_compress_after_days > 0:
+            # The compression settings can't be changed once there are compressed chunks
+            cursor.execute("SELECT compression_enabled FROM timescaledb_information.hypertables WHERE hypertable_name = %s", (HYPERTABLE,))
+            if not cursor.fetchone()[0]:
+                cursor.execute(f"""
+                    ALTER TABLE {HYPERTABLE} SET (
+                        timescaledb.compress,
+                        timescaledb.compress_segmentby = 'id',
+                        timescaledb.compress_orderby = 'last_seen')""")
+            cursor.execute("SELECT add_compression_policy(%s, compress_after => %s::interval)", (HYPERTABLE, _days(settings.timescale_compress_after_days)))
+
+        cursor.execute("SELECT remove_retention_policy(%s, if_exists => true)", (HYPERTABLE,))
+        if settings.timescale_raw_retention_days > 0:
+            cursor.execute("SELECT add_retention_policy(%s, drop_after => %s::interval)", (HYPERTABLE, _days(settings.timescale_raw_retention_days)))
+            # Replaces the policy of views_ts.sql, which refreshes the whole history
+            cursor.execute("SELECT remove_continuous_aggregate_policy(%s, if_exists => true)", (RAW_AGGREGATE,))
+            cursor.execute("""
+                SELECT add_continuous_aggregate_policy(%s,
+                    start_offset => %s::interval,
+                    end_offset => INTERVAL '1 h',
+                    schedule_interval => INTERVAL '1 minute')""", (RAW_AGGREGATE, _days(settings.timescale_raw_retention_days)))
+
+
+# Size of every chunk of sensor_data, and of the compressed ones their size before compression
+def chunk_stats(timescale: Timescale):
+    rows = timescale.fetch_all("""
+        SELECT c.chunk_name, c.range_start, c.range_end, c.is_compressed, s.total_bytes,
+               cs.before_compression_total_bytes, cs.after_compression_total_bytes
+        FROM timescaledb_information.chunks c
+        LEFT JOIN chunks_detailed_size(%s) s ON s.chunk_schema = c.chunk_schema AND s.chunk_name = c.chunk_name
+        LEFT JOIN chunk_compression_stats(%s) cs ON cs.chunk_schema = c.chunk_schema AND cs.chunk_name = c.chunk_name
+        WHERE c.hypertable_name = %s
+        ORDER BY c.range_start""", (HYPERTABLE, HYPERTABLE, HYPERTABLE))
+    chunks = []
+    for name, range_start, range_end, is_compressed, total_bytes, before_bytes, after_bytes in rows:
+        size = after_bytes if is_compressed and after_bytes is not None else total_bytes
+        uncompressed_size = before_bytes if is_compressed and before_bytes is not None else total_bytes
+        chunks.append({
+            "chunk": name,
+            "range_start": range_start,
+            "range_end": range_end,
+            "compressed": is_compressed,
+            "bytes": size,
+            "uncompressed_bytes": uncompressed_size,
+            "compression_ratio": uncompressed_size / size if is_compressed and size else None,
+        })
+    total = sum(chunk["bytes"] or 0 for chunk in chunks)
+    uncompressed_total = sum(chunk["uncompressed_bytes"] or 0 for chunk in chunks)
+    return {
+        "hypertable": HYPERTABLE,
+        "chunks": chunks,
+        "compressed_chunks": sum(1 for chunk in chunks if chunk["compressed"]),
+        "bytes": total,
+        "uncompressed_bytes": uncompressed_total,
+        "compression_ratio": uncompressed_total / total if total else None,
+    }
@@ -2,29 +2,54 @@ import pika
 import time
 
 from shared.publisher import QUEUE_NAME
+from shared.queues import connection_parameters
+from shared.settings import get_settings
 
 class Subscriber:
-    def __init__(self):
-        credentials = pika.PlainCredentials('guest', 'guest')
-        # Change the host to rabbitmq
-        parameters = pika.ConnectionParameters('localhost',
-                                       5672,
-                                       '/',
-                                       credentials)
+    def __init__(self, settings=None):
+        parameters = connection_parameters(settings or get_settings())
         try:
             self.conn = pika.BlockingConnection(parameters)
         except Exception as e:
             time.sleep(10)
             self.conn = pika.BlockingConnection(parameters)
         self.channel = self.conn.channel()
+        self.publish_channel = None
 
-
-    def subscribe(self, callback):
-        result = self.channel.queue_declare(queue=QUEUE_NAME)
-        self.channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback, auto_ack=True)
+    # With auto_ack=False the callback must ack the messages itself (basic_ack),
+    # prefetch_count limits how many unacked messages RabbitMQ sends to this channel.
+    # Without queues it consumes the QUEUE_NAME queue; with exclusive the queues
+    # can't have any other consumer while this one is connected.
+    def subscribe(self, callback, auto_ack=True, prefetch_count=None, queues=None, exclusive=False):
+        if queues is None:
+            self.channel.queue_declare(queue=QUEUE_NAME)
+            queues = [QUEUE_NAME]
+        if prefetch_count:
+            self.channel.basic_qos(prefetch_count=prefetch_count, global_qos=True)
+        for queue in queues:
+            self.channel.basic_consume(queue=queue, on_message_callback=callback, auto_ack=auto_ack, exclusive=exclusive)
         self.channel.start_consuming()
 
-    def close(self):
-        self.conn.close()
+    def ack(self, delivery_tag, multiple=False):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag, multiple=False, requeue=True):
+        self.channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+
+    # Publishes a message from the consuming thread (retries and dead letters), returns once the broker confirmed it
+    def publish(self, exchange, routing_key, body, properties=None):
+        if self.publish_channel is None:
+            self.publish_channel = self.conn.channel()
+            self.publish_channel.confirm_delivery()
+        self.publish_channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
 
-    
\ No newline at end of file
+    # Timers run in the consuming thread, between message deliveries
+    def call_later(self, delay, callback):
+        return self.conn.call_later(delay, callback)
+
+    def remove_timeout(self, timer_id):
+        self.conn.remove_timeout(timer_id)
+
+    def close(self):
+        if self.conn.is_open:
+            self.conn.close()
@@ -1,15 +1,86 @@
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import threading
+import csv
+import io
 import os
+import uuid
+from datetime import datetime, timezone
+
+SENSOR_DATA_COLUMNS = ("id", "last_seen", "temperature", "humidity", "velocity", "battery_level")
+# Reason of the rejected rows that were already stored, e.g. when a reading is delivered twice
+DUPLICATE = "duplicate (id, last_seen)"
+# Result of insert_sensor_data for a reading it stored, DUPLICATE for one already stored
+INSERTED = "inserted"
+
+
+# Result of a bulk insert: how many rows were written, with which method, and the rejected ones
+class BulkInsertReport():
+    def __init__(self, method):
+        self.method = method
+        self.inserted = 0
+        self.rejected = []
+
+    def reject(self, index, row, reason):
+        self.rejected.append({"index": index, "row": row, "reason": reason})
+
+    def to_dict(self):
+        return {"method": self.method, "inserted": self.inserted, "rejected": self.rejected}
+
+
+def connection_params():
+    return dict(
+        host=os.environ.get("TS_HOST"),
+        port=os.environ.get("TS_PORT"),
+        user=os.environ.get("TS_USER"),
+        password=os.environ.get("TS_PASSWORD"),
+        database=os.environ.get("TS_DBNAME"))
+
+
+# Thread safe pool of Timescale connections. When all the connections are in use getconn
+# waits up to `timeout` seconds for one to be returned instead of failing straight away.
+class TimescalePool:
+    def __init__(self, minconn=1, maxconn=10, timeout=5, connect_timeout=10):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, connect_timeout=connect_timeout, **connection_params())
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._timeout = timeout
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise psycopg2.pool.PoolError(f"No Timescale connection available after {self._timeout} s")
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            if conn.closed:
+                self._pool.putconn(conn, close=True)
+                return
+            # Connections go back to the pool clean: no open transaction and default autocommit
+            conn.rollback()
+            conn.autocommit = False
+            self._pool.putconn(conn)
+        except psycopg2.Error:
+            self._pool.putconn(conn, close=True)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
 
 
 class Timescale:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.environ.get("TS_HOST"),
-            port=os.environ.get("TS_PORT"),
-            user=os.environ.get("TS_USER"),
-            password=os.environ.get("TS_PASSWORD"),
-            database=os.environ.get("TS_DBNAME"))
+    # With a pool the connection is borrowed from it and close() gives it back
+    def __init__(self, pool=None):
+        self.pool = pool
+        if pool is not None:
+            self.conn = pool.getconn()
+        else:
+            self.conn = psycopg2.connect(**connection_params())
         self.cursor = self.conn.cursor()
         
     def getCursor(self):
@@ -17,7 +88,10 @@ class Timescale:
 
     def close(self):
         self.cursor.close()
-        self.conn.close()
+        if self.pool is not None:
+            self.pool.putconn(self.conn)
+        else:
+            self.conn.close()
     
     def ping(self):
         return self.conn.ping()
@@ -32,40 +106,148 @@ class Timescale:
         self.cursor.execute(query, params)
         return self.cursor.fetchall()
     
+    # Iterates the rows of a query with a server-side (named) cursor that fetches itersize rows at a
+    # time, so the memory used doesn't depend on the number of rows. The cursor lives in a transaction
+    # that is rolled back when the iteration ends or is abandoned.
+    def stream(self, query, params=None, itersize=2000):
+        cursor = self.conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query.strip().rstrip(";"), params)
+            for row in cursor:
+                yield row
+        finally:
+            try:
+                cursor.close()
+            finally:
+                self.conn.rollback()
+
     def delete(self, table):
         self.cursor.execute("DELETE FROM " + table)
         self.conn.commit()
 
+    # Returns INSERTED, or DUPLICATE if the reading was already stored. Any other error is raised after
+    # the rollback, which leaves the connection usable for the next query
     def insert_sensor_data(self,sensor_id,data):
-        try:
-            columns = []
-            values = []
-            placeholders = []
+        columns = []
+        values = []
+        placeholders = []
 
-            for key,value in data.items():
-                columns.append(key)
-                values.append(value)
-                placeholders.append("%s")
+        for key,value in data.items():
+            columns.append(key)
+            values.append(value)
+            placeholders.append("%s")
 
-            # Convert to , separated
+        # Convert to , separated
 
-            columns_str = ", ".join(columns)
-            placeholders_str = ", ".join(placeholders)
+        columns_str = ", ".join(columns)
+        placeholders_str = ", ".join(placeholders)
 
-            # Construct the SQL INSERT query
-            query = f"""
-            INSERT INTO sensor_data (id, {columns_str})
-            VALUES (%s, {placeholders_str});
-            """
+        # Construct the SQL INSERT query
+        query = f"""
+        INSERT INTO sensor_data (id, {columns_str})
+        VALUES (%s, {placeholders_str})
+        ON CONFLICT (id, last_seen) DO NOTHING;
+        """
 
-            values.insert(0,sensor_id)
+        values.insert(0,sensor_id)
 
+        try:
             # Execute the query with data
             self.cursor.execute(query, tuple(values))
             self.conn.commit()
-        except Exception as e:
-            # Handle any exceptions
-            print(f"Error inserting sensor data: {e}")
+        except Exception:
+            self.conn.rollback()
+            raise
+        return INSERTED if self.cursor.rowcount == 1 else DUPLICATE
+
+    # Inserts many readings in one transaction. rows is a list of
+    # (sensor_id, last_seen, temperature, humidity, velocity, battery_level).
+    # COPY is tried first; if any row makes it fail (e.g. an already stored reading after a redelivery)
+    # the batch is retried with execute_values, and as a last resort row by row to isolate the bad rows.
+    def insert_sensor_data_bulk(self, rows, method="copy"):
+        report = BulkInsertReport(method)
+        valid = []
+        for index, row in enumerate(rows):
+            if row[0] is None or row[1] is None or row[5] is None:
+                report.reject(index, row, "id, last_seen and battery_level are required")
+            else:
+                valid.append((index, row))
+        if not valid:
+            return report
+
+        if method == "copy":
+            try:
+                self._copy_sensor_data([row for _, row in valid])
+                self.conn.commit()
+                report.inserted = len(valid)
+                return report
+            except psycopg2.Error:
+                self.conn.rollback()
+                report.method = "execute_values"
+
+        try:
+            inserted = psycopg2.extras.execute_values(self.cursor, f"""
+                INSERT INTO sensor_data ({", ".join(SENSOR_DATA_COLUMNS)})
+                VALUES %s
+                ON CONFLICT (id, last_seen) DO NOTHING
+                RETURNING id, last_seen
+            """, [row for _, row in valid], page_size=1000, fetch=True)
+            self.conn.commit()
+            report.inserted = len(inserted)
+            if len(inserted) < len(valid):
+                # RETURNING only has the new rows, the rest were already stored
+                self._reject_duplicates(report, valid, inserted)
+            return report
+        except psycopg2.Error:
+            self.conn.rollback()
+            report.method = "row_by_row"
+
+        for index, row in valid:
+            self.cursor.execute("SAVEPOINT bulk_row")
+            try:
+                self.cursor.execute(f"""
+                    INSERT INTO sensor_data ({", ".join(SENSOR_DATA_COLUMNS)})
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (id, last_seen) DO NOTHING
+                """, row)
+                if self.cursor.rowcount == 1:
+                    report.inserted += 1
+                else:
+                    report.reject(index, row, DUPLICATE)
+                self.cursor.execute("RELEASE SAVEPOINT bulk_row")
+            except psycopg2.Error as e:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_row")
+                report.reject(index, row, str(e).strip())
+        self.conn.commit()
+        return report
+
+    def _copy_sensor_data(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            # None is written as an empty unquoted field, which COPY reads as NULL
+            writer.writerow(["" if value is None else value for value in row])
+        buffer.seek(0)
+        self.cursor.copy_expert(f"COPY sensor_data ({', '.join(SENSOR_DATA_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    def _reject_duplicates(self, report, valid, inserted):
+        # RETURNING gives back the (id, last_seen) really inserted, the other rows were already stored
+        # or repeated inside the batch
+        inserted = {(sensor_id, _utc(last_seen)) for sensor_id, last_seen in inserted}
+        seen = set()
+        for index, row in valid:
+            key = (row[0], _utc(row[1]))
+            if key in inserted and key not in seen:
+                seen.add(key)
+                continue
+            report.reject(index, row, DUPLICATE)
+
 
-     
-         
+def _utc(value):
+    # Timestamps are compared as aware UTC datetimes, naive ones are taken as UTC like the database session does
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
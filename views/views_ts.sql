@@ -1,93 +1,214 @@
+-- Continuous aggregates of sensor_data. Each one stores, for every metric, the average, minimum,
+-- maximum, count, sum and sum of squares (the variance is derived from them, see
+-- repository.aggregated_data_sql). Only the hourly aggregate reads sensor_data, the coarser ones are
+-- built from a finer aggregate:
+--   sensor_data -> hour -> day -> week
+--                           day -> month -> year
+-- A week or a month is not a whole number of the bucket above it, so both come from the days.
+-- The bucket column of every view is named like its bucket.
+--
+-- shared/bootstrap.py runs this file again whenever it changes, so every statement must keep the
+-- views and their data as they are. A view whose definition changes is dropped by a migration of
+-- migrations_ts (which runs once, before this file). The views are created empty: the refresh
+-- policies and the refresher (shared/refresher.py) materialize them, and meanwhile the reads compute
+-- the buckets from the finer level (materialized_only = false).
+
+-- Hourly aggregate, from the readings
 CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_hour
-WITH (timescaledb.continuous) AS
-SELECT 
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
   id,
-  time_bucket( INTERVAL '1 hour', last_seen) AS hour,
-  AVG(velocity) AS avg_velocity,
-  AVG(temperature) AS avg_temperature,
-  AVG(humidity) AS avg_humidity,
-  AVG(battery_level) AS avg_battery
-FROM 
-  sensor_data
-GROUP BY 
-  id, hour; 
+  time_bucket(INTERVAL '1 hour', last_seen) AS hour,
+  avg(temperature) AS avg_temperature,
+  min(temperature) AS min_temperature,
+  max(temperature) AS max_temperature,
+  count(temperature) AS count_temperature,
+  sum(temperature) AS sum_temperature,
+  sum(temperature * temperature) AS sumsq_temperature,
+  avg(humidity) AS avg_humidity,
+  min(humidity) AS min_humidity,
+  max(humidity) AS max_humidity,
+  count(humidity) AS count_humidity,
+  sum(humidity) AS sum_humidity,
+  sum(humidity * humidity) AS sumsq_humidity,
+  avg(velocity) AS avg_velocity,
+  min(velocity) AS min_velocity,
+  max(velocity) AS max_velocity,
+  count(velocity) AS count_velocity,
+  sum(velocity) AS sum_velocity,
+  sum(velocity * velocity) AS sumsq_velocity,
+  avg(battery_level) AS avg_battery_level,
+  min(battery_level) AS min_battery_level,
+  max(battery_level) AS max_battery_level,
+  count(battery_level) AS count_battery_level,
+  sum(battery_level) AS sum_battery_level,
+  sum(battery_level * battery_level) AS sumsq_battery_level
+FROM sensor_data
+GROUP BY id, hour
+WITH NO DATA;
 
 SELECT add_continuous_aggregate_policy('sensor_data_hour',
-  start_offset => NULL,   
-  end_offset => INTERVAL '1 h',      
-  schedule_interval => INTERVAL '1 minute');  
+  start_offset => NULL,
+  end_offset => INTERVAL '1 h',
+  schedule_interval => INTERVAL '1 minute',
+  if_not_exists => true);
 
--- Daily Materialized View
+-- Daily aggregate, from the hourly one
 CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_day
-WITH (timescaledb.continuous) AS
-SELECT 
-       id, 
-       time_bucket('1 day', last_seen) AS day,
-       avg(temperature) AS avg_temperature,
-       avg(humidity) AS avg_humidity,
-       avg(velocity) AS avg_velocity,
-       avg(battery_level) AS avg_battery_level
-FROM 
- sensor_data
-GROUP BY
-    id,day;
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
+  id,
+  time_bucket(INTERVAL '1 day', hour) AS day,
+  sum(sum_temperature) / NULLIF(sum(count_temperature), 0) AS avg_temperature,
+  min(min_temperature) AS min_temperature,
+  max(max_temperature) AS max_temperature,
+  sum(count_temperature)::bigint AS count_temperature,
+  sum(sum_temperature) AS sum_temperature,
+  sum(sumsq_temperature) AS sumsq_temperature,
+  sum(sum_humidity) / NULLIF(sum(count_humidity), 0) AS avg_humidity,
+  min(min_humidity) AS min_humidity,
+  max(max_humidity) AS max_humidity,
+  sum(count_humidity)::bigint AS count_humidity,
+  sum(sum_humidity) AS sum_humidity,
+  sum(sumsq_humidity) AS sumsq_humidity,
+  sum(sum_velocity) / NULLIF(sum(count_velocity), 0) AS avg_velocity,
+  min(min_velocity) AS min_velocity,
+  max(max_velocity) AS max_velocity,
+  sum(count_velocity)::bigint AS count_velocity,
+  sum(sum_velocity) AS sum_velocity,
+  sum(sumsq_velocity) AS sumsq_velocity,
+  sum(sum_battery_level) / NULLIF(sum(count_battery_level), 0) AS avg_battery_level,
+  min(min_battery_level) AS min_battery_level,
+  max(max_battery_level) AS max_battery_level,
+  sum(count_battery_level)::bigint AS count_battery_level,
+  sum(sum_battery_level) AS sum_battery_level,
+  sum(sumsq_battery_level) AS sumsq_battery_level
+FROM sensor_data_hour
+GROUP BY id, day
+WITH NO DATA;
 
 SELECT add_continuous_aggregate_policy('sensor_data_day',
-  start_offset => NULL,   
-  end_offset => INTERVAL '1 h',      
-  schedule_interval => INTERVAL '1 h');
+  start_offset => NULL,
+  end_offset => INTERVAL '1 h',
+  schedule_interval => INTERVAL '1 h',
+  if_not_exists => true);
 
--- Weekly Materialized View
+-- Weekly aggregate, from the daily one
 CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_week
-WITH (timescaledb.continuous) AS
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
 SELECT
-    id,
-    time_bucket('1 week', last_seen) AS month,
-       avg(temperature) AS avg_temperature,
-       avg(humidity) AS avg_humidity,
-       avg(velocity) AS avg_velocity,
-       avg(battery_level) AS avg_battery_level
-FROM sensor_data
-GROUP BY 
-    id,month;
+  id,
+  time_bucket(INTERVAL '1 week', day) AS week,
+  sum(sum_temperature) / NULLIF(sum(count_temperature), 0) AS avg_temperature,
+  min(min_temperature) AS min_temperature,
+  max(max_temperature) AS max_temperature,
+  sum(count_temperature)::bigint AS count_temperature,
+  sum(sum_temperature) AS sum_temperature,
+  sum(sumsq_temperature) AS sumsq_temperature,
+  sum(sum_humidity) / NULLIF(sum(count_humidity), 0) AS avg_humidity,
+  min(min_humidity) AS min_humidity,
+  max(max_humidity) AS max_humidity,
+  sum(count_humidity)::bigint AS count_humidity,
+  sum(sum_humidity) AS sum_humidity,
+  sum(sumsq_humidity) AS sumsq_humidity,
+  sum(sum_velocity) / NULLIF(sum(count_velocity), 0) AS avg_velocity,
+  min(min_velocity) AS min_velocity,
+  max(max_velocity) AS max_velocity,
+  sum(count_velocity)::bigint AS count_velocity,
+  sum(sum_velocity) AS sum_velocity,
+  sum(sumsq_velocity) AS sumsq_velocity,
+  sum(sum_battery_level) / NULLIF(sum(count_battery_level), 0) AS avg_battery_level,
+  min(min_battery_level) AS min_battery_level,
+  max(max_battery_level) AS max_battery_level,
+  sum(count_battery_level)::bigint AS count_battery_level,
+  sum(sum_battery_level) AS sum_battery_level,
+  sum(sumsq_battery_level) AS sumsq_battery_level
+FROM sensor_data_day
+GROUP BY id, week
+WITH NO DATA;
 
 SELECT add_continuous_aggregate_policy('sensor_data_week',
-  start_offset => NULL,   
-  end_offset => INTERVAL '1 h',      
-  schedule_interval => INTERVAL '1 h');
+  start_offset => NULL,
+  end_offset => INTERVAL '1 h',
+  schedule_interval => INTERVAL '1 h',
+  if_not_exists => true);
 
--- Monthly Materialized View
+-- Monthly aggregate, from the daily one
 CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_month
-WITH (timescaledb.continuous) AS
-SELECT 
-       id,
-       time_bucket('1 month', last_seen) AS month,
-       avg(temperature) AS avg_temperature,
-       avg(humidity) AS avg_humidity,
-       avg(velocity) AS avg_velocity,
-       avg(battery_level) AS avg_battery_level
-FROM sensor_data
-GROUP BY id,month;
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
+  id,
+  time_bucket(INTERVAL '1 month', day) AS month,
+  sum(sum_temperature) / NULLIF(sum(count_temperature), 0) AS avg_temperature,
+  min(min_temperature) AS min_temperature,
+  max(max_temperature) AS max_temperature,
+  sum(count_temperature)::bigint AS count_temperature,
+  sum(sum_temperature) AS sum_temperature,
+  sum(sumsq_temperature) AS sumsq_temperature,
+  sum(sum_humidity) / NULLIF(sum(count_humidity), 0) AS avg_humidity,
+  min(min_humidity) AS min_humidity,
+  max(max_humidity) AS max_humidity,
+  sum(count_humidity)::bigint AS count_humidity,
+  sum(sum_humidity) AS sum_humidity,
+  sum(sumsq_humidity) AS sumsq_humidity,
+  sum(sum_velocity) / NULLIF(sum(count_velocity), 0) AS avg_velocity,
+  min(min_velocity) AS min_velocity,
+  max(max_velocity) AS max_velocity,
+  sum(count_velocity)::bigint AS count_velocity,
+  sum(sum_velocity) AS sum_velocity,
+  sum(sumsq_velocity) AS sumsq_velocity,
+  sum(sum_battery_level) / NULLIF(sum(count_battery_level), 0) AS avg_battery_level,
+  min(min_battery_level) AS min_battery_level,
+  max(max_battery_level) AS max_battery_level,
+  sum(count_battery_level)::bigint AS count_battery_level,
+  sum(sum_battery_level) AS sum_battery_level,
+  sum(sumsq_battery_level) AS sumsq_battery_level
+FROM sensor_data_day
+GROUP BY id, month
+WITH NO DATA;
 
 SELECT add_continuous_aggregate_policy('sensor_data_month',
-  start_offset => NULL,   
-  end_offset => INTERVAL '1 h',      
-  schedule_interval => INTERVAL '1 h'); 
+  start_offset => NULL,
+  end_offset => INTERVAL '1 h',
+  schedule_interval => INTERVAL '1 h',
+  if_not_exists => true);
 
--- Yearly Materialized View
+-- Yearly aggregate, from the monthly one
 CREATE MATERIALIZED VIEW IF NOT EXISTS sensor_data_year
-WITH (timescaledb.continuous) AS
-SELECT 
-       id,
-       time_bucket('1 year', last_seen) AS year,
-       avg(temperature) AS avg_temperature,
-       avg(humidity) AS avg_humidity,
-       avg(velocity) AS avg_velocity,
-       avg(battery_level) AS avg_battery_level
-FROM sensor_data
-GROUP BY id,year;
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT
+  id,
+  time_bucket(INTERVAL '1 year', month) AS year,
+  sum(sum_temperature) / NULLIF(sum(count_temperature), 0) AS avg_temperature,
+  min(min_temperature) AS min_temperature,
+  max(max_temperature) AS max_temperature,
+  sum(count_temperature)::bigint AS count_temperature,
+  sum(sum_temperature) AS sum_temperature,
+  sum(sumsq_temperature) AS sumsq_temperature,
+  sum(sum_humidity) / NULLIF(sum(count_humidity), 0) AS avg_humidity,
+  min(min_humidity) AS min_humidity,
+  max(max_humidity) AS max_humidity,
+  sum(count_humidity)::bigint AS count_humidity,
+  sum(sum_humidity) AS sum_humidity,
+  sum(sumsq_humidity) AS sumsq_humidity,
+  sum(sum_velocity) / NULLIF(sum(count_velocity), 0) AS avg_velocity,
+  min(min_velocity) AS min_velocity,
+  max(max_velocity) AS max_velocity,
+  sum(count_velocity)::bigint AS count_velocity,
+  sum(sum_velocity) AS sum_velocity,
+  sum(sumsq_velocity) AS sumsq_velocity,
+  sum(sum_battery_level) / NULLIF(sum(count_battery_level), 0) AS avg_battery_level,
+  min(min_battery_level) AS min_battery_level,
+  max(max_battery_level) AS max_battery_level,
+  sum(count_battery_level)::bigint AS count_battery_level,
+  sum(sum_battery_level) AS sum_battery_level,
+  sum(sumsq_battery_level) AS sumsq_battery_level
+FROM sensor_data_month
+GROUP BY id, year
+WITH NO DATA;
 
 SELECT add_continuous_aggregate_policy('sensor_data_year',
-  start_offset => NULL,   
-  end_offset => INTERVAL '1 h',      
-  schedule_interval => INTERVAL '1 h'); 
\ No newline at end of file
+  start_offset => NULL,
+  end_offset => INTERVAL '1 h',
+  schedule_interval => INTERVAL '1 h',
+  if_not_exists => true);